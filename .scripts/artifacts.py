@@ -0,0 +1,133 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""段がつくったファイルを、その段が読んだものの中身で引けるようにしておく置き場
+
+キーは読んだファイルの中身と設定のハッシュなので、同じものを読んだ段の出力はつくり直さずに置き場から取り出せる。
+取り出すときはハードリンクを張り（張れなければコピーし）、置き場が max_bytes を超えたら
+いちばん長く使われていないものから捨てる。
+
+  cache = ArtifactCache()
+  key = cache.key('combine', [pdf_q, pdf_a], {'mode': mode}, scripts=[__file__])
+  if cache.fetch(key, combined) is None:
+    ... combined をつくる ...
+    cache.store(key, combined, pages=pages)
+
+置き場の中身は、キーの名前の出力ファイルと、その記録（キー.json）。使った時刻は出力ファイルの更新時刻で表す。
+記録にはいつも出力ファイルのバイト数（bytes）を入れておき、読めない記録や大きさの合わない出力は、なかったものとして捨てる。
+"""
+
+import os
+import json
+import shutil
+import threading
+import hashlib
+import mymodule
+import runlog
+from pathlib import Path
+from functools import lru_cache
+
+CACHEDIR = mymodule.APPDIR / '.cache/artifacts'
+# 置き場の大きさの上限（バイト）
+MAX_BYTES = 2 << 30
+
+@lru_cache(maxsize=None)
+def _script_digest(path: str) -> str:
+  """スクリプトの中身のハッシュ（1プロセスで1回だけ読む）"""
+  return mymodule.file_digest(Path(path))
+
+class ArtifactCache():
+  """内容で引く出力の置き場（プロセスプールの子プロセスにもそのまま渡せる）"""
+
+  def __init__(self, root: Path = CACHEDIR, max_bytes: int = MAX_BYTES):
+    self.root = Path(root)
+    self.max_bytes = max_bytes
+
+  def key(self, stage: str, files: list, settings: dict, scripts: list = ()) -> str:
+    """段の名前、読むファイルの中身、設定、出力を左右するスクリプトの中身からキーを決める"""
+    h = hashlib.sha256()
+    h.update(json.dumps([stage, settings], sort_keys=True, default=str).encode())
+    for path in files:
+      h.update(mymodule.file_digest(path).encode())
+    for path in scripts:
+      h.update(_script_digest(str(path)).encode())
+    return h.hexdigest()
+
+  def fetch(self, key: str, dest: Path) -> dict:
+    """キーの出力があればdestに置いて、しまったときの記録（storeに渡したもの）を返す。なければNone"""
+    obj = self.root / key
+    record_path = self.root / f'{key}.json'
+    # 記録は出力をしまい終えてから書くので、記録があればしまい終えている
+    if not record_path.exists() or not obj.exists():
+      runlog.record('cache', 'miss', page=dest.stem)
+      return None
+    record = mymodule.load_manifest(record_path)
+    try:
+      # 壊れた記録（読めなければ空になる）や、記録と大きさの合わない出力は使わずに捨てる
+      if not isinstance(record, dict) or record.get('bytes') != obj.stat().st_size:
+        self.__discard(key)
+        runlog.record('cache', 'miss', page=dest.stem, corrupt=True)
+        return None
+      _place(obj, dest)
+      # 使った時刻を新しくする（捨てる順番を決めるのに使う）
+      os.utime(obj)
+    except FileNotFoundError:
+      # ほかのプロセスがちょうど捨てた
+      runlog.record('cache', 'miss', page=dest.stem)
+      return None
+    runlog.record('cache', 'hit', page=dest.stem, bytes=obj.stat().st_size)
+    return record
+
+  def store(self, key: str, src: Path, **record) -> None:
+    """srcをキーの出力として置き場にしまい、置き場が大きくなりすぎていたら古いものから捨てる
+
+    recordには、取り出すときに要る（出力ファイルからはすぐにわからない）ことを入れておく。
+    """
+    self.root.mkdir(parents=True, exist_ok=True)
+    record = {**record, 'bytes': src.stat().st_size}
+    _place(src, self.root / key)
+    # 同じキーを同時にしまうこともある（問いと答えのHTMLが同じなど）ので、一時ファイルの名前は呼び手ごとに変える
+    temp = self.root / f'{key}.{os.getpid()}-{threading.get_ident()}.tmp'
+    temp.write_text(json.dumps(record, ensure_ascii=False), encoding='utf-8')
+    os.replace(temp, self.root / f'{key}.json')
+    self.evict()
+
+  def evict(self) -> int:
+    """置き場が max_bytes に収まるまで、いちばん長く使われていないものから捨て、捨てたバイト数を返す"""
+    objects = []
+    try:
+      with os.scandir(self.root) as entries:
+        for entry in entries:
+          if entry.is_file() and '.' not in entry.name:
+            stat = entry.stat()
+            objects.append((stat.st_mtime_ns, stat.st_size, entry.name))
+    except FileNotFoundError:
+      return 0
+    total = sum(size for mtime, size, name in objects)
+    freed = 0
+    for mtime, size, name in sorted(objects):
+      if total - freed <= self.max_bytes: break
+      self.__discard(name)
+      freed += size
+    if freed: runlog.record('cache', 'evict', bytes=freed)
+    return freed
+
+  def __discard(self, key: str) -> None:
+    """キーの出力と記録を捨てる"""
+    (self.root / key).unlink(missing_ok=True)
+    (self.root / f'{key}.json').unlink(missing_ok=True)
+
+def _place(src: Path, dest: Path) -> None:
+  """srcと同じ中身のファイルをdestに置く（ハードリンクを張れなければコピーする）
+
+  一時的な名前で置いてから置き換えるので、途中で止まっても書きかけのdestは残らない。
+  destにもともとあったファイルは置き換わるだけで、中身は書き換えない（ハードリンクの先の中身を壊さない）。
+  """
+  temp = dest.with_name(f'{dest.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+  temp.unlink(missing_ok=True)
+  try:
+    os.link(src, temp)
+  except OSError:
+    # ハードリンクを張れないファイルシステムや、別のドライブ
+    shutil.copyfile(src, temp)
+  os.replace(temp, dest)
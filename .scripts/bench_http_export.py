@@ -0,0 +1,53 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""notion_http.NotionHttpExporter の計測（Notionの代役サーバーを相手に）
+
+代役サーバーのエクスポートには export_delay_second 秒かかる（Notion側の処理時間のつもり）。
+1ページずつ頼んで待つときと、まとめて頼んで状態をまとめて聞くときとで、かかる時間と、
+開いた接続の数・状態を聞いた回数を比べる。最後に、わざと失敗させたときのやり直しも確かめる。
+
+  python bench_http_export.py [ページ数 ...]
+"""
+
+import sys
+import time
+from mylib.path import TempDirPath
+from notion_standin import NotionStandin, TASKS_API_PATH
+from notion_http import NotionHttpExporter
+
+TOKEN = 'bench-token'
+
+def run(n_pages: int, one_by_one: bool, delay_second: float = 1., **faults) -> None:
+  dest = TempDirPath()
+  with NotionStandin(export_delay_second=delay_second, token=TOKEN, **faults) as standin:
+    pages = [(f'Page {n}', standin.add_page(f'Page {n}')) for n in range(n_pages)]
+    if 'seed' in faults: standin.break_page(pages[-1][1])
+    exporter = NotionHttpExporter(dest, cookies={'token_v2': TOKEN}, poll_interval_second=0.2,
+                                  max_attempts=3 if not faults else 4)
+    exporter.backoff.base_second = 0.2
+    started = time.perf_counter()
+    if one_by_one:
+      failed = [title for title, url in pages if not exporter.download(url, title)]
+    else:
+      failed = exporter.download_many(pages)
+    elapsed = time.perf_counter() - started
+    exporter.close()
+    saved = len(list(dest.glob('*.html')))
+    print(f'{n_pages:>5} pages {"one by one" if one_by_one else "at once   "}: {elapsed:6.2f} s '
+          f'({elapsed/n_pages*1000:7.1f} ms/page), {saved} saved, {len(failed)} failed, '
+          f'{exporter.pool.opened} connections opened ({standin.connections} accepted), '
+          f'{standin.api_requests.get(TASKS_API_PATH, 0)} status polls')
+    if faults:
+      print(f'      task failures injected: {sum(standin.export_failures.values())}, '
+            f'gave up: {sorted(exporter.failures)}')
+  del dest
+
+def main(sizes=(20, 200)):
+  run(10, one_by_one=True)
+  for n in sizes:
+    run(n, one_by_one=False)
+  run(50, one_by_one=False, export_failure_rate=0.3, seed=0)
+
+if __name__ == '__main__':
+  main([int(arg) for arg in sys.argv[1:]] or (20, 200))
@@ -0,0 +1,96 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""reform_html.lenz のマイクロベンチマーク
+
+以前の実装（PATTERNSを1文字ごとに総なめし、Fractionを毎回つくる）と
+結果が完全に一致することを確かめたうえで、速さを比べる。
+"""
+
+import reform_html
+import re
+import random
+import timeit
+from fractions import Fraction
+import unicodedata
+
+def legacy_lenz(s: str):
+  """以前のlenz（比較用にそのまま残したもの）"""
+  PATTERNS = {
+    ",:;": "2/9",
+    "'‘`": "3/13",
+    "I!": "2/7",
+    "ijl.|": "1/4",
+    "_/\\": "2/5",
+    "frtJ \"()[]{}": "1/3",
+    "*-": "3/7",
+    "?": "4/9",
+    "EFLSTY$": "1/2",
+    "#": "3/5",
+    "~<=>^": "2/3",
+    "DGHNOQ+": "3/4",
+    "%&": "7/8",
+    "mw": "5/6",
+    "MW@": "1",
+  }
+  length = 0.
+  for c in s:
+    for pat, length_str in PATTERNS.items():
+      if c in pat:
+        length += Fraction(length_str)
+        break
+    else:
+      if re.match('[0-9a-zｱ-ﾝ]', c):
+        length += Fraction('1/2')
+      elif re.match('[A-Z]', c):
+        length += Fraction('3/5')
+      elif unicodedata.east_asian_width(c) in 'FW':
+        length += 1.
+      elif unicodedata.east_asian_width(c) in 'HNa':
+        length += Fraction('1/2')
+      else:
+        length += Fraction('3/4')
+  return float(length)
+
+def make_corpus(n: int, seed: int = 0):
+  """日本語と英語のまじった一問一答の問い部分っぽい文字列をn個つくる"""
+  rnd = random.Random(seed)
+  ja = 'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん' \
+       'アイウエオカキクケコサシスセソ漢字問題答解説重要語句年代人物事件条約法律（）「」、。'
+  en = ['Treaty', 'of', 'Versailles', 'HTTP', 'TCP/IP', 'O(n)', 'x + y = z', 'DNA', 'e.g.', "don't", '100%', '#1', 'Q&A']
+  corpus = []
+  for _ in range(n):
+    words = []
+    for _ in range(rnd.randint(2, 12)):
+      if rnd.random() < 0.6:
+        words.append(''.join(rnd.choice(ja) for _ in range(rnd.randint(1, 6))))
+      else:
+        words.append(rnd.choice(en))
+    corpus.append(rnd.choice([' ', '']).join(words) + rnd.choice(['　', '  ', '　　']))
+  return corpus
+
+def main(n: int = 20000, repeat: int = 5):
+  corpus = make_corpus(n)
+
+  # 結果が以前と変わらないことの確認
+  mismatches = [s for s in corpus if reform_html.lenz(s) != legacy_lenz(s)]
+  print(f'corpus: {n} strings, {sum(map(len, corpus))} chars, mismatches: {len(mismatches)}')
+
+  def run_legacy():
+    for s in corpus: legacy_lenz(s)
+  def run_cold():
+    reform_html.lenz.cache_clear()
+    for s in corpus: reform_html.lenz(s)
+  def run_warm():
+    for s in corpus: reform_html.lenz(s)
+  def run_units():
+    for s in corpus: reform_html.lenz_units(s)
+
+  results = {}
+  for name, func in [('legacy', run_legacy), ('lenz (cold cache)', run_cold), ('lenz (warm cache)', run_warm), ('lenz_units', run_units)]:
+    results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+  for name, sec in results.items():
+    print(f'{name:>18}: {sec*1000:9.2f} ms  (x{results["legacy"]/sec:.1f})')
+
+if __name__ == '__main__':
+  main()
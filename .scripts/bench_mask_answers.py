@@ -0,0 +1,114 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""reform_html.mask_answers の回帰確認とベンチマーク
+
+以前の実装（1行置換するたびにbody全体を作り直す）と出力が完全に一致することを確かめたうえで、
+ページの大きさに対して処理時間がどう伸びるかを比べる。
+"""
+
+import reform_html
+from reform_html import lenz, WIDTHZ
+import re
+import random
+import time
+from queue import LifoQueue
+
+def legacy_mask_answers(body: str):
+  """以前のproblem_htmlの虫食い処理（比較用にそのまま残したもの）"""
+  summary_list = list(re.finditer(r"<summary>(.|\n)*?</summary>", body))
+  invalid_summs = LifoQueue()
+  for summ in reversed(summary_list):
+    if re.compile(r'(<[^<>]*?>)*[☆※](.|\n)*').fullmatch(summ.group(0)): continue
+    if re.compile(r'<summary><del>(.|\n)*?</del></summary>').fullmatch(summ.group(0)): continue
+    match_list = list(re.finditer(r"(<summary>|\n)(([^\n]*?)(　+|[　 ]{2,}))[^　 \n]", summ.group(0)))
+    if len(match_list)==0:
+      invalid_summs.put(summ)
+      continue
+    ques_and_blank = re.sub(r"<[^<>]*?>", "", match_list[0].group(2))
+    ques_and_blank_lenz = lenz(ques_and_blank)
+    ans_lenz = WIDTHZ - int(ques_and_blank_lenz)
+    for idx, m in enumerate(list(reversed(match_list))):
+      repl = f'<mark class="highlight-yellow_background">{"　"*(ans_lenz-3)}\t\t\t\t\t\t</mark>'
+      start = summ.start() + m.end() - 1
+      if idx < len(match_list)-1:
+        startroot = summ.start() + m.start() + 2
+        start = startroot + 1
+        while True:
+          temp_ques_and_blank = re.sub(r"<[^<>]*>", "", body[startroot:start])
+          if lenz(temp_ques_and_blank) > ques_and_blank_lenz \
+            or re.compile(r'.*(　+|[　 ]{2,})[^　 \n]').fullmatch(temp_ques_and_blank):
+            start -= 1
+            break
+          start += 1
+      stop = start + re.search(r'</summary>|\n', body[start:]).start()
+      body = f'{body[:start]}{repl}{body[stop:] if stop<len(body) else ""}'
+  return body, [invalid_summs.get() for _ in range(invalid_summs.qsize())]
+
+# 手書きの回帰用フィクスチャ。タグをまたぐ空白、除外されるトグル、複数行、行頭の空白などを含む。
+FIXTURE = '''<body><div class="page-body"><div class="indented">
+<details><summary>鎌倉幕府の成立　　1185年</summary></details>
+<details><summary>☆これはマスクしない　答え</summary></details>
+<details><summary>※これもマスクしない　答え</summary></details>
+<details><summary><del>取り消し　答え</del></summary></details>
+<details><summary>区切りのない不適切なトグル</summary></details>
+<details><summary>TCP/IPの層の数  4
+OSIの層の数  7
+HTTPの既定ポート　80</summary></details>
+<details><summary><strong>太字の問い</strong>　<strong>太字の答え</strong>
+次の<em>問い</em>　　<code>code</code></summary></details>
+<details><summary>問題　<b>　</b>答え
+行頭の空白
+  答えだけの行
+　全角の行頭空白の行</summary></details>
+<details><summary>とても長い問題文がここにあります　　答え
+  短
+次の問題　　答え</summary></details>
+<details><summary>A very long English question that is longer than the page width, really  answer
+short  x</summary></details>
+</div></div></body>'''
+
+def make_body(n_toggles: int, seed: int = 0):
+  """トグルをn_toggles個もつbodyをつくる"""
+  rnd = random.Random(seed)
+  words = ['鎌倉幕府', '成立', 'TCP/IP', '条約', 'Versailles', '<strong>重要</strong>', '<code>x+y</code>', '年代', 'DNA', '人物']
+  seps = ['　', '  ', '　　', '   ']
+  rows = []
+  for _ in range(n_toggles):
+    lines = []
+    for _ in range(rnd.choice([1, 1, 1, 2, 3])):
+      ques = ''.join(rnd.choice(words) for _ in range(rnd.randint(1, 4)))
+      ans = ''.join(rnd.choice(words) for _ in range(rnd.randint(1, 3)))
+      lines.append(f'{ques}{rnd.choice(seps)}{ans}')
+    prefix = rnd.choice(['', '', '', '', '☆', '<del>'])
+    text = '\n'.join(lines)
+    if prefix == '<del>':
+      text = f'<del>{text}</del>'
+    else:
+      text = prefix + text
+    rows.append(f'<details><summary>{text}</summary></details>')
+  return '<body><div class="page-body"><div class="indented">\n' + '\n'.join(rows) + '\n</div></div></body>'
+
+def check(body: str):
+  new_body, new_invalid = reform_html.mask_answers(body)
+  old_body, old_invalid = legacy_mask_answers(body)
+  assert new_body == old_body, 'output differs from the previous implementation'
+  assert [m.span() for m in new_invalid] == [m.span() for m in old_invalid]
+
+def main(sizes=(100, 1000, 3000, 10000)):
+  check(FIXTURE)
+  print('fixture: identical')
+  for n in sizes:
+    body = make_body(n, seed=n)
+    check(body)
+    timings = {}
+    for name, func in [('legacy', legacy_mask_answers), ('mask_answers', reform_html.mask_answers)]:
+      started = time.perf_counter()
+      func(body)
+      timings[name] = time.perf_counter() - started
+    print(f'{n:>6} toggles ({len(body):>8} chars): '
+          f'legacy {timings["legacy"]*1000:9.1f} ms, mask_answers {timings["mask_answers"]*1000:7.1f} ms '
+          f'(x{timings["legacy"]/timings["mask_answers"]:.1f})')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""reform_html.EDITERS の編集屋どうしの比較
+
+BeautifulSoupで木をつくる編集屋（soup）と、1回読むだけの編集屋（stream）について、
+問い用・答え用のHTMLが1文字も違わないことを確かめたうえで、速さを比べる。
+soupの出力はBeautifulSoupの版で変わりうるので、streamを使う前にenvironment.ymlの環境でこれを走らせること。
+"""
+
+import reform_html
+import bs4
+import bench_suite
+from mylib.path import TempDirPath
+import time
+
+# 手書きの回帰用フィクスチャ。リンク、codeの連結、入れ子のトグル、実体参照、コメント、
+# 空白だけの文字列、属性の引用符、class の空白、pre の中の空白などを含む。
+FIXTURE = '''<!DOCTYPE html>
+<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"/><title>A &amp; B</title><style>
+/* cspell:disable-file */ a > b { color: red; }
+</style><style>.second {}</style></head><body><article id="x" class="page sans"><header><h1 class="page-title">A &amp; B</h1></header>
+<div class="page-body"><p>前書き <a href="https://example.com?a=1&amp;b=2">リンク</a>&nbsp;&#39;&#x27;&#150;&foo; &amp &lt;</p>
+<div class="indented">
+<ul class="toggle"><li><details open=""><summary>鎌倉幕府の<code>成</code><code>立</code>　　<a href="#">1185年</a></summary><div class="indented"><p>解説</p>
+<ul class="toggle"><li><details open=""><summary>入れ子　答え</summary><p>消える</p></details></li></ul></div></details></li></ul>
+<ul class="toggle"><li><details open=""><a href="#"><summary>リンクの中の問い　答え</summary></a> 余り <!-- コメント --></details></li></ul>
+<ul class="toggle"><li><details open=""><summary><strong>太字</strong><code>x</code><strong><code>y</code></strong>　<em><code>z</code></em>
+次の<code>a</code><em><code>b</code></em>  答え</summary></details></li></ul>
+<ul class="toggle"><li><details open=""><summary>☆除外　答え</summary><div>消える</div></details></li></ul>
+<details open=""><summary class=" x  y ">属性つき　答え</summary></details>
+<p title='say "hi"' data-x="it's" data-y='"both" it&#39;s'>引用符</p>
+<pre>  空白を   残す  </pre>   <span>   </span><span>
+  </span><br><br/><hr></hr><div/><img src="a.png" alt="">
+<!---->
+</div></div>
+<details open=""><summary>page-bodyの外　答え</summary><p>残る</p></details>
+</article></body></html>
+'''
+
+def check(nhfile) -> None:
+  soup = reform_html.EDITERS['soup'](nhfile)
+  stream = reform_html.EDITERS['stream'](nhfile)
+  assert stream.basic_html == soup.basic_html, 'basic_html differs'
+  assert stream.problem_html == soup.problem_html, 'problem_html differs'
+
+def main(sizes=(30, 300, 3000, 10000), repeat: int = 3):
+  tempdir = TempDirPath()
+  try:
+    def nhfile_for(name: str, html: str):
+      src = tempdir / f'{name}.html'
+      src.write_text(html, encoding='utf-8', newline='')
+      return reform_html.NotionHtmlFile(name, src, tempdir / f'{name}_q.html', tempdir / f'{name}_a.html')
+
+    print(f'BeautifulSoup {bs4.__version__}')
+    check(nhfile_for('fixture', FIXTURE))
+    check(nhfile_for('fixture_crlf', FIXTURE.replace('\n', '\r\n')))
+    print('fixture: identical')
+    for n in sizes:
+      nhfile = nhfile_for(f'page{n}', bench_suite.notion_export_html(f'page{n}', n, seed=n))
+      check(nhfile)
+      timings = {}
+      for engine in reform_html.EDITERS:
+        best = None
+        for _ in range(repeat if n < 10000 else 1):
+          started = time.perf_counter()
+          reform_html.reform(nhfile, engine=engine)
+          elapsed = time.perf_counter() - started
+          best = elapsed if best is None else min(best, elapsed)
+        timings[engine] = best
+      print(f'{n:>6} toggles ({nhfile.src.stat().st_size:>9} B): identical, '
+            f'soup {timings["soup"]*1000:9.1f} ms, stream {timings["stream"]*1000:8.1f} ms '
+            f'(x{timings["soup"]/timings["stream"]:.1f})')
+  finally:
+    del tempdir
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,301 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""Notionにつながずに回せるベンチマーク一式
+
+NotionHtmlEditerが読むのと同じ形（div.page-body div.indented details）のエクスポートHTMLと、
+印刷後のものに見立てたPDFをその場でつくり、
+reform_html.reform・reform_html.lenz・combine_pdfsの見開き（COMPOSERSのすべて）とそれを小さくするoptimize_pdfs、
+1冊へのまとめ（bind）の時間を測る。
+つくるデータは乱数の種で決まるので、何度回しても同じものになる。
+quizpdf.pyの各サブコマンドが読み込むモジュールの読み込み時間（python -X importtime）も測る。
+
+結果は log/bench.jsonl に1件1行で書き足し、前の版（コミット）の結果と比べて表示する。
+
+  python bench_suite.py                  # トグル30〜30000個のページで全部
+  python bench_suite.py --sizes 30 300   # 小さいものだけ
+"""
+
+import reform_html
+import combine_pdfs
+import optimize_pdfs
+import bench_lenz
+import mymodule
+from mylib.path import TempDirPath
+import io
+import sys
+import json
+import time
+import zlib
+import tracemalloc
+import random
+import argparse
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+RESULTS_PATH = mymodule.APPDIR / 'log/bench.jsonl'
+# 起動時間の内訳に出す、重い依存パッケージ
+HEAVY_MODULES = ('selenium', 'chromedriver_binary', 'bs4', 'PyPDF2', 'tqdm')
+
+_WORDS = ['鎌倉幕府', '成立', 'TCP/IP', '条約', 'Versailles', '年代', 'DNA', '人物', 'O(n)', '光合成',
+          '<strong>重要</strong>', '<code>x+y</code>', '<em>強調</em>', '<a href="https://example.com">リンク</a>']
+_SEPS = ['　', '  ', '　　', '   ']
+
+def _summary_text(rnd: random.Random) -> str:
+  """summaryの中身。1〜3行の「問い＋空白＋答え」と、☆・※・<del>による除外や区切りのない行がまじる"""
+  lines = []
+  for _ in range(rnd.choice([1, 1, 1, 2, 3])):
+    ques = ''.join(rnd.choice(_WORDS) for _ in range(rnd.randint(1, 4)))
+    ans = ''.join(rnd.choice(_WORDS) for _ in range(rnd.randint(1, 3)))
+    lines.append(f'{ques}{rnd.choice(_SEPS)}{ans}')
+  text = '\n'.join(lines)
+  kind = rnd.random()
+  if kind < 0.05: return '☆' + text
+  if kind < 0.08: return '※' + text
+  if kind < 0.11: return f'<del>{text}</del>'
+  if kind < 0.13: return ''.join(rnd.choice(_WORDS) for _ in range(3))   # 区切りのない不適切なトグル
+  return text
+
+def _toggles(rnd: random.Random, n: int, depth: int = 0) -> tuple:
+  """トグルn個ぶんのHTMLと、実際につくったトグルの数を返す（ときどき入れ子になる）"""
+  rows = []
+  made = 0
+  while made < n:
+    made += 1
+    inner = f'<p>解説{made}：{"".join(rnd.choice(_WORDS) for _ in range(rnd.randint(2, 8)))}</p>'
+    if depth < 2 and made < n and rnd.random() < 0.1:
+      child, count = _toggles(rnd, min(n - made, rnd.randint(1, 4)), depth + 1)
+      inner += f'<div class="indented">{child}</div>'
+      made += count
+    rows.append(f'<ul class="toggle"><li><details open=""><summary>{_summary_text(rnd)}</summary>'
+                f'<div class="indented">{inner}</div></details></li></ul>')
+  return '\n'.join(rows), made
+
+def notion_export_html(title: str, n_toggles: int, seed: int = 0) -> str:
+  """Notionのエクスポートと同じ形の、トグルをn_toggles個もつページのHTML"""
+  rnd = random.Random(seed)
+  rows, _ = _toggles(rnd, n_toggles)
+  return (
+    f'<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"/><title>{title}</title>'
+    f'<style>/* cspell:disable-file */ html {{ -webkit-print-color-adjust: exact; }} body {{ margin: 0; }}</style></head>'
+    f'<body><article id="{seed:08x}" class="page sans"><header><h1 class="page-title">{title}</h1></header>'
+    f'<div class="page-body"><p>前書き</p><div class="indented">\n{rows}\n</div></div></article></body></html>'
+  )
+
+def quiz_pdf(n_pages: int, answer: bool, seed: int = 0) -> bytes:
+  """印刷後のPDFに見立てたA4縦のPDF
+
+  Chromeの出力と同じく、フォントを埋め込み（中身は意味のないバイト列）、内容ストリームは圧縮しておく。
+  問い用と答え用で同じseedを使えば、埋め込むフォントは同じものになる。
+  """
+  rnd = random.Random(seed)
+  font_data = bytes(rnd.getrandbits(8) for _ in range(40000))
+  objects = [
+    b'<</Type /Catalog /Pages 2 0 R>>',
+    None,   # ページツリー（後で埋める）
+    b'<</Length %d /Length1 %d>>\nstream\n' % (len(font_data), len(font_data)) + font_data + b'\nendstream',
+    b'<</Type /FontDescriptor /FontName /Quiz /Flags 4 /FontBBox [0 -200 1000 800] /ItalicAngle 0'
+    b' /Ascent 800 /Descent -200 /CapHeight 700 /StemV 80 /FontFile2 3 0 R>>',
+    b'<</Type /Font /Subtype /TrueType /BaseFont /Quiz /FirstChar 32 /LastChar 126 /FontDescriptor 4 0 R'
+    b' /Widths [' + b' '.join(b'500' for _ in range(95)) + b']>>',
+  ]
+  kids = []
+  for n in range(n_pages):
+    lines = [b'BT /F1 11 Tf 40 800 Td 14 TL']
+    for k in range(50):
+      words = ' '.join(rnd.choice(['Kamakura', 'TCP/IP', 'treaty', 'DNA', '1185']) for _ in range(6))
+      lines.append(b"(Q%d-%d %s  %s) '" % (n, k, words.encode(), b'answer' if answer else b'______'))
+    lines.append(b'ET')
+    content = zlib.compress(b'\n'.join(lines))
+    objects.append(b'<</Filter /FlateDecode /Length %d>>\nstream\n' % len(content) + content + b'\nendstream')
+    objects.append(b'<</Type /Page /Parent 2 0 R /MediaBox [0 0 595.92 842.88] /Resources <</Font <</F1 5 0 R>>>>'
+                   b' /Contents %d 0 R>>' % len(objects))
+    kids.append(b'%d 0 R' % len(objects))
+  objects[1] = b'<</Type /Pages /Kids [%s] /Count %d>>' % (b' '.join(kids), n_pages)
+  buf = io.BytesIO()
+  buf.write(b'%PDF-1.4\n')
+  offsets = []
+  for num, data in enumerate(objects, 1):
+    offsets.append(buf.tell())
+    buf.write(b'%d 0 obj\n' % num + data + b'\nendobj\n')
+  xref = buf.tell()
+  buf.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects)+1))
+  buf.write(b''.join(b'%010d 00000 n \n' % offset for offset in offsets))
+  buf.write(b'trailer\n<</Size %d /Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (len(objects)+1, xref))
+  return buf.getvalue()
+
+def _best_of(func, repeat: int) -> float:
+  timings = []
+  for _ in range(repeat):
+    started = time.perf_counter()
+    func()
+    timings.append(time.perf_counter() - started)
+  return min(timings)
+
+def bench_reform(tempdir, sizes: list, repeat: int) -> list:
+  """トグルの数ごとに、reform_html.reform（読み込み・虫食い・書き出し）の時間を測る"""
+  results = []
+  for n in sizes:
+    src = tempdir / f'page{n}.html'
+    src.write_text(notion_export_html(f'page{n}', n, seed=n), encoding='utf-8')
+    nhfile = reform_html.NotionHtmlFile(f'page{n}', src, tempdir / f'page{n}_q.html', tempdir / f'page{n}_a.html')
+    seconds = _best_of(lambda: reform_html.reform(nhfile), repeat if n < 10000 else 1)
+    results.append({'bench': 'reform', 'size': n, 'seconds': seconds, 'bytes': src.stat().st_size})
+  return results
+
+def bench_lenz_corpus(n: int, repeat: int) -> list:
+  """bench_lenzと同じ問い部分っぽい文字列n個について、lenzの時間を測る（キャッシュなし・あり）"""
+  corpus = bench_lenz.make_corpus(n)
+  def cold():
+    reform_html.lenz.cache_clear()
+    for s in corpus: reform_html.lenz(s)
+  def warm():
+    for s in corpus: reform_html.lenz(s)
+  return [{'bench': 'lenz_cold', 'size': n, 'seconds': _best_of(cold, repeat)},
+          {'bench': 'lenz_warm', 'size': n, 'seconds': _best_of(warm, repeat)}]
+
+def bench_combine(tempdir, pages: list, repeat: int) -> list:
+  """PDFのページ数ごとに、COMPOSERSのそれぞれで見開きをつくる時間と出力の大きさ、それを小さくする時間と大きさを測る"""
+  results = []
+  for n in pages:
+    src_q = tempdir / f'book{n}_q.pdf'
+    src_a = tempdir / f'book{n}_a.pdf'
+    src_q.write_bytes(quiz_pdf(n, answer=False, seed=n))
+    src_a.write_bytes(quiz_pdf(n, answer=True, seed=n))
+    for mode, compose in combine_pdfs.COMPOSERS.items():
+      npfile = combine_pdfs.NotionPdfFile(f'book{n}', src_q, src_a, tempdir / f'book{n}-{mode}.pdf')
+      seconds = _best_of(lambda: compose(npfile), repeat if n < 100 else 1)
+      results.append({'bench': f'combine_{mode}', 'size': n, 'seconds': seconds, 'bytes': npfile.exp.stat().st_size})
+      optimized = tempdir / f'book{n}-{mode}-optimized.pdf'
+      seconds = _best_of(lambda: optimize_pdfs.rewrite(npfile.exp, optimized), repeat if n < 100 else 1)
+      results.append({'bench': f'optimize_{mode}', 'size': n, 'seconds': seconds, 'bytes': optimized.stat().st_size})
+  return results
+
+def bench_book(tempdir, books: list, pages_per_title: int = 50) -> list:
+  """見開きのページ数ごとに、pages_per_titleページの見開きのPDFをつなげて1冊にする時間と出力の大きさ、メモリの最大を測る
+
+  見開きのPDFは1つだけつくって使い回す（フォントなどは全ファイルで同じなので、1冊には1つだけ入るはず）。
+  """
+  src_q = tempdir / 'title_q.pdf'
+  src_a = tempdir / 'title_a.pdf'
+  src_q.write_bytes(quiz_pdf(pages_per_title, answer=False))
+  src_a.write_bytes(quiz_pdf(pages_per_title, answer=True))
+  spread = combine_pdfs.NotionPdfFile('title', src_q, src_a, tempdir / 'title.pdf')
+  combine_pdfs.pdf2to1_xobject(spread)
+  results = []
+  for n in books:
+    sources = [(f'Title {k}', spread.exp) for k in range(max(1, n // pages_per_title))]
+    dest = tempdir / f'book{n}.pdf'
+    tracemalloc.start()
+    started = time.perf_counter()
+    num_pages = combine_pdfs.bind(sources, dest)
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append({'bench': 'book', 'size': num_pages, 'seconds': seconds, 'bytes': dest.stat().st_size,
+                    'peak_bytes': peak, 'source_bytes': spread.exp.stat().st_size * len(sources)})
+  return results
+
+def import_time(modules: list) -> tuple:
+  """新しいPythonでmodulesを読み込み、-X importtime の出力から (秒数, 読み込まれたモジュールの集合) を返す
+
+  秒数は、読み込まれたもののうちいちばん外側のものの cumulative の合計。
+  読み込めなければ ImportError を発出する。
+  """
+  code = '; '.join(f'import {module}' for module in modules)
+  process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                           cwd=Path(__file__).parent, capture_output=True, text=True)
+  if process.returncode != 0:
+    raise ImportError(process.stderr.strip().splitlines()[-1])
+  micro_seconds = 0
+  loaded = set()
+  for line in process.stderr.splitlines():
+    # import time: self [us] | cumulative | imported package
+    if not line.startswith('import time:') or 'imported package' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    loaded.add(name.strip())
+    if not name.startswith('  '):   # 先頭の空白1つは区切り。それより深いものは入れ子
+      micro_seconds += int(cumulative)
+  return micro_seconds / 1e6, loaded
+
+def bench_startup(repeat: int) -> list:
+  """quizpdf.pyの各サブコマンドが実行までに読み込むモジュールの読み込み時間を測る"""
+  import quizpdf
+  results = []
+  for command, modules in quizpdf.COMMAND_MODULES.items():
+    try:
+      timings = [import_time(['quizpdf', *modules]) for _ in range(repeat)]
+    except ImportError as e:
+      print(f'startup {command}: skipped ({e})')
+      continue
+    seconds, loaded = min(timings, key=lambda timing: timing[0])
+    heavy = [module for module in HEAVY_MODULES if module in loaded]
+    results.append({'bench': 'startup', 'size': command, 'seconds': seconds, 'modules': len(loaded), 'heavy': heavy})
+  return results
+
+def version() -> str:
+  """いまのコミット（変更があれば末尾に+）"""
+  try:
+    cwd = mymodule.APPDIR
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+    dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd, capture_output=True, text=True).stdout.strip()
+    return commit + ('+' if dirty else '')
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def load_results(path=RESULTS_PATH) -> list:
+  try:
+    with open(path, encoding='utf-8') as f:
+      return [json.loads(line) for line in f if line.strip()]
+  except FileNotFoundError:
+    return []
+
+def save_results(results: list, path=RESULTS_PATH) -> None:
+  path.parent.mkdir(parents=True, exist_ok=True)
+  with open(path, 'a', encoding='utf-8') as f:
+    for result in results:
+      f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+def main(sizes=(30, 300, 3000, 30000), pages=(10, 100), books=(500, 5000), lenz_n: int = 20000, repeat: int = 3,
+         save: bool = True):
+  run = {'ts': datetime.now().isoformat(timespec='seconds'), 'version': version(),
+         'python': sys.version.split()[0], 'platform': sys.platform}
+  # 前の版の、同じベンチマーク・同じ大きさのいちばん新しい結果
+  previous = {}
+  for result in load_results():
+    if result.get('version') != run['version']:
+      previous[(result['bench'], result['size'])] = result
+
+  tempdir = TempDirPath()
+  try:
+    results = bench_lenz_corpus(lenz_n, repeat) + bench_reform(tempdir, list(sizes), repeat) + bench_combine(tempdir, list(pages), repeat)
+    results += bench_book(tempdir, list(books))
+    results += bench_startup(repeat)
+  finally:
+    del tempdir
+
+  print(f'version {run["version"]}, Python {run["python"]}')
+  for result in results:
+    line = f'{result["bench"]:>16} {result["size"]:>7}: {result["seconds"]*1000:10.1f} ms'
+    if 'bytes' in result: line += f' {result["bytes"]:>11,} B'
+    if 'peak_bytes' in result: line += f' (peak memory {result["peak_bytes"]:,} B, sources {result["source_bytes"]:,} B)'
+    if 'modules' in result: line += f' {result["modules"]:>5} modules {",".join(result["heavy"]) or "-"}'
+    before = previous.get((result['bench'], result['size']))
+    if before:
+      line += f'  ({result["seconds"]/before["seconds"]-1:+.0%} vs {before["version"]})'
+    print(line)
+    result.update(run)
+  if save:
+    save_results(results)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Notionにつながずに回せるベンチマーク')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[30, 300, 3000, 30000], help='ページのトグルの数')
+  parser.add_argument('--pages', type=int, nargs='+', default=[10, 100], help='見開きにするPDFのページ数')
+  parser.add_argument('--books', type=int, nargs='+', default=[500, 5000], help='1冊にまとめる見開きのページ数')
+  parser.add_argument('--repeat', type=int, default=3, help='何回測って最良をとるか')
+  parser.add_argument('--no-save', action='store_true', help='結果を log/bench.jsonl に書き足さない')
+  args = parser.parse_args()
+  main(sizes=args.sizes, pages=args.pages, books=args.books, repeat=args.repeat, save=not args.no_save)
@@ -0,0 +1,306 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""ステップや実行をまたいで使い回すブラウザー
+
+Chromeを1つ、リモートデバッグのポートを開けて起動しておき、notion2htmlもhtml2pdfもそこへつなぐ。
+プロファイルは専用のもの（/.browser/profile）を使うので、ふだん使いのChromeを閉じる必要はなく、
+ダウンロード先を元に戻す必要もない。Notionへのログインも次の実行まで残る（初回だけ、開いたウィンドウでログインする）。
+ブラウザーは実行が終わっても閉じずに残しておき、次の実行ではつなぐだけで済ませる。
+
+ダウンロード先はDevToolsプロトコルで指定する。Page.setDownloadBehaviorはブラウザー全体に効くので、
+同時にいくつものタブでダウンロードするときは、open_context_tabでタブごとにブラウザーコンテキストを分ける。
+
+  driver = browser.connect()                  # 起動していなければ起動してからつなぐ
+  handle = browser.open_tab(driver, tempdir)  # ダウンロード先はtempdir
+  ...
+  browser.close_tab(driver, handle)
+  driver.quit()                               # 切り離すだけで、ブラウザーは閉じない
+
+  python browser.py start [--headless] / status / stop / login
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import subprocess
+import urllib.request
+import mymodule
+import runlog
+from mylib.io import yes_no_input
+from pathlib import Path
+from contextlib import contextmanager
+
+SERVICE_DIR = mymodule.APPDIR / '.browser'
+PROFILE_DIR = SERVICE_DIR / 'profile'
+STATE_PATH = SERVICE_DIR / 'state.json'
+# 起動を1つずつにするためのロックファイル
+LOCK_PATH = SERVICE_DIR / 'start.lock'
+DEFAULT_PORT = 9222
+# Chromeの実行ファイルを指定するための環境変数
+ENV_CHROME = 'CHROME_PATH'
+# 新しいプロファイルで最初に開く、Notionのログインページ
+LOGIN_URL = 'https://www.notion.so/login'
+
+def chrome_path() -> str:
+  """Chromeの実行ファイルのパスを返す。見つからなければFileNotFoundErrorを発出する"""
+  if os.environ.get(ENV_CHROME):
+    return os.environ[ENV_CHROME]
+  for name in ('google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser', 'chrome'):
+    path = shutil.which(name)
+    if path: return path
+  candidates = [
+    Path(os.environ.get('PROGRAMFILES', 'C:/Program Files')) / 'Google/Chrome/Application/chrome.exe',
+    Path(os.environ.get('PROGRAMFILES(X86)', 'C:/Program Files (x86)')) / 'Google/Chrome/Application/chrome.exe',
+    Path(os.environ.get('LOCALAPPDATA', mymodule.HOMEDIR / 'AppData/Local')) / 'Google/Chrome/Application/chrome.exe',
+    Path('/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'),
+  ]
+  for path in candidates:
+    if path.exists(): return str(path)
+  raise FileNotFoundError(f'Chrome was not found. Set {ENV_CHROME} to its executable.')
+
+def _version(port: int) -> dict:
+  """ポートの先のブラウザーの /json/version を返す。応答がなければNone"""
+  try:
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/json/version', timeout=1) as response:
+      return json.load(response)
+  except (OSError, ValueError):
+    return None
+
+def _load_state() -> dict:
+  try:
+    with open(STATE_PATH, encoding='utf-8') as f:
+      return json.load(f)
+  except (FileNotFoundError, ValueError):
+    return {}
+
+def has_display() -> bool:
+  """ウィンドウを出せるか（画面のないLinux、つまりDISPLAYもWAYLAND_DISPLAYもないときだけFalse）"""
+  return not sys.platform.startswith('linux') or bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def _open_page(port: int, url: str) -> None:
+  """ブラウザーに新しいタブでurlを開かせる"""
+  request = urllib.request.Request(f'http://127.0.0.1:{port}/json/new?{url}', method='PUT')
+  with urllib.request.urlopen(request, timeout=5):
+    pass
+
+def status(port: int = None) -> dict:
+  """起動しているブラウザーの状態（pid, port, headless, browser）を返す。起動していなければNone"""
+  state = _load_state()
+  port = port or state.get('port') or DEFAULT_PORT
+  version = _version(port)
+  if version is None: return None
+  if state.get('port') != port:
+    # 記録にないブラウザーでも、ポートが開いていればそれを使う
+    state = {'pid': None, 'port': port, 'headless': None}
+  state['browser'] = version.get('Browser')
+  return state
+
+@contextmanager
+def _start_lock():
+  """ほかのスレッドやプロセスがブラウザーを起動しているあいだ待つ
+
+  同じプロファイルで2つ目のChromeを起動すると、1つ目に任せてすぐ終わってしまうので、起動は1つずつにする。
+  """
+  SERVICE_DIR.mkdir(parents=True, exist_ok=True)
+  with open(LOCK_PATH, 'a+b') as f:
+    if sys.platform == 'win32':
+      import msvcrt
+      while True:
+        try:
+          f.seek(0)
+          msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+          break
+        except OSError:
+          time.sleep(0.1)
+      try:
+        yield
+      finally:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+      import fcntl
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def start(port: int = None, headless: bool = None, timeout_second: float = 20., login: bool = True) -> dict:
+  """ブラウザーが起動していなければ起動し、その状態を返す
+
+  headlessを省略すると、画面のないLinux（DISPLAYもWAYLAND_DISPLAYもない）でだけヘッドレスにする。
+  ブラウザーはこのプロセスが終わっても残るように、別のセッションとして起動する。
+  プロファイルを新しくつくるとき（login=Trueなら）は、ウィンドウを出してNotionにログインしてもらい、
+  ログインしたと答えるまで待つ。ウィンドウを出せなかったり、ログインしなかったりすればRuntimeErrorを発出する。
+  いくつものスレッドやプロセスから同時に呼んでも、起動するのは1つだけ（ほかは起動し終わるのを待ってつなぐ）。
+  """
+  state = status(port)
+  if state is not None: return state
+  with _start_lock():
+    return _launch(port, headless, timeout_second, login)
+
+def _launch(port: int, headless: bool, timeout_second: float, login: bool) -> dict:
+  """startの本体（_start_lockの中で呼ぶ）"""
+  # 待っているあいだにほかが起動したなら、それを使う
+  state = status(port)
+  if state is not None: return state
+  port = port or DEFAULT_PORT
+  # 新しいプロファイルにはNotionのログインがないので、このままではどのページもダウンロードできない
+  first_login = login and not PROFILE_DIR.exists()
+  if first_login:
+    if not has_display() or not sys.stdin.isatty():
+      raise RuntimeError('The shared browser has a new profile without a Notion login, and there is no window to log in through. '
+                         f'Run "python browser.py login" where a display is available (or copy {PROFILE_DIR} from there).')
+    headless = False
+  if headless is None:
+    headless = not has_display()
+  PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+  args = [chrome_path(), f'--remote-debugging-port={port}', f'--user-data-dir={PROFILE_DIR}',
+          '--no-first-run', '--no-default-browser-check', '--start-maximized']
+  if headless: args.append('--headless=new')
+  # rootではサンドボックスが使えない（コンテナーなど）
+  if hasattr(os, 'geteuid') and os.geteuid() == 0: args.append('--no-sandbox')
+  if sys.platform == 'win32':
+    detach = {'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+  else:
+    detach = {'start_new_session': True}
+  with runlog.timed('browser', 'start'):
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **detach)
+    started = time.perf_counter()
+    while _version(port) is None:
+      if process.poll() is not None:
+        raise RuntimeError(f'Chrome exited with code {process.returncode} before opening port {port}.')
+      if time.perf_counter() - started > timeout_second:
+        process.kill()
+        raise TimeoutError(f'Chrome did not open port {port} in {timeout_second} seconds.')
+      time.sleep(0.1)
+  mymodule.save_manifest(STATE_PATH, {'pid': process.pid, 'port': port, 'headless': headless})
+  # logging.info(f'Started browser on port {port}')
+  if first_login and not _wait_for_login(port):
+    stop()
+    raise RuntimeError('Not logged in to Notion. Run "python browser.py login" and log in before downloading.')
+  return status(port)
+
+def _wait_for_login(port: int) -> bool:
+  """ログインページを開き、ログインし終えたかどうかを聞く"""
+  _open_page(port, LOGIN_URL)
+  return yes_no_input('Log in to Notion in the browser window. Have you logged in?')
+
+def login(port: int = None) -> bool:
+  """ウィンドウを出したブラウザーでNotionのログインページを開き、ログインしたかどうかを聞いて返す
+
+  ヘッドレスで起動していれば、いったん閉じてウィンドウを出して起動し直す。
+  """
+  if not has_display():
+    raise RuntimeError('There is no display to log in through. Log in where a display is available '
+                       f'and copy {PROFILE_DIR} here.')
+  state = status(port)
+  if state is not None and state['headless'] is not False:
+    stop()
+  state = start(port, headless=False, login=False)
+  return _wait_for_login(state['port'])
+
+def stop(timeout_second: float = 10.) -> bool:
+  """起動しているブラウザーを閉じる。閉じるものがなければFalseを返す"""
+  state = status()
+  STATE_PATH.unlink(missing_ok=True)
+  if state is None or state['pid'] is None: return False
+  try:
+    os.kill(state['pid'], signal.SIGTERM)
+  except OSError:
+    return False
+  started = time.perf_counter()
+  while _version(state['port']) is not None and time.perf_counter() - started < timeout_second:
+    time.sleep(0.1)
+  return True
+
+def connect(port: int = None, login: bool = True):
+  """ブラウザーにつないだSeleniumのドライバーを返す（起動していなければ起動する）
+
+  ドライバーのquit()はブラウザーから切り離すだけで、ブラウザーは閉じない。
+  スレッドごとに別々につないでよい。
+  Notionにログインしていなくてよい（印刷だけの）ときは login=False にする（startを参照）。
+  """
+  # !conda install -c conda-forge selenium
+  from selenium import webdriver
+  # !conda install -c conda-forge python-chromedriver-binary==バージョン番号
+  import chromedriver_binary   # chromedriver-binaryを使う
+  state = start(port, login=login)
+  options = webdriver.chrome.options.Options()
+  options.debugger_address = f'127.0.0.1:{state["port"]}'
+  with runlog.timed('browser', 'connect'):
+    return webdriver.Chrome(options=options)
+
+def open_tab(driver, download_dir: Path = None) -> str:
+  """新しいタブを開いてそこに切り替え、そのハンドルを返す
+
+  download_dirを指定すると、このタブでのダウンロードはそこへ保存される。
+  """
+  driver.switch_to.new_window('tab')
+  if download_dir is not None:
+    set_download_dir(driver, download_dir)
+  return driver.current_window_handle
+
+def open_context_tab(driver, download_dir: Path) -> tuple:
+  """ダウンロード先をdownload_dirにした別のブラウザーコンテキストに新しいタブを開いてそこに切り替え、
+  (ハンドル, コンテキストID) を返す
+
+  Page.setDownloadBehaviorはブラウザー全体に効くので、タブごとにダウンロード先を分けるにはコンテキストを分ける。
+  新しいコンテキストにはいまのコンテキストのクッキー（ログイン）を写す。
+  コンテキストをつくれない（古いChromeなど）ときは、ふつうのタブを開いてコンテキストIDをNoneにする。
+  """
+  try:
+    context = driver.execute_cdp_cmd('Target.createBrowserContext', {})['browserContextId']
+  except Exception:
+    return open_tab(driver, download_dir), None
+  cookies = driver.execute_cdp_cmd('Storage.getCookies', {})['cookies']
+  if cookies:
+    driver.execute_cdp_cmd('Storage.setCookies', {'cookies': cookies, 'browserContextId': context})
+  driver.execute_cdp_cmd('Browser.setDownloadBehavior',
+                         {'behavior': 'allow', 'downloadPath': str(download_dir), 'browserContextId': context})
+  target = driver.execute_cdp_cmd('Target.createTarget', {'url': 'about:blank', 'browserContextId': context})['targetId']
+  # ChromeDriverのウィンドウハンドルはタブのターゲットIDそのもの（古い版では前に CDwindow- が付く）
+  handle = next((handle for handle in driver.window_handles if handle.endswith(target)), target)
+  driver.switch_to.window(handle)
+  return handle, context
+
+def set_download_dir(driver, download_dir: Path) -> None:
+  """いまのタブのダウンロード先を変える（ブラウザー全体に効く。タブごとに分けるならopen_context_tabを使う）"""
+  driver.execute_cdp_cmd('Page.setDownloadBehavior', {'behavior': 'allow', 'downloadPath': str(download_dir)})
+
+def close_tab(driver, handle: str, context: str = None) -> None:
+  """タブを閉じる（ほかのタスクのタブは閉じない）。contextを指定すると、そのブラウザーコンテキストも捨てる"""
+  try:
+    driver.switch_to.window(handle)
+    driver.close()
+    if context is not None:
+      # 閉じたタブからはCDPを呼べないので、残っているタブに移ってから捨てる
+      driver.switch_to.window(driver.window_handles[0])
+      driver.execute_cdp_cmd('Target.disposeBrowserContext', {'browserContextId': context})
+  except Exception:
+    # すでに閉じられていたり、ブラウザーが落ちていたりしたら何もしない
+    pass
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='ステップや実行をまたいで使い回すブラウザーを操作する')
+  parser.add_argument('command', choices=['start', 'status', 'stop', 'login'])
+  parser.add_argument('--port', type=int, default=None, help=f'リモートデバッグのポート（省略すると{DEFAULT_PORT}）')
+  parser.add_argument('--headless', action=argparse.BooleanOptionalAction, default=None,
+                      help='ヘッドレスで起動するか（省略すると画面のないLinuxでだけヘッドレス）')
+  args = parser.parse_args()
+
+  if args.command == 'start':
+    state = start(args.port, headless=args.headless)
+    print(f'{state["browser"]} on port {state["port"]} (pid {state["pid"]})')
+  elif args.command == 'login':
+    print('logged in' if login(args.port) else 'not logged in')
+  elif args.command == 'status':
+    state = status(args.port)
+    print('not running' if state is None else f'{state["browser"]} on port {state["port"]} (pid {state["pid"]})')
+  else:
+    print('stopped' if stop() else 'not running')
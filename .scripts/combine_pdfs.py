@@ -3,12 +3,25 @@
 
 # from mylib import logging
 import mymodule
+import runlog
+import artifacts
+import optimize_pdfs
 # !conda install -c conda-forge pypdf2
 import PyPDF2
+import pdfstream
+from pdfstream import StreamingPdfWriter
 from tqdm import tqdm
 from pathlib import Path
 from dataclasses import dataclass
 from multiprocessing import Pool
+import argparse
+import traceback
+import os
+
+# 見開きにしたページの横幅（A4横）と余白
+A4YOKO_WITDH = 840.95996
+JOGE_YOHAKU = 20.
+SAYU_YOHAKU = JOGE_YOHAKU / 2**(1/2)  # ルート2で割る
 
 @dataclass
 class NotionPdfFile():
@@ -35,9 +48,6 @@ def pdf2to1(npfile: NotionPdfFile):
   ques_reader = PyPDF2.PdfFileReader(npfile.src_q.as_posix(), strict=False)
   ans_reader = PyPDF2.PdfFileReader(npfile.src_a.as_posix(), strict=False)
   out_writer = PyPDF2.PdfFileWriter()
-  A4YOKO_WITDH = 840.95996
-  JOGE_YOHAKU = 20.
-  SAYU_YOHAKU = JOGE_YOHAKU / 2**(1/2)  # ルート2で割る
   for n in range(0, ques_reader.getNumPages()):
     # 繋ぎ合わせるページ（page1：左側、page2：右側）
     page1 = ques_reader.getPage(n)
@@ -61,29 +71,187 @@ def pdf2to1(npfile: NotionPdfFile):
     out_writer.write(f)
   # logging.info(f'Export {npfile.title}')
 
-def main():
-  # 対象の記事のNotionPdfFileのリストを取得
-  SRCDIR = mymodule.APPDIR / 'pdf/src/'
-  EXPDIR = mymodule.APPDIR / 'pdf/combined/'
-  npfiles = []
-  for title in mymodule.target_pages():
-    src_q = SRCDIR / f'{title}{mymodule.POSTFIXES.q}.pdf'
-    src_a = SRCDIR / f'{title}{mymodule.POSTFIXES.a}.pdf'
-    # もととなるPDFが実際に存在していなければ、ログに書いたうえでスキップ
-    if not all([src_q.exists(), src_a.exists()]):
-      # logging.info(f'"{src_q.name}" or "{src_a.name}" do not exist.')
-      continue
-    exp = EXPDIR / f'{title}.pdf'
-    # リストに追加
-    npfiles.append(NotionPdfFile(title, src_q, src_a, exp))
+def pdf2to1_xobject(npfile: NotionPdfFile):
+  """pdf2to1と同じ見開きを、ページを丸ごとフォームXObjectとして貼り付けてつくる
+
+  pdf2to1はページの内容ストリームを展開してつなぎ直し、全ページをメモリに溜めてから書き出す。
+  こちらはもとのページの内容ストリームを圧縮されたまま写して「q 行列 cm /X Do Q」で置くだけにし、
+  見開き1ページができるたびにファイルへ書き出す。
+  問いと答えで中身が同じフォントなどは1つにまとめるので、ファイルも小さくなる。
+  """
+  ques_reader = PyPDF2.PdfReader(npfile.src_q.as_posix(), strict=False)
+  ans_reader = PyPDF2.PdfReader(npfile.src_a.as_posix(), strict=False)
+  # ページ数が違えば印刷がおかしいので、短いほうに合わせて黙って切り詰めたりしない
+  if len(ques_reader.pages) != len(ans_reader.pages):
+    raise ValueError(f'"{npfile.src_q.name}" has {len(ques_reader.pages)} pages '
+                     f'but "{npfile.src_a.name}" has {len(ans_reader.pages)}')
+  with open(npfile.exp.as_posix(), mode="wb") as f:
+    writer = StreamingPdfWriter(f)
+    for page1, page2 in zip(ques_reader.pages, ans_reader.pages):
+      # 見開きにしたページサイズ（pdf2to1と同じ計算）
+      width1 = float(page1.mediabox.getUpperRight_x())
+      total_width = width1 + float(page2.mediabox.getUpperRight_x()) + SAYU_YOHAKU*4
+      total_height = float(page1.mediabox.getUpperRight_y()) + JOGE_YOHAKU*2
+      page_scale = A4YOKO_WITDH / total_width
+      content = (
+        f'q {page_scale:f} 0 0 {page_scale:f} 0 0 cm '
+        f'q 1 0 0 1 {SAYU_YOHAKU:f} {JOGE_YOHAKU:f} cm /Xq Do Q '
+        f'q 1 0 0 1 {width1+SAYU_YOHAKU*3:f} {JOGE_YOHAKU:f} cm /Xa Do Q Q'
+      ).encode()
+      writer.add_page(total_width*page_scale, total_height*page_scale, content,
+                      {'Xq': writer.form_xobject(page1), 'Xa': writer.form_xobject(page2)})
+    writer.close()
+  # logging.info(f'Export {npfile.title}')
+
+# 見開きのつくり方
+COMPOSERS = {'merge': pdf2to1, 'xobject': pdf2to1_xobject}
+
+# 全ページの見開きを setting.csv の順にまとめた1冊
+BOOK_PATH = mymodule.APPDIR / 'pdf/book.pdf'
+
+# 1プロセスが使うと見込むメモリ（もとのPDFの大きさによらないぶんと、もとのPDFの大きさにかける倍率）
+PROCESS_BASE_MEMORY = 64 << 20
+PROCESS_MEMORY_FACTOR = 4
+
+def pdf_file(title: str) -> NotionPdfFile:
+  """タイトルから、問い用・答え用のPDFと見開きのPDFのパスをまとめて返す"""
+  page = mymodule.make_page(title)
+  return NotionPdfFile(title, page.pdf_q, page.pdf_a, page.combined)
+
+def combine_key(cache: artifacts.ArtifactCache, npfile: NotionPdfFile, mode: str) -> str:
+  """見開きのPDFを置き場から引くキー（問いと答えのPDFの中身、見開きのつくり方と寸法から決まる）"""
+  settings = {'mode': mode, 'width': A4YOKO_WITDH, 'joge': JOGE_YOHAKU, 'sayu': SAYU_YOHAKU}
+  return cache.key('combine', [npfile.src_q, npfile.src_a], settings, scripts=[__file__, pdfstream.__file__])
+
+def combine(job: tuple):
+  """見開きを1つつくる（プロセスプールの各プロセスで実行される）
+
+  jobは (npfile, mode, cache)。cacheがNoneでなければ、前に同じPDFから同じつくり方でつくった見開きを置き場から取り出し、
+  なければつくって置き場にしまう。
+  失敗しても例外は投げず、(npfile, エラーの説明) を返す。成功すればエラーの説明はNone。
+  """
+  npfile, mode, cache = job
+  try:
+    key = None
+    if cache is not None:
+      key = combine_key(cache, npfile, mode)
+      if cache.fetch(key, npfile.exp) is not None:
+        return npfile, None
+    # 置き場の見開きとハードリンクでつながっているかもしれないので、上書きせずに消してから書く
+    npfile.exp.unlink(missing_ok=True)
+    with runlog.timed('combine', mode, page=npfile.title):
+      COMPOSERS[mode](npfile)
+    if cache is not None:
+      cache.store(key, npfile.exp)
+  except Exception:
+    # 書きかけのファイルは残さない
+    npfile.exp.unlink(missing_ok=True)
+    return npfile, traceback.format_exc()
+  return npfile, None
+
+def bind(sources: list, dest: Path) -> int:
+  """(しおりの題名, PDFのパス) のリストの順にPDFをつなげてdestに書き出し、ページ数を返す
+
+  1ファイルずつ読んでは書き出していくので、ページがいくら多くてもメモリに載るのは1ファイルぶんだけ。
+  ファイルどうしで中身が同じフォントなどは1つにまとめる。
+  一時ファイルに書いてから置き換えるので、途中で止まっても前のdestは壊れない。
+  """
+  temp = dest.with_name(f'{dest.name}.tmp')
+  try:
+    with open(temp, mode='wb') as f:
+      writer = StreamingPdfWriter(f)
+      for title, path in tqdm(sources, desc='Binding book'):
+        first = writer.add_pdf(PyPDF2.PdfReader(path.as_posix(), strict=False))
+        if first is not None:
+          writer.add_outline(title, first)
+      writer.close()
+    os.replace(temp, dest)
+  except Exception:
+    # 書きかけのファイルは残さない（前にできた本はそのまま）
+    temp.unlink(missing_ok=True)
+    raise
+  return writer.page_count
+
+def bind_book(dest: Path = BOOK_PATH) -> tuple:
+  """対象のページの見開きのPDFを setting.csv の順につなげて1冊にし、タイトルごとのしおりをつける（bindを参照）
+
+  見開きのPDFがないページは飛ばす。(ページ数, 飛ばしたページのタイトルのリスト) を返す。
+  """
+  pages = [page for page in mymodule.page_index() if page.enabled]
+  names = mymodule.file_names(mymodule.DIRS.pdf_combined)
+  missing = [page.title for page in pages if page.combined.name not in names]
+  with runlog.timed('combine', 'book'):
+    num_pages = bind([(page.title, page.combined) for page in pages if page.title not in missing], dest)
+  return num_pages, missing
+
+def main(mode: str = 'xobject', processes: int = None, cache: bool = True, book: bool = False,
+         optimize: bool = False, linearize: bool = False) -> list:
+  """問いと答えのPDFを見開きにする
+
+  processesはプロセスプールの大きさ（Noneならコア数と空きメモリから決め、1ならこのプロセスだけで処理）。
+  cache=True なら、問いと答えのPDFが前と同じページは、つくり直さずに置き場（artifacts.py）から取り出す。
+  optimize=True なら、できた見開きを同じプロセスプールで小さくする（optimize_pdfsを参照。linearizeはそちらに渡す）。
+  book=True なら、最後に全ページの見開きを1冊（BOOK_PATH）にまとめる（bind_bookを参照）。
+  大きいPDFから先に取りかかり、できたものから順に進捗に反映する。
+  見開きにできなかったページのタイトルのリストを返す。
+  """
+  # 対象の記事のNotionPdfFileのリストを取得（もととなるPDFが存在しないページは飛ばす）
+  npfiles = [pdf_file(page.title) for page in mymodule.stage_status('combine').ready]
+
+  # 大きいものから始めて、最後に大物が1つだけ残るのを避ける
+  sizes = {npfile.title: npfile.src_q.stat().st_size + npfile.src_a.stat().st_size for npfile in npfiles}
+  npfiles.sort(key=lambda npfile: sizes[npfile.title], reverse=True)
+  store = artifacts.ArtifactCache() if cache else None
+  jobs = [(npfile, mode, store) for npfile in npfiles]
+  if processes is None and npfiles:
+    processes = mymodule.pool_size(len(npfiles), PROCESS_BASE_MEMORY + PROCESS_MEMORY_FACTOR * max(sizes.values()))
 
   # 2枚を見開き1ページに
   bar = tqdm(total=len(npfiles))
   bar.set_description('Exporting PDF')
-  with Pool(processes=6) as pool:
-    results = pool.map(pdf2to1, npfiles)
-  for result in results:
+  failed = []
+  def done(result: tuple):
+    npfile, error = result
+    if error is not None:
+      failed.append(npfile.title)
+      bar.write(f'Failed to combine "{npfile.title}":\n{error}')
+      # logging.error(f'Failed to combine {npfile.title}: {error}')
     bar.update(1)
 
+  pool = None if processes == 1 or len(jobs) <= 1 else Pool(processes=processes)
+  imap = map if pool is None else pool.imap_unordered
+  try:
+    for result in imap(combine, jobs):
+      done(result)
+    bar.close()
+    if optimize:
+      optimize_pdfs.optimize_all([npfile.exp for npfile in npfiles if npfile.title not in failed],
+                                 linearize=linearize, cache=store, imap=imap)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  if book: print_book(*bind_book())
+  return failed
+
+def print_book(num_pages: int, missing: list, dest: Path = BOOK_PATH) -> None:
+  """bind_bookの結果を知らせる"""
+  print(f'Bound {num_pages} pages into {dest}')
+  for title in missing:
+    print(f'Missed the combined PDF of "{title}"')
+
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  parser = argparse.ArgumentParser(description='問いと答えのPDFを見開きにする')
+  parser.add_argument('--mode', choices=COMPOSERS.keys(), default='xobject',
+                      help='見開きのつくり方（mergeならPyPDF2でページを展開してつなぎ直す、以前のやり方）')
+  parser.add_argument('--processes', type=int, default=None,
+                      help='プロセスプールの大きさ（省略するとコア数と空きメモリから決める。1ならプールを使わない）')
+  parser.add_argument('--no-cache', action='store_true', help='前と同じPDFでも置き場から取り出さずにつくり直す')
+  parser.add_argument('--book', action='store_true', help='全ページの見開きを setting.csv の順に1冊（pdf/book.pdf）にまとめる')
+  parser.add_argument('--optimize', action='store_true', help='できた見開きを小さくする（同じフォントをまとめ、圧縮し直す）')
+  parser.add_argument('--linearize', action='store_true', help='小さくするときに、1ページ目からすぐ表示できるように並べ直す')
+  args = parser.parse_args()
+  runlog.start('combine_pdfs')
+  main(mode=args.mode, processes=args.processes, cache=not args.no_cache, book=args.book,
+       optimize=args.optimize or args.linearize, linearize=args.linearize)
+  runlog.report()
\ No newline at end of file
@@ -2,22 +2,232 @@
 # This software is released under the MIT License, see LICENSE.
 
 from mylib.io import yes_no_input
-from multiprocessing import freeze_support
+from mylib.path import TempDirPath
+from multiprocessing import freeze_support, Pool
+from datetime import datetime
+from tqdm import tqdm
+import argparse
+import mymodule
+import pipeline
+import runlog
+import retry
+import filewatch
+import artifacts
 import notion2html
+import notion_http
 import reform_html
 import html2pdf
 import combine_pdfs
+import optimize_pdfs
+
+def run_pipeline(reform_workers: int = 2, print_workers: int = 1, combine_workers: int = 2,
+                 backend: str = 'devtools', mode: str = 'xobject', force: bool = False, since: datetime = None,
+                 shared: bool = True, downloader: str = 'browser', spread: bool = False, cache: bool = True,
+                 optimize: bool = False, linearize: bool = False):
+  """1ページずつ、ダウンロード→編集→印刷→見開きと流していく
+
+  全ページのダウンロードを待たずに、ダウンロードできたページから編集・印刷・見開きへと進める。
+  ダウンロードはブラウザー1つで1ページずつ、ほかの段はそれぞれ指定した数だけ同時に進める。
+  編集と見開きはプロセスプールで行う。更新されていないページのダウンロードと編集は飛ばす。
+  shared=True なら、ダウンロードも（devtoolsのプリンターなら）印刷も、使い回すブラウザー（browser.py）のタブで行う。
+  downloader='http' なら、ダウンロードするページのエクスポートを最初にまとめて頼んでおき、できた順に受け取る。
+  spread=True なら、見開き用のHTMLをつくって1ページ1回だけ印刷し、見開きの段は飛ばす（devtoolsのプリンターのみ）。
+  cache=True なら、印刷と見開きは、読むファイルが前と同じなら置き場（artifacts.py）から取り出す。
+  optimize=True なら、できた見開きを（見開きと同じ数だけ同時に）プロセスプールで小さくする（optimize_pdfsを参照）。
+  """
+  if spread and not html2pdf.can_print_spread(backend):
+    raise ValueError(f'The {backend} printer cannot print spreads; use devtools.')
+  if optimize and linearize and not optimize_pdfs.can_linearize():
+    raise ValueError('Linearizing needs pikepdf (conda install -c conda-forge pikepdf).')
+  urls = { title: url for title, url in mymodule.target_pages(need_url=True) }
+  HTMLDIR = mymodule.DIRS.html_src
+  PDFDIR = mymodule.DIRS.pdf_src
+  COMBINEDDIR = mymodule.DIRS.pdf_combined
+  state_path = HTMLDIR / 'sync_state.json'
+  state = mymodule.load_manifest(state_path)
+  manifest_path = mymodule.DIRS.html_reformed / 'manifest.json'
+  manifest = {} if force else mymodule.load_manifest(manifest_path)
+  settings = reform_html.settings_digest()
+  store = artifacts.ArtifactCache() if cache else None
+  # まだダウンロードしていないページと、問い用・答え用（見開き用）のHTMLがそろっていないページ
+  undownloaded = {page.title for page in mymodule.stage_status('download').pending}
+  unreformed = {page.title for page in mymodule.stage_status('reform_spread' if spread else 'reform').pending} | undownloaded
+
+  dead = retry.DeadLetters(HTMLDIR / notion2html.DEAD_LETTERS_NAME)
+  loader = notion2html.DOWNLOADERS[downloader](HTMLDIR, shared=shared)
+  pool = Pool(processes=reform_workers + (combine_workers if optimize or not spread else 0))
+  try:
+    # 更新されたページだけダウンロードする（forceでも、次の実行で比べられるように最終更新時刻は記録する）
+    last_edited = {}
+    if urls:
+      first_url = next(iter(urls.values()))
+      cookies = loader.session_cookies(first_url)
+      notion_http.require_login(cookies, first_url)
+      last_edited = notion2html.fetch_last_edited(list(urls.values()), cookies)
+    todo = notion2html.pages_to_export(list(urls.items()), state, last_edited, HTMLDIR, force=force, since=since)
+    todo = {title for title, url in notion2html.add_dead_letters(todo, list(urls.items()), dead)}
+    if downloader == 'http':
+      loader.prefetch([(title, url) for title, url in urls.items() if title in todo])
+
+    def download_worker():
+      def download(title: str) -> str:
+        if title in todo:
+          if not loader.download(url=urls[title], title=title):
+            dead.add(title, **loader.failures[title])
+            raise filewatch.DownloadError(f'Failed to download {title}.html: {loader.failures[title]["error"]}')
+          state[title] = notion2html.export_record(urls[title], last_edited.get(urls[title]), HTMLDIR / f'{title}.html')
+          dead.remove(title)
+        elif title in undownloaded:
+          raise FileNotFoundError(f'Missed the file "{title}.html"')
+        return title
+      return download
+
+    def reform_worker():
+      def reform(title: str) -> str:
+        nhfile = reform_html.html_file(title)
+        entry = reform_html.manifest_entry(nhfile, settings, spread)
+        # もとのHTMLも編集の設定も変わっていなければ飛ばす
+        if manifest.get(title) != entry or title in unreformed:
+          pool.apply(reform_html.reform, (nhfile,), {'spread': spread})
+          manifest[title] = entry
+        return title
+      return reform
+
+    def print_worker():
+      # 仮の保存先（プリンターごとに分ける）
+      tempdir = TempDirPath()
+      printer = None
+      def get_printer():
+        nonlocal printer
+        if printer is None:
+          printer = html2pdf.PRINTERS[backend](tempdir)
+        return printer
+      def print_pdf(title: str) -> str:
+        nonlocal printer
+        nhfile = reform_html.html_file(title)
+        try:
+          if spread:
+            html2pdf.print_cached(get_printer, tempdir, nhfile.exp_s, COMBINEDDIR, backend, spread=True, cache=store)
+          else:
+            for src in (nhfile.exp_q, nhfile.exp_a):
+              html2pdf.print_cached(get_printer, tempdir, src, PDFDIR, backend, cache=store)
+        except Exception:
+          # ブラウザーが落ちたかもしれないので、次のページではプリンターを作り直す
+          printer = None
+          tempdir.empty()
+          raise
+        return title
+      return print_pdf
+
+    def combine_worker():
+      def combine(title: str) -> str:
+        npfile, error = pool.apply(combine_pdfs.combine, ((combine_pdfs.pdf_file(title), mode, store),))
+        if error is not None:
+          raise RuntimeError(error)
+        return title
+      return combine
+
+    def optimize_worker():
+      def optimize(title: str) -> str:
+        result = pool.apply(optimize_pdfs.optimize, ((mymodule.make_page(title).combined, linearize, store),))
+        if result.error is not None:
+          raise RuntimeError(result.error)
+        bar.write(optimize_pdfs.describe(result))
+        return title
+      return optimize
+
+    stages = [
+      pipeline.Stage('download', download_worker),
+      pipeline.Stage('reform', reform_worker, workers=reform_workers),
+      pipeline.Stage('print', print_worker, workers=print_workers),
+    ]
+    if not spread:
+      stages.append(pipeline.Stage('combine', combine_worker, workers=combine_workers))
+    if optimize:
+      stages.append(pipeline.Stage('optimize', optimize_worker, workers=combine_workers))
+    bar = tqdm(total=len(urls))
+    bar.set_description('Making quiz PDF')
+    def failed(stage: str, title: str, error: str):
+      bar.write(f'[{stage}] {title}: {error}')
+      # logging.error(f'[{stage}] {title}: {error}')
+      bar.update(1)
+    result = pipeline.run(list(urls), stages, on_done=lambda title: bar.update(1), on_failed=failed)
+    bar.close()
+  finally:
+    pool.close()
+    pool.join()
+    mymodule.save_manifest(state_path, state)
+    mymodule.save_manifest(manifest_path, manifest)
+    dead.save()
+    notion2html.report_downloads(loader, dead)
+    del loader
+
+  if result.first_done_second is not None:
+    print(f'First PDF in {result.first_done_second:.1f} s, '
+          f'{len(result.done)}/{len(urls)} PDFs in {result.elapsed_second:.1f} s')
+  return result
+
+def main(serial: bool = False, reform_workers: int = 2, print_workers: int = 1, combine_workers: int = 2,
+         backend: str = 'devtools', mode: str = 'xobject', force: bool = False, since: datetime = None,
+         shared: bool = True, downloader: str = 'browser', spread: bool = False, cache: bool = True, book: bool = False,
+         optimize: bool = False, linearize: bool = False):
+  """Step 1 から 4 までを通して実行する（serial=Trueなら流れ作業にせず、ステップごとに全ページずつ）
+
+  sinceを指定すると、その時刻以降に更新されたページは必ずダウンロードし直す（notion2html.pages_to_exportを参照）。
+  spread=True なら、見開き用のHTMLを1回印刷して見開きのPDFをつくり、Step 4 は飛ばす。
+  cache=True なら、Step 3 と 4 は読むファイルが前と同じなら置き場から取り出す。
+  optimize=True なら、できた見開きを小さくする（linearize=True なら並べ直しも）。
+  book=True なら、最後に全ページの見開きを1冊にまとめる（combine_pdfs.bind_book）。
+
+  shared=False なら、ダウンロードには使い回すブラウザーではなく、ふだんのChromeのプロファイルで起動したものを使う。
+  """
+  if serial:
+    notion2html.main(force=force, since=since, shared=shared, downloader=downloader)
+    reform_html.main(force=force, spread=spread)
+    html2pdf.main(backend=backend, workers=print_workers, spread=spread, cache=cache)
+    if not spread:
+      combine_pdfs.main(mode=mode, cache=cache, optimize=optimize, linearize=linearize)
+    elif optimize:
+      optimize_pdfs.main(linearize=linearize, cache=cache)
+  else:
+    run_pipeline(reform_workers=reform_workers, print_workers=print_workers,
+                 combine_workers=combine_workers, backend=backend, mode=mode, force=force, since=since, shared=shared,
+                 downloader=downloader, spread=spread, cache=cache, optimize=optimize, linearize=linearize)
+  if book: combine_pdfs.print_book(*combine_pdfs.bind_book())
+  if not shared: notion2html.NotionHtmlDownloader.recover_chrome()
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Step 1 から 4 までを通して実行する')
+  parser.add_argument('--serial', action='store_true', help='流れ作業にせず、Step 1 から 4 を順に全ページずつ実行する')
+  parser.add_argument('--reform-workers', type=int, default=2, help='同時に編集するページの数')
+  parser.add_argument('--print-workers', type=int, default=1, help='同時に動かすプリンターの数')
+  parser.add_argument('--combine-workers', type=int, default=2, help='同時に見開きにするページの数')
+  parser.add_argument('--backend', choices=html2pdf.PRINTERS.keys(), default='devtools', help='使うプリンター')
+  parser.add_argument('--mode', choices=combine_pdfs.COMPOSERS.keys(), default='xobject', help='見開きのつくり方')
+  parser.add_argument('--force', action='store_true', help='更新されていないページもダウンロード・編集し直す')
+  parser.add_argument('--since', type=datetime.fromisoformat,
+                      help='この日時（例: 2023-04-01T09:00）以降に更新されたページは必ずダウンロードし直す')
+  parser.add_argument('--own-browser', action='store_true',
+                      help='使い回すブラウザーではなく、起動中のChromeを閉じてふだんのプロファイルで起動する')
+  parser.add_argument('--downloader', choices=notion2html.DOWNLOADERS.keys(), default='browser', help='使うダウンローダー')
+  parser.add_argument('--spread', action='store_true', help='見開き用のHTMLを1回印刷して見開きのPDFをつくる（Step 4 を飛ばす）')
+  parser.add_argument('--optimize', action='store_true', help='できた見開きを小さくする（同じフォントをまとめ、圧縮し直す）')
+  parser.add_argument('--linearize', action='store_true', help='小さくするときに、1ページ目からすぐ表示できるように並べ直す')
+  parser.add_argument('--book', action='store_true', help='最後に全ページの見開きを1冊（pdf/book.pdf）にまとめる')
+  parser.add_argument('--no-cache', action='store_true', help='読むファイルが前と同じでも置き場から取り出さずに印刷・見開きし直す')
+  args = parser.parse_args()
+
   # 実行の確認
   if not yes_no_input("I'll execute Step 1 to 4 all at once. Ready?"):
     exit()
-  
+
   # マルチプロセスのバグ回避
   freeze_support()
 
-  notion2html.main()
-  reform_html.main()
-  html2pdf.main()
-  combine_pdfs.main()
-  notion2html.NotionHtmlDownloader.recover_chrome()
+  runlog.start('do_all_at_once')
+
+  main(serial=args.serial, reform_workers=args.reform_workers, print_workers=args.print_workers,
+       combine_workers=args.combine_workers, backend=args.backend, mode=args.mode, force=args.force,
+       since=args.since, shared=not args.own_browser, downloader=args.downloader, spread=args.spread, cache=not args.no_cache,
+       book=args.book, optimize=args.optimize or args.linearize, linearize=args.linearize)
+  runlog.report()
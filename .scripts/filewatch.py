@@ -0,0 +1,124 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""ダウンロードの完了を待つための、フォルダの見張り
+
+Linuxではinotifyでフォルダ内の変化を待ち、それ以外では短い間隔で見にいく。
+"""
+
+import os
+import sys
+import time
+import select
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+class DownloadError(Exception):
+  """ダウンロードがうまくいかなかった"""
+
+class DownloadTimeoutError(DownloadError, TimeoutError):
+  """時間内にダウンロードが終わらなかった"""
+
+  def __init__(self, directory: Path, timeout_second: float):
+    super().__init__(f'Download into {directory} did not finish in {timeout_second} seconds.')
+    self.directory = directory
+    self.timeout_second = timeout_second
+
+class MultipleFilesError(DownloadError):
+  """ダウンロード先のフォルダにファイルが2個以上できた"""
+
+  def __init__(self, directory: Path, files: list):
+    super().__init__(f'{len(files)} files were found in {directory}: {", ".join(p.name for p in files)}')
+    self.directory = directory
+    self.files = files
+
+def is_in_progress(path: Path) -> bool:
+  """ダウンロード途中のファイルか"""
+  return path.suffix in ('.crdownload', '.tmp', '.part') or path.name.startswith('.com.google.Chrome')
+
+def finished_download(directory: Path):
+  """ダウンロードが終わっていればそのファイルのパスを、まだならNoneを返す
+
+  このフォルダにはダウンロードされるファイル1つしかできないことが前提。
+  ダウンロード途中のファイルがなくなったのにファイルが2個以上あれば、MultipleFilesErrorを発出する。
+  """
+  files = list(Path(directory).iterdir())
+  if any(is_in_progress(p) for p in files):
+    return None
+  if len(files) == 0:
+    return None
+  if len(files) > 1:
+    raise MultipleFilesError(Path(directory), files)
+  # Chromeは書き終わってから本来の名前に変えるので、名前が変わっていれば完了している
+  return files[0]
+
+class _InotifyWatcher():
+  """inotifyでフォルダ内の変化を待つ（Linux）"""
+
+  # ファイルの作成・書き込み終了・名前変更（移動）・削除
+  MASK = 0x00000100 | 0x00000008 | 0x00000080 | 0x00000200
+
+  def __init__(self, directory: Path):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.__fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.__fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    if libc.inotify_add_watch(self.__fd, os.fsencode(str(directory)), self.MASK) < 0:
+      os.close(self.__fd)
+      raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+  def wait(self, timeout_second: float) -> None:
+    """フォルダ内に変化があるか、timeout_second秒たつまで待つ"""
+    readable, _, _ = select.select([self.__fd], [], [], max(0., timeout_second))
+    if readable:
+      # たまったイベントは読み捨てる（中身はフォルダを見なおせばわかる）
+      try:
+        while os.read(self.__fd, 4096): pass
+      except BlockingIOError:
+        pass
+
+  def close(self) -> None:
+    os.close(self.__fd)
+
+class _PollingWatcher():
+  """短い間隔でフォルダを見にいく（inotifyが使えないとき）"""
+
+  def __init__(self, directory: Path, interval_second: float = 0.05):
+    self.interval_second = interval_second
+
+  def wait(self, timeout_second: float) -> None:
+    time.sleep(max(0., min(timeout_second, self.interval_second)))
+
+  def close(self) -> None:
+    pass
+
+def watch(directory: Path):
+  """フォルダの見張りを返す。Linuxならinotify、それ以外や使えなければ短い間隔の見回り"""
+  if sys.platform.startswith('linux'):
+    try:
+      return _InotifyWatcher(directory)
+    except (OSError, AttributeError):
+      pass
+  return _PollingWatcher(directory)
+
+def wait_for_download(directory: Path, timeout_second: float) -> Path:
+  """フォルダにダウンロードされたファイルが完成するまで待ち、そのパスを返す
+
+  timeout_second秒たっても終わらなければDownloadTimeoutErrorを、
+  ファイルが2個以上できたらMultipleFilesErrorを発出する。
+  """
+  deadline = time.monotonic() + timeout_second
+  watcher = watch(directory)
+  try:
+    # 見張りを始めてからフォルダを見るので、そのあいだの変化も取りこぼさない
+    while True:
+      path = finished_download(directory)
+      if path is not None:
+        return path
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise DownloadTimeoutError(Path(directory), timeout_second)
+      watcher.wait(remaining)
+  finally:
+    watcher.close()
@@ -4,35 +4,96 @@
 # from mylib import logging
 from mylib.io import yes_no_input
 from mylib.path import TempDirPath
-# !conda install -c conda-forge selenium
-from selenium import webdriver
-# !conda install -c conda-forge python-chromedriver-binary==バージョン番号
-# https://pypi.org/project/chromedriver-binary/#history
-import chromedriver_binary   # chromedriver-binaryを使う
 import time
 import mymodule
+import runlog
+import browser
+import artifacts
 # !conda install -c anaconda tqdm
 from tqdm import tqdm
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 import json
-from tqdm import tqdm
+import base64
 import warnings
-warnings.simplefilter('ignore')
+import argparse
+import threading
+import queue
+import shutil
+from collections import namedtuple
+
+# 印刷の体裁（どのプリンターでも共通）
+PAGE_SIZE = 'A4'
+PRINT_SCALE = 112   # 倍率（%）
+
+# 編集したHTMLが読むスタイルシート（reform_htmlのSTYLESHEET_HREFの指す先）
+STYLESHEET_PATH = mymodule.DIRS.html_reformed / 'css/styles.css'
+
+# 見開き1枚で印刷するときの体裁（用紙と余白はpt、gap_mmは倍率をかける前の列と列のあいだ）
+Spread = namedtuple('Spread', 'width_pt height_pt margin_top_pt margin_side_pt scale gap_mm')
+
+def spread_geometry() -> Spread:
+  """問いと答えを左右に並べて1枚で印刷するときの体裁を返す
+
+  combine_pdfsでつくる見開き（A4縦の2ページを上下JOGE_YOHAKU・左右SAYU_YOHAKU（真ん中はその2倍）の
+  余白をとって並べ、A4横の幅に縮めたもの）と同じになるようにする。
+  もとのページの余白（MARGIN_MM）と倍率（PRINT_SCALE）も同じだけ縮めるので、1列の幅は縦1ページと変わらない。
+  """
+  from combine_pdfs import A4YOKO_WITDH, JOGE_YOHAKU, SAYU_YOHAKU
+  pt_per_mm = 72 / 25.4
+  width = WeasyPrinter.PAGE_WIDTH_MM * pt_per_mm
+  height = WeasyPrinter.PAGE_HEIGHT_MM * pt_per_mm
+  margin = WeasyPrinter.MARGIN_MM * pt_per_mm
+  # 並べたものをA4横の幅にするための縮小率
+  shrink = A4YOKO_WITDH / (width*2 + SAYU_YOHAKU*4)
+  return Spread(
+    width_pt=A4YOKO_WITDH,
+    height_pt=(height + JOGE_YOHAKU*2) * shrink,
+    margin_top_pt=(JOGE_YOHAKU + margin) * shrink,
+    margin_side_pt=(SAYU_YOHAKU + margin) * shrink,
+    scale=PRINT_SCALE / 100 * shrink,
+    gap_mm=(SAYU_YOHAKU*2 + margin*2) / (PRINT_SCALE / 100) / pt_per_mm,
+  )
+
+def has_pdf_trailer(path) -> bool:
+  """PDFの末尾（%%EOF）まで書かれているか"""
+  with open(path, 'rb') as f:
+    f.seek(0, 2)
+    f.seek(max(0, f.tell() - 1024))
+    return b'%%EOF' in f.read()
+
+def wait_until_pdf_complete(path, timeout_second: float, interval_second: float = 0.05) -> None:
+  """PDFが書き終わるまで待つ
+  
+  ファイルが現れ、大きさが変わらなくなり、末尾が%%EOFになっていれば書き終わったとみなす。
+  timeout_second秒たっても書き終わらなければTimeoutErrorを発出する。
+  """
+  started = time.perf_counter()
+  last_size = -1
+  while time.perf_counter() - started < timeout_second:
+    try:
+      size = path.stat().st_size
+    except FileNotFoundError:
+      size = -1
+    if size > 0 and size == last_size and has_pdf_trailer(path):
+      return
+    last_size = size
+    time.sleep(interval_second)
+  raise TimeoutError(f'{path.name} was not printed in {timeout_second} seconds.')
 
 class Printer():
   from pathlib import Path as __Path
   from typing import Any
 
-  def __init__(self, destination_dir: __Path):
+  def __init__(self, destination_dir: __Path, timeout_second: float = 30.):
     """初期化
     
     ブラウザーを開いたり。
     distination_dirには保存先のディレクトリパスを指定。
+    timeout_secondは1ファイルの印刷を待つ最大の秒数。
     なお、Chromeがすでに起動していても問題ない。
     """
 
     self.dest_dir = destination_dir
+    self.timeout_second = timeout_second
     self.__browser = self.__get_browser()
 
   def __get_browser(self) -> Any:
@@ -42,6 +103,13 @@ class Printer():
     なお、ヘッドレスモードじゃ無理！！！
     """
 
+    # Seleniumは（WeasyPrintで印刷するときには要らないので）ここで読み込む
+    # !conda install -c conda-forge selenium
+    from selenium import webdriver
+    # !conda install -c conda-forge python-chromedriver-binary==バージョン番号
+    # https://pypi.org/project/chromedriver-binary/#history
+    import chromedriver_binary   # chromedriver-binaryを使う
+
     # オプション設定
     options = webdriver.chrome.options.Options()
     # 不要な警告を非表示に
@@ -59,9 +127,9 @@ class Printer():
       ],
       "selectedDestinationId": "Save as PDF",
       "version": 2,
-      "pageSize": 'A4',
+      "pageSize": PAGE_SIZE,
       "scalingType": 3, #倍率 0：デフォルト 1：ページに合わせる 2：用紙に合わせる 3：カスタム
-      "scaling": "112", # 倍率カスタムの場合の数値
+      "scaling": str(PRINT_SCALE), # 倍率カスタムの場合の数値
       "isHeaderFooterEnabled": False,
       "marginsType": 2,  #余白タイプ #0:デフォルト 1:余白なし 2:最小
     }
@@ -71,18 +139,22 @@ class Printer():
     })
     options.add_argument('--kiosk-printing')
 
-    # ドライバ起動
-    return webdriver.Chrome(options=options)
+    # ドライバ起動（Seleniumの非推奨の警告はここだけ出さない）
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', DeprecationWarning)
+      return webdriver.Chrome(options=options)
 
   def print(self, html_path: __Path):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
     self.__browser.implicitly_wait(10)
     self.__browser.get(html_path.as_posix())
     # ページ上のすべての要素が読み込まれるまで待機
     WebDriverWait(self.__browser, 5).until(EC.presence_of_all_elements_located)
     # PDFとして印刷
     self.__browser.execute_script('window.print();')
-    # 待機
-    time.sleep(3)   # 2秒だとけっこうギリギリ
+    # 書き出されるまで待機（ファイル名はタイトル、すなわちHTMLのファイル名になる）
+    wait_until_pdf_complete(self.dest_dir / f'{html_path.stem}.pdf', self.timeout_second)
     # logging.info(f'Downloaded {html_path.name}')
 
   def __del__(self):
@@ -92,41 +164,294 @@ class Printer():
     self.__browser.quit()   # すべてのタブを閉じてブラウザを終了。（ないとダメだ！）
     # logging.info('Closed browser')
 
-def main():
-  # 対象のHTMLファイルのパスのリスト
-  HTMLDIR  = mymodule.APPDIR / 'html/reformed/'
+class WeasyPrinter():
+  """ブラウザーを使わないプリンター
+  
+  WeasyPrintでHTMLをその場でPDFにする。ヘッドレスのLinuxでも動く。
+  Printerと同じ体裁（A4、倍率112%、余白最小）になるようにしてある。
+  """
+  from pathlib import Path as __Path
+
+  # Chromeの余白「最小」に相当する余白（mm）
+  MARGIN_MM = 4.2
+  # A4の大きさ（mm）
+  PAGE_WIDTH_MM, PAGE_HEIGHT_MM = 210, 297
+
+  def __init__(self, destination_dir: __Path):
+    """初期化
+    
+    distination_dirには保存先のディレクトリパスを指定。
+    """
+    # !conda install -c conda-forge weasyprint
+    import weasyprint
+    from weasyprint.text.fonts import FontConfiguration
+
+    self.dest_dir = destination_dir
+    self.__weasyprint = weasyprint
+    # フォントの読み込みはファイル間で使い回す
+    self.__font_config = FontConfiguration()
+    # 倍率はwrite_pdfのzoomでかけるので、レイアウトはその分だけ小さい用紙で行う
+    scale = PRINT_SCALE / 100
+    self.__page_css = weasyprint.CSS(string=(
+      f'@page {{ size: {self.PAGE_WIDTH_MM/scale:.3f}mm {self.PAGE_HEIGHT_MM/scale:.3f}mm; '
+      f'margin: {self.MARGIN_MM/scale:.3f}mm; }}'
+    ), font_config=self.__font_config)
+
+  def print(self, html_path: __Path) -> int:
+    """PDFとして保存し、ページ数を返す
+    
+    ファイル名はChromeと同じくHTMLのファイル名（=タイトル）にする。
+    """
+    document = self.__weasyprint.HTML(filename=html_path.as_posix()).render(
+      stylesheets=[self.__page_css], font_config=self.__font_config)
+    document.write_pdf(self.dest_dir / f'{html_path.stem}.pdf', zoom=PRINT_SCALE/100)
+    # logging.info(f'Printed {html_path.name}')
+    return len(document.pages)
+
+class DevToolsPrinter():
+  """使い回すブラウザー（browser.py）で印刷するプリンター
+
+  自分のタブを開き、DevToolsプロトコルの Page.printToPDF で受け取ったPDFをそのまま書き出す。
+  印刷ダイアログもダウンロード先の設定も使わないので、ヘッドレスのLinuxでも動き、
+  プリンターをいくつ作っても（タブが増えるだけで）ブラウザーは1つで済む。
+  Printerと同じ体裁（A4、倍率112%、余白最小）になるようにしてある。
+  print_spreadなら、見開き用のHTMLを見開きのPDF（spread_geometryの体裁）として印刷する。
+  """
+  from pathlib import Path as __Path
+
+  def __init__(self, destination_dir: __Path):
+    """初期化
+    
+    distination_dirには保存先のディレクトリパスを指定。
+    """
+    self.dest_dir = destination_dir
+    # 印刷にはNotionのログインは要らない
+    self.__driver = browser.connect(login=False)
+    self.__tab = browser.open_tab(self.__driver)
+    self.__options = {
+      'paperWidth': WeasyPrinter.PAGE_WIDTH_MM / 25.4,   # インチ
+      'paperHeight': WeasyPrinter.PAGE_HEIGHT_MM / 25.4,
+      'marginTop': WeasyPrinter.MARGIN_MM / 25.4,
+      'marginBottom': WeasyPrinter.MARGIN_MM / 25.4,
+      'marginLeft': WeasyPrinter.MARGIN_MM / 25.4,
+      'marginRight': WeasyPrinter.MARGIN_MM / 25.4,
+      'scale': PRINT_SCALE / 100,
+      'displayHeaderFooter': False,
+      'printBackground': False,
+    }
+    self.__spread_options = None
+
+  def print(self, html_path: __Path) -> None:
+    """PDFとして保存する（ファイル名はChromeと同じくHTMLのファイル名）"""
+    self.__print(html_path, self.__options)
+
+  def print_spread(self, html_path: __Path) -> None:
+    """見開き用のHTMLを、見開きのPDFとして保存する（ファイル名はHTMLのファイル名）"""
+    if self.__spread_options is None:
+      spread = spread_geometry()
+      self.__spread_options = dict(self.__options,
+        paperWidth=spread.width_pt / 72, paperHeight=spread.height_pt / 72,
+        marginTop=spread.margin_top_pt / 72, marginBottom=spread.margin_top_pt / 72,
+        marginLeft=spread.margin_side_pt / 72, marginRight=spread.margin_side_pt / 72,
+        scale=spread.scale)
+    self.__print(html_path, self.__spread_options)
+
+  def __print(self, html_path: __Path, options: dict) -> None:
+    self.__driver.switch_to.window(self.__tab)
+    self.__driver.get(html_path.resolve().as_uri())
+    result = self.__driver.execute_cdp_cmd('Page.printToPDF', options)
+    (self.dest_dir / f'{html_path.stem}.pdf').write_bytes(base64.b64decode(result['data']))
+    # logging.info(f'Printed {html_path.name}')
+
+  def __del__(self):
+    """自分のタブを閉じて切り離す（ブラウザーは閉じない）"""
+    browser.close_tab(self.__driver, self.__tab)
+    self.__driver.quit()
+
+PRINTERS = {
+  'devtools': DevToolsPrinter,
+  'chrome': Printer,
+  'weasyprint': WeasyPrinter,
+}
+
+def count_pages(pdf_path) -> int:
+  """PDFのページ数を返す"""
+  # !conda install -c conda-forge pypdf2
+  import PyPDF2
+  return PyPDF2.PdfFileReader(pdf_path.as_posix(), strict=False).getNumPages()
+
+def can_print_spread(backend: str) -> bool:
+  """そのプリンターで見開き用のHTMLを印刷できるか"""
+  return hasattr(PRINTERS[backend], 'print_spread')
+
+def output_pdf(src, dest_dir, spread: bool = False):
+  """srcを印刷したPDFの保存先（spread=True なら末尾のPOSTFIXES.sを除いた、見開きのPDFの名前）"""
+  name = src.stem[:-len(mymodule.POSTFIXES.s)] if spread else src.stem
+  return dest_dir / f'{name}.pdf'
+
+def print_key(cache: artifacts.ArtifactCache, src, backend: str, spread: bool = False) -> str:
+  """印刷したPDFを置き場から引くキー（HTMLとスタイルシートの中身、プリンター、印刷の体裁から決まる）"""
+  settings = {
+    'backend': backend, 'page_size': PAGE_SIZE, 'scale': PRINT_SCALE, 'margin_mm': WeasyPrinter.MARGIN_MM,
+    'spread': spread_geometry()._asdict() if spread else None,
+  }
+  files = [src] + ([STYLESHEET_PATH] if STYLESHEET_PATH.exists() else [])
+  return cache.key('print', files, settings, scripts=[__file__])
+
+def print_one(printer, tempdir, src, dest_dir, spread: bool = False) -> int:
+  """printerでsrcをtempdirに印刷し、dest_dirへ移してページ数を返す
+
+  spread=True なら見開き用のHTMLとして印刷し、見開きのPDFの名前（末尾のPOSTFIXES.sを除いたもの）で保存する。
+  """
+  with runlog.timed('print', 'spread' if spread else 'print', page=src.stem):
+    pages = printer.print_spread(src) if spread else printer.print(src)
+  # 本当の保存先へ移動（すでにファイルが存在していても上書きする）
+  pdf = output_pdf(src, dest_dir, spread)
+  if pdf.exists(): pdf.unlink()
+  shutil.move((tempdir / f'{src.stem}.pdf').as_posix(), pdf.as_posix())
+  # ページ数を返さないプリンター（Chrome）なら、できたPDFから数える
+  if pages is None: pages = count_pages(pdf)
+  return pages
+
+def print_cached(get_printer, tempdir, src, dest_dir, backend: str, spread: bool = False,
+                 cache: artifacts.ArtifactCache = None) -> int:
+  """前に同じものを印刷していれば置き場から取り出し、なければprint_oneで印刷して置き場にしまう。ページ数を返す
+
+  get_printerはプリンターを返す関数で、印刷するときにだけ呼ぶ（すべて置き場にあればブラウザーにつながない）。
+  cacheがNoneなら、いつも印刷する。
+  """
+  if cache is None:
+    return print_one(get_printer(), tempdir, src, dest_dir, spread=spread)
+  pdf = output_pdf(src, dest_dir, spread)
+  key = print_key(cache, src, backend, spread)
+  record = cache.fetch(key, pdf)
+  if record is not None:
+    return record['pages']
+  pages = print_one(get_printer(), tempdir, src, dest_dir, spread=spread)
+  cache.store(key, pdf, pages=pages)
+  return pages
+
+def print_all(srcs: list, dest_dir, backend: str = 'devtools', workers: int = 1, max_attempts: int = 3,
+              spread: bool = False, cache: artifacts.ArtifactCache = None):
+  """HTMLファイルをworkers個のプリンターで手分けしてPDFにし、dest_dirに保存する
+  
+  spread=True なら見開き用のHTMLとして印刷する（print_oneを参照）。
+  cacheを渡すと、前に同じものを印刷していれば印刷せずに置き場から取り出す（print_cachedを参照）。
+  プリンターはそれぞれ自分専用の一時フォルダに印刷し、終わったファイルはすぐにdest_dirへ移す。
+  ファイル名はHTMLのファイル名（=タイトル）なので、手分けしても重ならない。
+  印刷に失敗した（ブラウザーが落ちたなど）ら、プリンターを作り直し、そのファイルは後回しにする。
+  max_attempts回失敗したファイルはあきらめる。
+  (ページ数, 1ファイルあたりの秒数のリスト, あきらめたファイルのリスト) を返す。
+  """
+  jobs = queue.Queue()
+  for src in srcs:
+    jobs.put((src, 1))
+  lock = threading.Lock()
+  page_counts = []
+  latencies = []
+  failures = []
+  bar = tqdm(total=len(srcs))
+  bar.set_description('Printing PDF')
+
+  def work():
+    # 仮の保存先（新しいフォルダに保存しないと名前が変えられてしまうので）
+    tempdir = TempDirPath()
+    printer = None
+    def get_printer():
+      nonlocal printer
+      if printer is None:
+        printer = PRINTERS[backend](tempdir)
+      return printer
+    try:
+      while True:
+        try:
+          src, attempt = jobs.get_nowait()
+        except queue.Empty:
+          return
+        try:
+          started = time.perf_counter()
+          pages = print_cached(get_printer, tempdir, src, dest_dir, backend, spread=spread, cache=cache)
+          latency = time.perf_counter() - started
+          with lock:
+            page_counts.append(pages)
+            latencies.append(latency)
+            bar.update(1)
+        except Exception:
+          # ブラウザーが落ちたかもしれないので、プリンターは作り直す
+          printer = None
+          tempdir.empty()
+          runlog.record('print', 'retry', page=src.stem, attempt=attempt+1, ok=attempt < max_attempts)
+          if attempt < max_attempts:
+            # logging.warning(f'Failed to print {src.name} (attempt {attempt}), retrying later')
+            jobs.put((src, attempt+1))
+          else:
+            # logging.error(f'Gave up printing {src.name}')
+            with lock:
+              failures.append(src)
+              bar.update(1)
+    finally:
+      del printer
+      del tempdir
+
+  threads = [threading.Thread(target=work) for _ in range(max(1, min(workers, len(srcs))))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  bar.close()
+  return sum(page_counts), latencies, failures
+
+def main(backend: str = 'devtools', workers: int = 1, spread: bool = False, cache: bool = True):
+  """HTMLをPDFにする
+  
+  backendには使うプリンター（PRINTERSのキー）を、workersには同時に動かすプリンターの数を指定。
+  既定のdevtoolsでは、どのプリンターも使い回すブラウザー（browser.py）1つにタブを開いて印刷するので、
+  workersを増やすとタブが増える（レンダラーは分かれるが、ブラウザーは1つ）。
+  chromeではプリンターごとにブラウザーを起動するので、workersを増やしたぶんだけブラウザーのプロセスが増える。
+  spread=True なら、見開き用のHTML（reform_htmlでspread=Trueにしてつくったもの）を1ページ1回ずつ印刷し、
+  見開きのPDFを直接 pdf/combined/ につくる（combine_pdfsは要らない）。devtoolsのプリンターでだけできる。
+  cache=True なら、HTMLもスタイルシートも体裁も前と同じものは印刷せずに置き場（artifacts.py）から取り出す。
+  """
+  if spread and not can_print_spread(backend):
+    raise ValueError(f'The {backend} printer cannot print spreads; use devtools.')
+  # 対象のHTMLファイルのパスのリスト（もととなるHTMLファイルが存在しないページは飛ばす）
   srcs = []
-  for title in mymodule.target_pages():
-    src_q = HTMLDIR / f'{title}{mymodule.POSTFIXES.q}.html'
-    src_a = HTMLDIR / f'{title}{mymodule.POSTFIXES.a}.html'
-    # もととなるHTMLファイルが実際に存在していなければ、ログに書いたうえでスキップ
-    if not all([src_q.exists(), src_a.exists()]):
-      # logging.info(f'Missed the file "{src_q.name}" or "{src_a.name}"')
-      continue
-    srcs.append(src_q)
-    srcs.append(src_a)
-
-  # 仮の保存先（新しいフォルダに保存しないと名前が変えられてしまうので）
-  tempdir = TempDirPath()
+  if spread:
+    srcs = [page.html_s for page in mymodule.stage_status('print_spread').ready]
+  else:
+    for page in mymodule.stage_status('print').ready:
+      srcs.append(page.html_q)
+      srcs.append(page.html_a)
+
   # 本当の保存先
-  PDFDIR = mymodule.APPDIR / 'pdf/src/'
+  PDFDIR = mymodule.DIRS.pdf_combined if spread else mymodule.DIRS.pdf_src
 
-  printer = Printer(tempdir)
-  bar = tqdm(srcs)
-  bar.set_description('Printing PDF')
-  # HTMLファイルを順々に処理
-  try:
-    for src in bar:
-      printer.print(src)
-    # 一時フォルダ内のファイルをすべてPDFDIRに移動。
-    tempdir.move_contents(PDFDIR)   # すでにファイルが存在していても上書きする。
-  finally:
-    del tempdir
-    del printer
+  started = time.perf_counter()
+  num_pages, latencies, failures = print_all(srcs, PDFDIR, backend=backend, workers=workers, spread=spread,
+                                             cache=artifacts.ArtifactCache() if cache else None)
+  elapsed = time.perf_counter() - started
+  print(f'Printed {num_pages} pages in {elapsed:.1f} s ({num_pages/elapsed if elapsed else 0:.2f} pages/s)')
+  if latencies:
+    latencies.sort()
+    p50 = latencies[len(latencies)//2]
+    p95 = latencies[min(len(latencies)-1, int(len(latencies)*0.95))]
+    print(f'Latency per file: p50 {p50:.2f} s, p95 {p95:.2f} s, max {latencies[-1]:.2f} s')
+  for src in failures:
+    print(f'Failed to print {src.name}')
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='HTMLをPDFにする')
+  parser.add_argument('--backend', choices=PRINTERS.keys(), default='devtools',
+                      help='使うプリンター（devtoolsなら使い回すブラウザー、weasyprintならブラウザーを使わない）')
+  parser.add_argument('--workers', type=int, default=1, help='同時に動かすプリンターの数')
+  parser.add_argument('--spread', action='store_true', help='見開き用のHTMLを印刷して、見開きのPDFを直接つくる')
+  parser.add_argument('--no-cache', action='store_true', help='前と同じHTMLでも置き場から取り出さずに印刷し直す')
+  args = parser.parse_args()
+
   # 実行の確認
   if not yes_no_input("I'll convert HTML into PDF. Ready?"):
     exit()
   
-  main()
+  runlog.start('html2pdf')
+  main(backend=args.backend, workers=args.workers, spread=args.spread, cache=not args.no_cache)
+  runlog.report()
@@ -8,11 +8,14 @@ from typing import Union as __Union
 from typing import Tuple as __Tuple
 import ast as __ast
 from mylib.csv import load_csv_data as __load_csv_data
+import hashlib as __hashlib
+import json as __json
+import os as __os
 
 HOMEDIR = __Path.home()
 APPDIR = __Path(__file__).parent.parent
 
-POSTFIXES = __namedtuple('__PostFixes', 'q a')('_q', '_a')
+POSTFIXES = __namedtuple('__PostFixes', 'q a s')('_q', '_a', '_s')
 
 def __modify_title(title: str):
   """不適切なタイトル（ページネーム）を修正する"""
@@ -24,6 +27,59 @@ def __modify_title(title: str):
   title = re.sub(r'  +', ' ', title)
   return title
 
+# ページごとのファイルを置くディレクトリ
+DIRS = __namedtuple('__Dirs', 'html_src html_reformed pdf_src pdf_combined')(
+  APPDIR / 'html/src', APPDIR / 'html/reformed', APPDIR / 'pdf/src', APPDIR / 'pdf/combined')
+
+# setting.csvの1行ぶんのページと、そのページのファイルのパス
+# （src: ダウンロードしたHTML、html_q/html_a: 問い用・答え用のHTML、pdf_q/pdf_a: 問い用・答え用のPDF、combined: 見開きのPDF、
+#   html_s: 問いと答えを左右に並べた見開き用のHTML）
+Page = __namedtuple('Page', 'title url enabled src html_q html_a pdf_q pdf_a combined html_s')
+
+# 各段が読むファイルとつくるファイル（Pageの属性名）
+STAGE_FILES = {
+  'download': ((), ('src',)),
+  'reform': (('src',), ('html_q', 'html_a')),
+  'print': (('html_q', 'html_a'), ('pdf_q', 'pdf_a')),
+  'combine': (('pdf_q', 'pdf_a'), ('combined',)),
+  # 見開き用のHTMLを1回印刷して、見開きのPDFを直接つくるとき
+  'reform_spread': (('src',), ('html_s',)),
+  'print_spread': (('html_s',), ('combined',)),
+  # 見開きのPDFを小さくして置き換える（つくるファイルは読むファイルそのもの）
+  'optimize': (('combined',), ('combined',)),
+}
+
+# 読み込んだsetting.csvの (更新時刻, 大きさ, Pageのタプル)
+__index_cache = (None, None, ())
+
+def make_page(title: str, url: str = None, enabled: bool = True) -> Page:
+  """タイトルからページのファイルのパスを決めてPageにする（titleは修正済みのもの）"""
+  return Page(title, url, enabled,
+              DIRS.html_src / f'{title}.html',
+              DIRS.html_reformed / f'{title}{POSTFIXES.q}.html',
+              DIRS.html_reformed / f'{title}{POSTFIXES.a}.html',
+              DIRS.pdf_src / f'{title}{POSTFIXES.q}.pdf',
+              DIRS.pdf_src / f'{title}{POSTFIXES.a}.pdf',
+              DIRS.pdf_combined / f'{title}.pdf',
+              DIRS.html_reformed / f'{title}{POSTFIXES.s}.html')
+
+def page_index() -> __Tuple[Page]:
+  """setting.csvの全ページ（対象外のものも含む）のPageのタプルを返す
+
+  読み込んだ結果は覚えておき、setting.csvの更新時刻か大きさが変わったときだけ読み直す。
+  """
+  global __index_cache
+  path = APPDIR / 'setting.csv'
+  stat = path.stat()
+  mtime, size, pages = __index_cache
+  if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+    pages = tuple(
+      make_page(__modify_title(row[0]), row[1], bool(__ast.literal_eval(row[2])))   # 文字列がTrueに評価できれば対象
+      for row in __load_csv_data(path)
+    )
+    __index_cache = (stat.st_mtime_ns, stat.st_size, pages)
+  return pages
+
 def target_pages(need_url=False) -> __Union[str, __Tuple[str]]:
   """対象のページのタイトル（必要に応じてURLも）のリストを返す
   
@@ -32,8 +88,94 @@ def target_pages(need_url=False) -> __Union[str, __Tuple[str]]:
   """
 
   l = [
-    ((__modify_title(row[0]), row[1]) if need_url else __modify_title(row[0]))
-    for row in __load_csv_data(APPDIR / 'setting.csv')
-    if __ast.literal_eval(row[2])   # 文字列がTrueに評価できれば
+    ((page.title, page.url) if need_url else page.title)
+    for page in page_index()
+    if page.enabled
   ]
   return l
+
+def file_names(directory: __Path) -> set:
+  """ディレクトリにあるファイルの名前の集合を返す（1回読むだけ）。ディレクトリがなければ空"""
+  try:
+    with __os.scandir(directory) as entries:
+      return {entry.name for entry in entries}
+  except FileNotFoundError:
+    return set()
+
+StageStatus = __namedtuple('StageStatus', 'ready pending')
+
+def stage_status(stage: str) -> StageStatus:
+  """段（STAGE_FILESのキー）ごとに、対象のページのうち取りかかれるものと、まだ済んでいないものを返す
+
+  ready は読むファイルがすべてそろっているページ、pending はそのうちつくるファイルがそろっていないページ。
+  ファイルがあるかどうかは、ページごとに調べずに、関係するディレクトリを1回ずつ読んで判断する。
+  """
+  inputs, outputs = STAGE_FILES[stage]
+  pages = [page for page in page_index() if page.enabled]
+  if not pages: return StageStatus([], [])
+  # 同じ属性のファイルはどのページでも同じディレクトリにある
+  scanned = {}
+  names = {}
+  for attr in inputs + outputs:
+    directory = getattr(pages[0], attr).parent
+    if directory not in scanned:
+      scanned[directory] = file_names(directory)
+    names[attr] = scanned[directory]
+  ready = [page for page in pages if all(getattr(page, attr).name in names[attr] for attr in inputs)]
+  pending = [page for page in ready if not all(getattr(page, attr).name in names[attr] for attr in outputs)]
+  return StageStatus(ready, pending)
+
+def file_digest(path: __Path) -> str:
+  """ファイルの中身のハッシュ（SHA-256）を返す"""
+  h = __hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def load_manifest(path: __Path) -> dict:
+  """前回の実行内容を記録したJSONを読み込む。なければ空のdictを返す"""
+  try:
+    with open(path, encoding='utf-8') as f:
+      return __json.load(f)
+  except (FileNotFoundError, ValueError):
+    return {}
+
+def save_manifest(path: __Path, manifest: dict) -> None:
+  """前回の実行内容を記録したJSONを書き出す
+  
+  途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える。
+  """
+  temp = path.with_name(f'{path.name}.tmp')
+  with open(temp, 'w', encoding='utf-8') as f:
+    __json.dump(manifest, f, ensure_ascii=False, indent=2)
+  __os.replace(temp, path)
+
+def available_memory() -> int:
+  """いま使えるメモリのバイト数を返す。わからなければNoneを返す"""
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  try:
+    return __os.sysconf('SC_AVPHYS_PAGES') * __os.sysconf('SC_PAGE_SIZE')
+  except (ValueError, OSError, AttributeError):
+    return None
+
+def pool_size(n_jobs: int, memory_per_process: int) -> int:
+  """プロセスプールの大きさを、使えるコア数とメモリから決める
+
+  memory_per_processは1プロセスが使うと見込むメモリのバイト数。ジョブの数より大きくはしない。
+  """
+  try:
+    cores = len(__os.sched_getaffinity(0))
+  except AttributeError:
+    cores = __os.cpu_count() or 1
+  size = min(cores, n_jobs)
+  memory = available_memory()
+  if memory is not None and memory_per_process > 0:
+    size = min(size, memory // memory_per_process)
+  return max(1, size)
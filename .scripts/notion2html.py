@@ -7,24 +7,126 @@ from mylib.path import TempDirPath
 import mylib.subproc
 import mylib.csv
 import mymodule
-# !conda install -c conda-forge selenium
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-# !conda install -c conda-forge python-chromedriver-binary==バージョン番号
-# https://pypi.org/project/chromedriver-binary/#history
-import chromedriver_binary
+import filewatch
+import runlog
+import browser
+import retry
+import notion_http
+from notion_http import extract_html, page_id
 # !conda install -c anaconda tqdm
 from tqdm import tqdm
 import time
-from datetime import datetime, timedelta
-import shutil
+from pathlib import Path
 import io
 from collections import namedtuple
+import argparse
+import json
+import urllib.request
+from urllib.parse import urlparse
+from datetime import datetime, timezone
 
 Selector = namedtuple('Selector', 'name description content')
 
+# エクスポートするときに順々に押してゆくボタンなどのセレクタのリスト
+SELECTORS = [
+  Selector('button1', '右上のメニューボタン', "#notion-app > div > div:nth-child(1) > div > div:nth-child(2) > div:nth-child(1) > div.notion-topbar > div > div.notion-topbar-action-buttons > div:nth-child(2) > div.notion-topbar-more-button"),
+  Selector('button2', 'ボタン「エクスポート」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div:nth-child(2) > div > div > div > div > div > div:nth-child(1) > div:nth-child(7) > div:nth-child(2)"),
+  Selector('select1', 'ドロップダウンリスト「エクスポート形式」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(1) > div:nth-child(2)"),
+  Selector('option1', '項目「HTML」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(3) > div > div:nth-child(2) > div:nth-child(2) > div > div > div > div > div > div > div > div:nth-child(2)"),
+  Selector('select2', 'ドロップダウンリスト「対象コンテンツ」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(2) > div:nth-child(2)"),
+  Selector('option2', '項目「ファイルや画像以外」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(3) > div > div:nth-child(2) > div:nth-child(2) > div > div > div > div > div > div > div > div:nth-child(2)"),
+  Selector('toggle1', 'トグルボタン「サブページのフォルダーを作成」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(4) > div:nth-child(2) > input[type=checkbox]"),
+  Selector('toggle2', 'トグルボタン「サブページを含める」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(3) > div.pseudoHover.pseudoActive > input[type=checkbox]"),
+  Selector('submit', 'サブミットボタン「エクスポート」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(5) > div:nth-child(2)")
+  ]
+
+# ページの最終更新時刻を問い合わせるNotionのAPI
+RECORD_API_PATH = '/api/v3/syncRecordValues'
+
+def fetch_last_edited(urls: list, cookies: dict = None) -> dict:
+  """各ページの最終更新時刻（エポックからのミリ秒）を {url: 時刻} で返す
+
+  サイトごとにまとめてNotionのAPIに問い合わせる。わからなかったページはNoneになる。
+  cookiesにはログイン済みのブラウザーのクッキー（session_cookies）を渡す。
+  """
+  cookies = cookies or {}
+  last_edited = {url: None for url in urls}
+  by_origin = {}
+  for url in urls:
+    if page_id(url) is not None:
+      by_origin.setdefault('{0.scheme}://{0.netloc}'.format(urlparse(url)), []).append(url)
+  for origin, origin_urls in by_origin.items():
+    body = {'requests': [{'pointer': {'table': 'block', 'id': page_id(url)}, 'version': -1} for url in origin_urls]}
+    request = urllib.request.Request(f'{origin}{RECORD_API_PATH}', data=json.dumps(body).encode('utf-8'), headers={
+      'Content-Type': 'application/json',
+      'Cookie': '; '.join(f'{name}={value}' for name, value in cookies.items()),
+    })
+    try:
+      with urllib.request.urlopen(request, timeout=30) as response:
+        blocks = json.load(response).get('recordMap', {}).get('block', {})
+    except (OSError, ValueError):
+      # logging.warning(f'Could not fetch last edited times from {origin}')
+      continue
+    for url in origin_urls:
+      value = blocks.get(page_id(url), {}).get('value', {})
+      # 新しいAPIでは value がもう一段入れ子になっている
+      value = value.get('value', value)
+      last_edited[url] = value.get('last_edited_time')
+  return last_edited
+
+def pages_to_export(pages: list, state: dict, last_edited: dict, dest_dir: Path,
+                    force: bool = False, since: datetime = None) -> list:
+  """エクスポートし直す必要のあるページ (title, url) のリストを返す
+
+  前回エクスポートしたときから最終更新時刻が変わっておらず、
+  保存したHTMLにも手が加わっていなければ飛ばす。
+  force=True ならすべて、sinceを指定すればその時刻以降に更新されたページも必ずエクスポートし直す。
+  """
+  # すでにあるHTMLはディレクトリを1回読んで調べる
+  present = mymodule.file_names(dest_dir)
+  todo = []
+  for title, url in pages:
+    entry = state.get(title)
+    edited = last_edited.get(url)
+    html = dest_dir / f'{title}.html'
+    if force or entry is None or edited is None or html.name not in present:
+      todo.append((title, url))
+    elif entry.get('url') != url or entry.get('last_edited') != edited:
+      todo.append((title, url))
+    elif since is not None and edited >= since.timestamp() * 1000:
+      todo.append((title, url))
+    elif entry.get('html_digest') != mymodule.file_digest(html):
+      todo.append((title, url))
+  return todo
+
+# あきらめたページの記録（html/src/ に置く）
+DEAD_LETTERS_NAME = 'dead_letters.json'
+
+def add_dead_letters(todo: list, pages: list, dead: retry.DeadLetters, only: bool = False) -> list:
+  """前回あきらめたページを、更新されていなくてもやり直すようにtodoへ加える
+
+  pagesは (title, url) のリスト。only=True なら前回あきらめたページだけにする。
+  """
+  if only: todo = []
+  titles = {title for title, url in todo}
+  return todo + [(title, url) for title, url in pages if title in dead and title not in titles]
+
+def report_downloads(loader: 'NotionHtmlDownloader', dead: retry.DeadLetters, file=None) -> None:
+  """あきらめたページと、読み込み直した（むだになった）回数を表示する"""
+  for title, record in loader.failures.items():
+    print(f'Failed to download {title} after {record["attempts"]} attempts: {record["error"]}', file=file)
+  print(f'Full-page reloads: {loader.reloads}, pages given up: {len(loader.failures)}'
+        + (f' (retry them with --dead-letters; listed in {dead.path.name})' if len(dead) else ''), file=file)
+
+def export_record(url: str, last_edited, html_path: Path) -> dict:
+  """sync_state.jsonに書く、エクスポートしたページの記録"""
+  return {
+    'url': url,
+    'last_edited': last_edited,
+    'html_digest': mymodule.file_digest(html_path),
+    'exported_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+  }
+
 class NotionHtmlDownloader():
   """Notion記事のHTMLのダウンローダー
   
@@ -34,22 +136,49 @@ class NotionHtmlDownloader():
   from pathlib import Path as __Path
   from typing import Any
 
-  def __init__(self, destination_dir: __Path):
+  def __init__(self, destination_dir: __Path, use_profile: bool = True, selectors: list = SELECTORS, shared: bool = True,
+               max_attempts: int = 5, step_timeout_second: float = 3., backoff: retry.Backoff = None):
     """初期化
     
     一時フォルダを作ったり、
     ブラウザーを開いたり。
     distination_dirには保存先のディレクトリパスを指定。
+    shared=True なら、使い回すブラウザー（browser.py）に自分のタブを開いて使う。ブラウザーは閉じない。
+    そのとき use_profile=True なら、使い回すブラウザーのプロファイルがNotionにログインしていることを求める
+    （新しいプロファイルならログインしてもらう。browser.startを参照）。use_profile=False ならログインは求めない。
+    shared=False なら、自分でブラウザーを起動する。そのとき use_profile=True ならふだんのChromeのユーザープロファイル
+    （Googleアカウントのログイン）を使うので、起動中のChromeを閉じる。終わったらrecover_chromeを呼ぶこと。
+    use_profile=False ならプロファイルを使わない（起動中のChromeも閉じない）。ローカルの代役ページで試すとき用。
+    selectorsには順々に押してゆくボタンなどのセレクタのリストを指定。
+    max_attemptsは1ページあたりエクスポートを試みる回数、step_timeout_secondは1つのボタンが現れるのを待つ最大の秒数、
+    backoffはやり直すまでの間隔（retry.Backoff）。
     """
     
     self.dest_dir = destination_dir
+    self.use_profile = use_profile
+    self.selectors = selectors
+    self.shared = shared
+    self.max_attempts = max_attempts
+    self.step_timeout_second = step_timeout_second
+    self.backoff = backoff or retry.Backoff()
+    # ページを読み込み直した（ボタンを押した分がむだになった）回数
+    self.reloads = 0
+    # あきらめたページの記録 {title: {'url', 'attempts', 'error'}}
+    self.failures = {}
 
     # 一時フォルダを作成
     self.__tempdir = TempDirPath()
 
+    if self.shared:
+      # 使い回すブラウザーにつなぎ、ダウンロード先を一時フォルダにした自分のタブを開く
+      self.__browser = browser.connect(login=self.use_profile)
+      self.__tab = browser.open_tab(self.__browser, self.__tempdir)
+      return
+
     # 起動中のウィンドウを閉じて、ブラウザーを起動
-    self.__close_working_windows()
-    time.sleep(1)
+    if self.use_profile:
+      self.__close_working_windows()
+      time.sleep(1)
     self.__browser = self.__get_browser()
 
   def __close_working_windows(self) -> None:
@@ -78,159 +207,301 @@ class NotionHtmlDownloader():
     self.__tempdirがセットされている必要がある。
     """
 
+    # Seleniumは（httpのダウンローダーでは要らないので）ここで読み込む
+    # !conda install -c conda-forge selenium
+    from selenium import webdriver
+    # !conda install -c conda-forge python-chromedriver-binary==バージョン番号
+    # https://pypi.org/project/chromedriver-binary/#history
+    import chromedriver_binary   # chromedriver-binaryを使う
+
     options = webdriver.chrome.options.Options()
     # ダウンロードファイルの保存先を変更
-    options.add_experimental_option("prefs", {"download.default_directory": self.__tempdir.as_posix().replace('/', '\\') })
+    options.add_experimental_option("prefs", {"download.default_directory": str(self.__tempdir) })
     # 不要な警告を非表示に
     options.add_experimental_option('excludeSwitches', ['enable-logging'])
     # 起動時のウィンドウサイズを最大にする
     options.add_argument('--start-maximized')
     # Googleアカウントでログインしてスタートページを開く
-    datadir = mymodule.HOMEDIR / 'AppData/Local/Google/Chrome/User Data'
-    datadirstr = datadir.as_posix().replace('/', '\\')  # \を含むコードを変数展開に組み込むことは不可能なので一時変数を設ける
-    options.add_argument(f"--user-data-dir={datadirstr}")
-    options.add_argument("--profile-directory=Default")
+    if self.use_profile:
+      datadir = mymodule.HOMEDIR / 'AppData/Local/Google/Chrome/User Data'
+      datadirstr = datadir.as_posix().replace('/', '\\')  # \を含むコードを変数展開に組み込むことは不可能なので一時変数を設ける
+      options.add_argument(f"--user-data-dir={datadirstr}")
+      options.add_argument("--profile-directory=Default")
     # ブラウザを起動
     return webdriver.Chrome(options=options)
 
   def download(self, url: str, title: str):
     """NotionページのHTMLをダウンロード
     
-    5回までチャレンジするが、最後までできない可能性もある。
+    max_attempts回までチャレンジするが、最後までできない可能性もある。
+    失敗した段の要素がまだ画面にあればそこから（なければその手前の、画面にある段から）やり直し、
+    どの段の要素も見当たらないときだけページを読み込み直す。やり直す前には少しずつ長く待つ。
+    ダウンロードできたかどうかを返す。できなかったときはfailuresに記録が残る。
     """
     
-    for try_count in range(5):
-      # ページ遷移またはリロード
-      if try_count == 0:
-        self.__browser.get(url)
-      else:
-        self.__browser.refresh()
-      time.sleep(1)
-
-      # 一時フォルダ内のものをすべて削除
-      self.__tempdir.empty()
-
+    task = _ExportTask(title, url)
+    while task.attempt < self.max_attempts:
+      if task.attempt > 0: self.backoff.sleep(task.attempt)
       # ブラウザでHTMLをエクスポートする
-      export_complete = False
-      # セレクタのリスト
-      selectors = [
-        Selector('button1', '右上のメニューボタン', "#notion-app > div > div:nth-child(1) > div > div:nth-child(2) > div:nth-child(1) > div.notion-topbar > div > div.notion-topbar-action-buttons > div:nth-child(2) > div.notion-topbar-more-button"),
-        Selector('button2', 'ボタン「エクスポート」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div:nth-child(2) > div > div > div > div > div > div:nth-child(1) > div:nth-child(7) > div:nth-child(2)"),
-        Selector('select1', 'ドロップダウンリスト「エクスポート形式」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(1) > div:nth-child(2)"),
-        Selector('option1', '項目「HTML」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(3) > div > div:nth-child(2) > div:nth-child(2) > div > div > div > div > div > div > div > div:nth-child(2)"),
-        Selector('select2', 'ドロップダウンリスト「対象コンテンツ」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(2) > div:nth-child(2)"),
-        Selector('option2', '項目「ファイルや画像以外」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(3) > div > div:nth-child(2) > div:nth-child(2) > div > div > div > div > div > div > div > div:nth-child(2)"),
-        Selector('toggle1', 'トグルボタン「サブページのフォルダーを作成」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(4) > div:nth-child(2) > input[type=checkbox]"),
-        Selector('toggle2', 'トグルボタン「サブページを含める」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(3) > div.pseudoHover.pseudoActive > input[type=checkbox]"),
-        Selector('submit', 'サブミットボタン「エクスポート」', "#notion-app > div > div.notion-overlay-container.notion-default-overlay-container > div:nth-child(2) > div > div:nth-child(2) > div > div:nth-child(5) > div:nth-child(2)")
-        ]
-      # 順々にボタンを押してゆく
-      toggle2is_on = False
-      export_complete = False
-      for selector in selectors:
-        # トグル1以外ならクリックする（かも）
-        if selector.name != 'toggle1':
-          # トグル2の場合に限り、クリック不要の指示があるときはクリックしない
-          if selector.name == 'toggle2' and toggle2is_on == False: continue
-          try:
-            WebDriverWait(self.__browser, 3).until(EC.element_to_be_clickable((By.CSS_SELECTOR, selector.content)))
-          except:
-            break
-          else:
-            time.sleep(0.3)
-            self.__browser.find_element(By.CSS_SELECTOR, selector.content).click()
-        # トグル1はクリックせず属性の確認だけ
-        else:
-          try:
-            WebDriverWait(self.__browser, 3).until(EC.presence_of_element_located((By.CSS_SELECTOR, selector.content)))
-          except:
-            break
-          else:
-            # disabled属性が付帯しているか
-            if self.__browser.find_element(By.CSS_SELECTOR, selector.content).is_enabled():
-              toggle2is_on = True
-      # selectorを順当に処理していけたなら（breakされなければ）エクスポート成功とみなす
-      else:
-        export_complete = True
       # エクスポートに成功していなければチャレンジをやり直す
-      if not export_complete: continue
+      if not self.__try_export(task, self.__tempdir): continue
 
       # 最大20秒間ダウンロードを待つ
       try:
-        self.__wait_until_completing(20)
-        time.sleep(1)
+        with runlog.timed('download', 'wait', page=title):
+          zip_path = self.__wait_until_completing(20)
       # 長すぎたり、一時フォルダ内のファイルが2個以上なら異常なので、チャレンジをやり直す
-      except:
-        continue
-
-      # ZIPを解凍
-      for p in self.__tempdir.iterdir():
-        if p.suffix == '.zip':
-          shutil.unpack_archive(p.as_posix(), self.__tempdir.as_posix())
-          break
-      # ZIPファイルがないなら異常なので、チャレンジをやり直す
-      else:
+      except filewatch.DownloadError as e:
+        self.__retry_from_start(task, f'download: {e}')
         continue
 
-      # HTMLファイルの名前を変更しつつ、目的のフォルダへと移動させる
-      for p in self.__tempdir.iterdir():
-        if p.suffix == '.html':
-          shutil.move(p.as_posix(), self.dest_dir / f'{title}.html')
-          break
-      # HTMLファイルがないなら異常なので、チャレンジをやり直す
-      else:
+      # ZIPを解凍してHTMLファイルを目的のフォルダへと移動させる
+      # ZIPファイルやHTMLファイルがないなら異常なので、チャレンジをやり直す
+      with runlog.timed('download', 'unpack', page=title) as timing:
+        unpacked = self.__unpack(zip_path, task)
+        if not unpacked: timing.fail()
+      if not unpacked:
+        self.__retry_from_start(task, f'unpack: {zip_path.name} has no HTML of this page')
         continue
       
       # ログ書いて終わる
       # logging.info(f'Downloaded {title}.html')
-      return
+      return True
     
-    else:
-      # 失敗のログを書いて終わる
-      # logging.info(f'Failed to download {title}.html')
-      return
+    # 失敗を記録して終わる
+    self.__give_up(task)
+    return False
+
+  def download_many(self, pages: list, tabs: int = 3, timeout_second: float = 20.):
+    """複数のNotionページのHTMLを、タブを並べて同時にダウンロード
+
+    pagesは (title, url) のリスト。
+    ボタンを押す操作は1つずつしかできないが、Notion側でエクスポートが終わるのを待つあいだに
+    ほかのタブでエクスポートを始めておく。
+    タブごとにブラウザーコンテキストを分けて、それぞれの一時フォルダをダウンロード先にする。
+    それでもほかのページのZIPが紛れ込んだら（コンテキストを分けられなかったときなど）、ページIDが合わないので受け取らない。
+    やり直し方はdownloadと同じだが、待つあいだもほかのタブは進める。
+    ダウンロードできなかったページのタイトルのリストを返す（記録はfailuresに残る）。
+    """
+
+    pending = [_ExportTask(title, url) for title, url in reversed(pages)]
+    failed = []
+    # タブ（それぞれ別のブラウザーコンテキスト）と、その一時フォルダ
+    home = self.__browser.current_window_handle
+    slots = []
+    for n in range(max(1, min(tabs, len(pages)))):
+      tempdir = TempDirPath() if n > 0 else self.__tempdir
+      slots.append(_TabSlot(*browser.open_context_tab(self.__browser, tempdir), tempdir))
+
+    def retry_or_give_up(slot: _TabSlot) -> None:
+      task = slot.task
+      if task.attempt < self.max_attempts:
+        # 同じタブで（開いたページのまま）やり直す。待つあいだはほかのタブを進める
+        slot.wait(self.backoff.delay(task.attempt))
+      else:
+        slot.task = None
+        self.__give_up(task)
+        failed.append(task.title)
+
+    try:
+      while pending or any(slot.task for slot in slots):
+        for slot in slots:
+          # 空いているタブには次のページを割り当てる
+          if slot.task is None:
+            if not pending: continue
+            slot.assign(pending.pop())
+          task = slot.task
+
+          # エクスポートを始める（やり直しなら間隔をあけてから）
+          if not slot.downloading:
+            if time.monotonic() < slot.ready_at: continue
+            self.__browser.switch_to.window(slot.handle)
+            # コンテキストを分けられなかったタブは、ダウンロード先をこのタブの一時フォルダにする
+            if slot.context is None: browser.set_download_dir(self.__browser, slot.tempdir)
+            if self.__try_export(task, slot.tempdir):
+              slot.start()
+            else:
+              retry_or_give_up(slot)
+            continue
+
+          # エクスポート中のタブはダウンロードが終わったかどうか確かめる
+          error = None
+          try:
+            zip_path = filewatch.finished_download(slot.tempdir)
+          # 一時フォルダ内のファイルが2個以上なら異常
+          except filewatch.MultipleFilesError as e:
+            zip_path, error = None, f'download: {e}'
+          else:
+            # まだなら次のタブへ（長すぎるならやり直し）
+            if zip_path is None:
+              if time.monotonic() - slot.started < timeout_second: continue
+              error = f'download: not finished in {timeout_second} seconds'
+          runlog.record('download', 'wait', time.monotonic() - slot.started, page=task.title, ok=zip_path is not None)
+          if zip_path is not None:
+            with runlog.timed('download', 'unpack', page=task.title) as timing:
+              if self.__unpack(zip_path, task):
+                # logging.info(f'Downloaded {task.title}.html')
+                slot.task = None
+                continue
+              timing.fail()
+            error = f'unpack: {zip_path.name} has no HTML of this page'
+          # やり直し
+          self.__browser.switch_to.window(slot.handle)
+          self.__retry_from_start(task, error)
+          retry_or_give_up(slot)
+        time.sleep(0.05)
+    finally:
+      # 開いたタブとコンテキストを捨てて、もとのタブに戻る
+      for n, slot in enumerate(slots):
+        browser.close_tab(self.__browser, slot.handle, slot.context)
+        if n > 0: del slot.tempdir
+      self.__browser.switch_to.window(home)
+    return failed
+
+  def session_cookies(self, url: str) -> dict:
+    """urlのサイトにログインしているブラウザーのクッキーを返す"""
+    origin = '{0.scheme}://{0.netloc}'.format(urlparse(url))
+    self.__browser.get(f'{origin}/')
+    return {cookie['name']: cookie['value'] for cookie in self.__browser.get_cookies()}
+
+  def __try_export(self, task: '_ExportTask', tempdir: __Path) -> bool:
+    """今のタブでtaskのページのエクスポートを1回試みる
+
+    はじめてならページを開き、やり直しなら task.resume の段から（Noneならページを読み込み直して）始める。
+    最後まで押せたらTrueを返す。失敗したら、次にどこから始めるかを task.resume に入れてFalseを返す。
+    """
+    task.attempt += 1
+    if task.attempt > 1:
+      step = 'reload' if task.resume is None else self.selectors[task.resume].name
+      runlog.record('download', 'retry', page=task.title, attempt=task.attempt, at=step)
+    with runlog.timed('download', 'export', page=task.title, attempt=task.attempt) as timing:
+      # ページ遷移またはリロード
+      if task.resume is None:
+        if not task.opened:
+          self.__browser.get(task.url)
+          task.opened = True
+        else:
+          self.__browser.refresh()
+          self.reloads += 1
+          runlog.record('download', 'reload', page=task.title, attempt=task.attempt)
+        start = 0
+      else:
+        start = task.resume
+
+      # 一時フォルダ内のものをすべて削除
+      tempdir.empty()
+
+      failed_step = self.__click_through(start)
+      if failed_step is not None: timing.fail(at=self.selectors[failed_step].name)
+    if failed_step is None: return True
+    task.error = f'{self.selectors[failed_step].name}: {self.selectors[failed_step].description} was not found'
+    task.resume = self.__resume_point(failed_step)
+    return False
+
+  def __click_through(self, start: int) -> int:
+    """今のタブで、selectorsのstart番目から順々にボタンを押してゆく
+
+    最後まで押せたらNoneを、押せなかった（要素が現れなかった）段の番号を返す。
+    ボタンが現れしだい押し、押せなかったとき（ほかの要素に隠れていたなど）は少しずつ間隔をのばして押し直す。
+    """
+    # Seleniumは（httpのダウンローダーでは要らないので）ここで読み込む
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException, ElementClickInterceptedException, StaleElementReferenceException
+    for n in range(start, len(self.selectors)):
+      selector = self.selectors[n]
+      # トグル1以外ならクリックする（かも）
+      if selector.name != 'toggle1':
+        # トグル2の場合に限り、クリック不要の指示があるときはクリックしない
+        if selector.name == 'toggle2' and not self.__toggle2_is_on(): continue
+        with runlog.timed('download', f'click:{selector.name}') as timing:
+          try:
+            element = WebDriverWait(self.__browser, self.step_timeout_second).until(
+              EC.element_to_be_clickable((By.CSS_SELECTOR, selector.content)))
+          except TimeoutException:
+            timing.fail(error='not found')
+            return n
+          for failures in range(1, 4):
+            try:
+              element.click()
+              break
+            except (ElementClickInterceptedException, StaleElementReferenceException):
+              time.sleep(self.backoff.delay(failures) / 4)
+              element = self.__browser.find_elements(By.CSS_SELECTOR, selector.content)
+              if not element:
+                timing.fail(error='gone')
+                return n
+              element = element[0]
+          else:
+            timing.fail(error='not clickable')
+            return n
+      # トグル1はクリックせず属性の確認だけ
+      else:
+        try:
+          WebDriverWait(self.__browser, self.step_timeout_second).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, selector.content)))
+        except TimeoutException:
+          return n
+    # selectorを順当に処理していけたなら（returnされなければ）エクスポート成功とみなす
+    return None
+
+  def __toggle2_is_on(self) -> bool:
+    """トグル2を押す必要があるか（トグル1にdisabled属性が付帯していなければ押す）"""
+    toggle1 = next((selector for selector in self.selectors if selector.name == 'toggle1'), None)
+    if toggle1 is None: return False
+    from selenium.webdriver.common.by import By
+    elements = self.__browser.find_elements(By.CSS_SELECTOR, toggle1.content)
+    return bool(elements) and elements[0].is_enabled()
+
+  def __resume_point(self, failed_step: int) -> int:
+    """failed_step番目の段で失敗したとき、次に始める段の番号を返す
+
+    その段から手前へ順に見て、要素がいま画面にある最初の段を返す（メニューが閉じていればメニューを開くところから）。
+    どの段の要素もなければNone（ページを読み込み直す）。
+    """
+    from selenium.webdriver.common.by import By
+    for n in range(failed_step, -1, -1):
+      if self.__browser.find_elements(By.CSS_SELECTOR, self.selectors[n].content):
+        return n
+    return None
+
+  def __retry_from_start(self, task: '_ExportTask', error: str) -> None:
+    """ボタンは押せたのにダウンロードできなかったとき、最初のボタンから（なければ読み込み直して）やり直すようにする"""
+    task.error = error
+    task.resume = self.__resume_point(0)
+
+  def __give_up(self, task: '_ExportTask') -> None:
+    """やり直してもだめだったページを記録する"""
+    self.failures[task.title] = {'url': task.url, 'attempts': task.attempt, 'error': task.error}
+    runlog.record('download', 'failed', page=task.title, attempts=task.attempt, error=task.error)
+    # logging.error(f'Failed to download {task.title}.html: {task.error}')
 
-  def __wait_until_completing(self, timeout_second: float) -> None:
-    """最大timeout_second秒のあいだダウンロードを待つ。
+  def __unpack(self, zip_path: __Path, task: '_ExportTask') -> bool:
+    """ダウンロードしたZIPからHTMLファイルを取り出し、名前を変更しつつ目的のフォルダへ保存する
+
+    ZIPファイルでなかったり、taskのページのHTMLファイルがなかったりすればFalseを返す。
+    """
+    return extract_html(zip_path, self.dest_dir / f'{task.title}.html', page=page_id(task.url))
+
+  def __wait_until_completing(self, timeout_second: float) -> __Path:
+    """最大timeout_second秒のあいだダウンロードを待ち、ダウンロードされたファイルのパスを返す。
     
     このメソッドは、このメソッド実行前において一時フォルダ内が空であることが前提となっている。
+    長すぎるとfilewatch.DownloadTimeoutErrorを、
+    一時フォルダ内に2個以上のファイルが存在するとfilewatch.MultipleFilesErrorを発出する。
     """
-    started = datetime.now()
-    # ファイル一覧取得
-    # 現在時刻と開始時刻との差が指定時間以上になったらやめる。
-    while datetime.now() - started < timedelta(seconds=timeout_second):
-      # ちゃんと待つことにした（久しぶりに起動すると鈍いから）
-      time.sleep(1)
-      file_list = list(self.__tempdir.iterdir())
-      # ファイルが1つも存在しない場合
-      if len(file_list) == 0:
-        # 次の回へ
-        continue
-      # ファイルが1つだけ存在する場合
-      elif len(file_list) == 1:
-        # 拡張子が '.crdownload' の場合は、続ける
-        if file_list[0].suffix == ".crdownload":
-          continue
-        # 拡張子が '.crdownload' でない場合
-        # ちょっと待ってからもう一度確認
-        time.sleep(1)
-        if file_list[0].suffix == ".crdownload":
-          continue
-        # ダウンロード完了と判断し、待機を抜け、かつ関数の処理じたいも終わる
-        return
-      # ファイルが2つ以上存在する場合
-      else:
-        # とりあえずダウンロード中のファイルがあれば待ったあと、異常だよというエラーを発出
-        while any([p.suffix == ".crdownload" for p in file_list]):
-          time.sleep(1)
-        raise SystemError('一時フォルダ内に2個以上のファイルが存在しました。')
-    # 長すぎるよというエラーを発出
-    raise TimeoutError('Download will take forever!')
-     
+    return filewatch.wait_for_download(self.__tempdir, timeout_second)
+
   @classmethod
   def recover_chrome(cls):
     """Chromeのダウンロード先を元に戻す"""
 
+    # !conda install -c conda-forge selenium
+    from selenium import webdriver
+    # !conda install -c conda-forge python-chromedriver-binary==バージョン番号
+    import chromedriver_binary   # chromedriver-binaryを使う
+
     # オプション変数を作成
     options = webdriver.chrome.options.Options()
     # ヘッドレスモードで開く
@@ -253,36 +524,148 @@ class NotionHtmlDownloader():
     # logging.info('Recovered Chrome')
 
   def __del__(self):
-    """一時フォルダを削除し、ブラウザーを閉じる"""
+    """一時フォルダを削除し、ブラウザーを閉じる（使い回すブラウザーなら自分のタブを閉じて切り離すだけ）"""
     
     del self.__tempdir
 
+    if self.shared:
+      browser.close_tab(self.__browser, self.__tab)
+      self.__browser.quit()   # つないでいるだけなので、ブラウザーは閉じない。
+      return
+
     self.__browser.close()  # アクティブなタブのみ終了。
     self.__browser.quit()   # すべてのタブを閉じてブラウザを終了。（ないとダメだ！）
 
     # logging.info('Closed browser')
 
-def main():
+class _ExportTask():
+  """1ページぶんのエクスポートの進み具合"""
+
+  def __init__(self, title: str, url: str):
+    self.title = title
+    self.url = url
+    # エクスポートを試みた回数
+    self.attempt = 0
+    # 次に始める段の番号（Noneならページを開く、または読み込み直すところから）
+    self.resume = None
+    # タブでこのページを開いたか
+    self.opened = False
+    # 最後の失敗の説明
+    self.error = None
+
+class _TabSlot():
+  """download_manyで使うタブ1つぶんの状態"""
+
+  def __init__(self, handle: str, context: str, tempdir):
+    self.handle = handle
+    # タブのブラウザーコンテキストのID（分けられなかったらNone）
+    self.context = context
+    self.tempdir = tempdir
+    # このタブで扱っているページ（_ExportTask）。空いていればNone
+    self.task = None
+    # ボタンを押し終えてダウンロードを待っているか
+    self.downloading = False
+    self.started = 0.
+    # やり直しを始めてよい時刻
+    self.ready_at = 0.
+
+  def assign(self, task: _ExportTask) -> None:
+    self.task = task
+    self.downloading = False
+    self.ready_at = 0.
+
+  def start(self) -> None:
+    self.downloading = True
+    self.started = time.monotonic()
+
+  def wait(self, seconds: float) -> None:
+    self.downloading = False
+    self.ready_at = time.monotonic() + seconds
+
+# ダウンローダーの名前と、そのクラス（どちらも (保存先, shared=...) でつくれる）
+DOWNLOADERS = {
+  'browser': NotionHtmlDownloader,
+  'http': notion_http.NotionHttpExporter,
+}
+
+def main(tabs: int = 1, force: bool = False, since: datetime = None, shared: bool = True, dead_letters: bool = False,
+         downloader: str = 'browser'):
+  """setting.csvのページのHTMLをダウンロードする
+
+  downloader='browser' ならエクスポートメニューを押して、'http' ならNotionのAPIにエクスポートを頼んでダウンロードする。
+  'http' ではページをすべて一度に頼み、tabsは使わない（ログインには使い回すブラウザーのクッキーを使う）。
+  tabsを2以上にすると、その数のタブで同時にダウンロードする。
+  前回から更新されていないページは飛ばす（force、sinceについてはpages_to_exportを参照）。
+  前回あきらめたページ（dead_letters.json）は更新されていなくてもやり直す。dead_letters=True ならそれだけをやり直す。
+  shared=False なら使い回すブラウザーではなく、ふだんのChromeのプロファイルでブラウザーを起動する（NotionHtmlDownloaderを参照）。
+  """
   # URLの取得
   urls = { title: url for title, url in mymodule.target_pages(need_url=True) }
 
   # 各NotionページのHTMLをダウンロード
-  EXPDIR = mymodule.APPDIR / 'html/src'
-  loader = NotionHtmlDownloader(EXPDIR)
+  EXPDIR = mymodule.DIRS.html_src
+  state_path = EXPDIR / 'sync_state.json'
+  state = mymodule.load_manifest(state_path)
+  dead = retry.DeadLetters(EXPDIR / DEAD_LETTERS_NAME)
+  loader = DOWNLOADERS[downloader](EXPDIR, shared=shared)
   # logging.info('Browser Open')
-  bar = tqdm(list(urls.items()))
-  bar.set_description('Downloading Notion Article')
   try:
-    for title, url in bar:
-      loader.download(title=title, url=url)
+    # 更新されたページだけにしぼる（forceでも、次の実行で比べられるように最終更新時刻は記録する）
+    last_edited = {}
+    if urls:
+      first_url = next(iter(urls.values()))
+      cookies = loader.session_cookies(first_url)
+      notion_http.require_login(cookies, first_url)
+      last_edited = fetch_last_edited(list(urls.values()), cookies)
+    todo = pages_to_export(list(urls.items()), state, last_edited, EXPDIR, force=force, since=since)
+    todo = add_dead_letters(todo, list(urls.items()), dead, only=dead_letters)
+    # logging.info(f'{len(urls)-len(todo)} pages are unchanged')
+
+    def done(title: str):
+      state[title] = export_record(urls[title], last_edited.get(urls[title]), EXPDIR / f'{title}.html')
+      dead.remove(title)
+
+    if downloader == 'http':
+      failed = loader.download_many(todo)
+      for title, url in todo:
+        if title not in failed: done(title)
+    elif tabs > 1:
+      failed = loader.download_many(todo, tabs=tabs)
+      for title, url in todo:
+        if title not in failed: done(title)
+    else:
+      bar = tqdm(todo)
+      bar.set_description('Downloading Notion Article')
+      for title, url in bar:
+        if loader.download(title=title, url=url): done(title)
+    for title, record in loader.failures.items():
+      dead.add(title, **record)
+    report_downloads(loader, dead)
   finally:
+    mymodule.save_manifest(state_path, state)
+    dead.save()
     del loader
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='NotionページのHTMLをダウンロードする')
+  parser.add_argument('--tabs', type=int, default=1, help='同時にエクスポートするタブの数')
+  parser.add_argument('--force', action='store_true', help='更新されていないページもダウンロードし直す')
+  parser.add_argument('--since', type=datetime.fromisoformat,
+                      help='この日時（例: 2023-04-01T09:00）以降に更新されたページは必ずダウンロードし直す')
+  parser.add_argument('--own-browser', action='store_true',
+                      help='使い回すブラウザーではなく、起動中のChromeを閉じてふだんのプロファイルで起動する')
+  parser.add_argument('--dead-letters', action='store_true', help='前回あきらめたページだけをやり直す')
+  parser.add_argument('--downloader', choices=DOWNLOADERS.keys(), default='browser',
+                      help='browserならエクスポートメニューを押し、httpならNotionのAPIにまとめてエクスポートを頼む')
+  args = parser.parse_args()
+
   # 実行の確認
   print("I'll download notion documents.")
-  if not yes_no_input('May I close Google Chrome windows?'):
+  if args.own_browser and not yes_no_input('May I close Google Chrome windows?'):
     exit()
   
-  main()
-  NotionHtmlDownloader.recover_chrome()
+  runlog.start('notion2html')
+  main(tabs=args.tabs, force=args.force, since=args.since, shared=not args.own_browser, dead_letters=args.dead_letters,
+       downloader=args.downloader)
+  if args.own_browser: NotionHtmlDownloader.recover_chrome()
+  runlog.report()
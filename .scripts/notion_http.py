@@ -0,0 +1,476 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""NotionのエクスポートをHTTPで頼むダウンローダー
+
+エクスポートメニューをSeleniumで押すかわりに、Notionの画面が裏で使っているAPIを直接呼ぶ。
+  1. enqueueTask でページごとのエクスポートのタスクを頼む（頼めるものは一度にまとめて頼む）
+  2. getTasks でまだ終わっていないタスクの状態を、1回の問い合わせでまとめて聞く
+  3. 終わったものから、ZIPの取得と解凍をスレッドプールで同時に進める
+ログインには、使い回すブラウザー（browser.py）のクッキーをそのまま使う。
+接続はサイトごとにkeep-aliveで使い回すので、何百ページでもTCPやTLSのつなぎ直しはほとんど起きない。
+
+  exporter = NotionHttpExporter(dest)            # クッキーは使い回すブラウザーから
+  failed = exporter.download_many(pages)         # pagesは (title, url) のリスト
+  exporter.close()
+
+NotionHtmlDownloaderと同じく download(url, title) でも使え、failures と reloads（いつも0）を持つ。
+"""
+
+import os
+import re
+import ssl
+import json
+import time
+import shutil
+import zipfile
+import threading
+import http.client
+import runlog
+import retry
+from pathlib import Path
+from collections import namedtuple
+from urllib.parse import urlparse, urljoin
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mylib.path import TempDirPath
+
+# エクスポートのタスクを頼むAPIと、その状態を聞くAPI
+ENQUEUE_API_PATH = '/api/v3/enqueueTask'
+TASKS_API_PATH = '/api/v3/getTasks'
+# 1回の問い合わせで状態を聞くタスクの数の上限
+POLL_BATCH = 100
+# エクスポートメニューで選んでいるのと同じ設定（HTML、ファイルや画像以外、サブページを含めない）
+EXPORT_OPTIONS = {'exportType': 'html', 'includeContents': 'no_files', 'timeZone': 'Asia/Tokyo', 'locale': 'ja-JP'}
+
+def page_id(url: str) -> str:
+  """NotionのURLからページID（ハイフン区切り）を取り出す。見つからなければNone"""
+  ids = re.findall(r'(?<![0-9a-f])([0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12})$', urlparse(url).path)
+  if not ids:
+    return None
+  h = ids[-1].replace('-', '')
+  return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+def origin(url: str) -> str:
+  return '{0.scheme}://{0.netloc}'.format(urlparse(url))
+
+def extract_html(zip_path: Path, dest: Path, page: str = None) -> bool:
+  """ZIPの最上位にあるHTMLファイルだけを、destへ直接書き出す
+
+  ほかのファイル（画像など）は解凍しない。
+  pageにページIDを指定すると、ファイル名（「タイトル ページID.html」）にそのIDがないHTMLはほかのページのものとみなす。
+  書き出しの途中で止まっても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える。
+  ZIPファイルでなかったりHTMLファイルがなかったりすればFalseを返す。
+  """
+  if zip_path.suffix != '.zip':
+    return False
+  temp = dest.with_name(f'{dest.name}.part')
+  try:
+    with zipfile.ZipFile(zip_path) as zf:
+      member = next((info for info in zf.infolist()
+                     if not info.is_dir() and '/' not in info.filename and info.filename.endswith('.html')), None)
+      if member is None:
+        return False
+      if page is not None and page.replace('-', '') not in member.filename.replace('-', ''):
+        return False
+      with zf.open(member) as src, open(temp, 'wb') as f:
+        shutil.copyfileobj(src, f, 1 << 20)
+    os.replace(temp, dest)
+  except zipfile.BadZipFile:
+    return False
+  finally:
+    if temp.exists(): temp.unlink()
+  return True
+
+def browser_cookies(port: int = None) -> list:
+  """使い回すブラウザーのクッキー（name, value, domainなどのdictのリスト）を返す"""
+  import browser
+  driver = browser.connect(port)
+  try:
+    return driver.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+  finally:
+    driver.quit()   # つないでいるだけなので、ブラウザーは閉じない。
+
+# Notionにログインしているときに付いているクッキー
+SESSION_COOKIE = 'token_v2'
+
+def require_login(cookies: dict, url: str) -> None:
+  """urlがNotionのページなのに、cookies（{name: value}）にログインのクッキーがなければRuntimeErrorを発出する
+
+  ログインしていないと、どのページもエクスポートできずにやり直し続けるだけなので、始める前に止める。
+  """
+  host = urlparse(url).hostname or ''
+  if (host == 'notion.so' or host.endswith('.notion.so')) and not cookies.get(SESSION_COOKIE):
+    raise RuntimeError(f'The browser is not logged in to {origin(url)}. '
+                       'Run "python browser.py login" (or "quizpdf.py browser login") and log in to Notion first.')
+
+def cookies_for(cookies: list, host: str) -> dict:
+  """hostへ送るクッキーを {name: value} で返す（domainのないクッキーはどこへでも送る）"""
+  sent = {}
+  for cookie in cookies:
+    domain = (cookie.get('domain') or '').lstrip('.')
+    if not domain or host == domain or host.endswith(f'.{domain}'):
+      sent[cookie['name']] = cookie['value']
+  return sent
+
+class HttpError(Exception):
+  """200以外の応答"""
+
+  def __init__(self, status: int, url: str):
+    super().__init__(f'HTTP {status} from {url}')
+    self.status = status
+
+Response = namedtuple('Response', 'status headers body')
+
+class ConnectionPool():
+  """サイト（スキーム, ホスト:ポート）ごとに、keep-aliveの接続を使い回す
+
+  スレッドから同時に使ってよい。使い終わった接続はsize本まで残しておく。
+  opened はこれまでに開いた接続の数。
+  """
+
+  def __init__(self, size: int = 8, timeout_second: float = 30.):
+    self.size = size
+    self.timeout_second = timeout_second
+    self.opened = 0
+    self.__idle = {}
+    self.__lock = threading.Lock()
+    self.__ssl_context = None
+
+  def __acquire(self, key: tuple):
+    """(接続, 使い回しか) を返す"""
+    with self.__lock:
+      idle = self.__idle.get(key)
+      if idle: return idle.pop(), True
+      self.opened += 1
+    scheme, netloc = key
+    if scheme == 'https':
+      if self.__ssl_context is None: self.__ssl_context = ssl.create_default_context()
+      return http.client.HTTPSConnection(netloc, timeout=self.timeout_second, context=self.__ssl_context), False
+    return http.client.HTTPConnection(netloc, timeout=self.timeout_second), False
+
+  def __release(self, key: tuple, conn) -> None:
+    with self.__lock:
+      idle = self.__idle.setdefault(key, [])
+      if len(idle) < self.size:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def request(self, method: str, url: str, body: bytes = None, headers: dict = None, dest: Path = None) -> Response:
+    """リクエストを送って応答を返す
+
+    destを指定すると、本文はメモリに読まずにそのファイルへ書き出す（Response.bodyはNone）。
+    使い回した接続が向こうで切られていたときは、新しい接続で1回だけ送り直す。
+    """
+    parts = urlparse(url)
+    key = (parts.scheme, parts.netloc)
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    while True:
+      conn, reused = self.__acquire(key)
+      try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        if dest is None or response.status != 200:
+          data = response.read()
+        else:
+          with open(dest, 'wb') as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+          data = None
+      except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError):
+        conn.close()
+        if reused: continue
+        raise
+      except Exception:
+        conn.close()
+        raise
+      if response.will_close:
+        conn.close()
+      else:
+        self.__release(key, conn)
+      return Response(response.status, response.headers, data)
+
+  def close(self) -> None:
+    with self.__lock:
+      idle, self.__idle = self.__idle, {}
+    for conns in idle.values():
+      for conn in conns:
+        conn.close()
+
+class _HttpExport():
+  """1ページぶんのエクスポートの状態"""
+
+  def __init__(self, title: str, url: str):
+    self.title = title
+    self.url = url
+    self.origin = origin(url)
+    # エクスポートを頼んだ回数
+    self.attempt = 0
+    self.task_id = None
+    # タスクを頼んだ時刻と、（やり直すとき）次に頼んでよい時刻
+    self.enqueued_at = 0.
+    self.ready_at = 0.
+    # 最後の失敗の説明
+    self.error = None
+    self.ok = False
+    self.done = threading.Event()
+
+class NotionHttpExporter():
+  """NotionのエクスポートのAPIを使うダウンローダー
+
+  頼んだページは裏のスレッドがまとめて受け持つ。そのスレッドが、頼めるタスクをスレッドプールで一度に頼み、
+  終わっていないタスクの状態を poll_interval_second ごとに1回の問い合わせで聞き、
+  終わったものからZIPの取得と解凍をスレッドプールに任せる。
+  失敗したもの（タスクの失敗、timeout_secondを過ぎても終わらない、取得や解凍の失敗）は、
+  間隔（backoff）を空けて max_attempts 回まで頼み直し、それでもだめならfailuresに記録する。
+  cookiesは {name: value} かクッキーのdictのリスト。省略すると使い回すブラウザーから読む。
+  """
+
+  def __init__(self, destination_dir: Path, shared: bool = True, cookies=None, workers: int = 8,
+               poll_interval_second: float = 1., timeout_second: float = 300., max_attempts: int = 3,
+               backoff: retry.Backoff = None):
+    self.__closed = True
+    if cookies is None:
+      if not shared:
+        raise ValueError('The http downloader signs in with the shared browser; it cannot use --own-browser.')
+      cookies = browser_cookies()
+    if isinstance(cookies, dict):
+      cookies = [{'name': name, 'value': value} for name, value in cookies.items()]
+    self.dest_dir = destination_dir
+    self.cookies = cookies
+    self.poll_interval_second = poll_interval_second
+    self.timeout_second = timeout_second
+    self.max_attempts = max_attempts
+    self.backoff = backoff or retry.Backoff(base_second=1.)
+    # ページを読み込み直すことはないので、いつも0（NotionHtmlDownloaderと同じく表示するため）
+    self.reloads = 0
+    # あきらめたページの記録 {title: {'url', 'attempts', 'error'}}
+    self.failures = {}
+    # 状態を聞いた回数
+    self.polls = 0
+    self.pool = ConnectionPool(size=workers)
+    self.__executor = ThreadPoolExecutor(workers)
+    self.__tempdir = TempDirPath()
+    self.__lock = threading.Condition()
+    # 頼む順番を待っているもの
+    self.__queued = []
+    # prefetchで頼んだが、まだdownloadで受け取られていないもの {title: _HttpExport}
+    self.__prefetched = {}
+    self.__thread = None
+    self.__closed = False
+
+  def session_cookies(self, url: str) -> dict:
+    """urlのサイトへ送るクッキーを返す"""
+    return cookies_for(self.cookies, urlparse(url).hostname)
+
+  def prefetch(self, pages: list) -> None:
+    """pages（(title, url) のリスト）のエクスポートを先に頼んでおく（あとでdownloadすると受け取れる）"""
+    exports = [_HttpExport(title, url) for title, url in pages]
+    with self.__lock:
+      for export in exports:
+        self.__prefetched[export.title] = export
+    self.__submit(exports)
+
+  def download(self, url: str, title: str) -> bool:
+    """NotionページのHTMLをダウンロードし、できたかどうかを返す（できなかったときはfailuresに記録が残る）"""
+    export = self.__claim(title, url)
+    export.done.wait()
+    return export.ok
+
+  def download_many(self, pages: list) -> list:
+    """pages（(title, url) のリスト）を同時にダウンロードし、できなかったページのタイトルのリストを返す"""
+    exports = [self.__claim(title, url) for title, url in pages]
+    for export in exports:
+      export.done.wait()
+    return [export.title for export in exports if not export.ok]
+
+  def close(self) -> None:
+    """裏のスレッドの仕事が終わるのを待ち、接続と一時フォルダを片づける"""
+    if self.__closed: return
+    self.__closed = True
+    thread = self.__thread
+    if thread is not None: thread.join()
+    self.__executor.shutdown()
+    self.pool.close()
+    del self.__tempdir
+
+  def __del__(self):
+    self.close()
+
+  def __claim(self, title: str, url: str) -> _HttpExport:
+    with self.__lock:
+      export = self.__prefetched.pop(title, None)
+    if export is None or export.url != url:
+      export = _HttpExport(title, url)
+      self.__submit([export])
+    return export
+
+  def __submit(self, exports: list) -> None:
+    with self.__lock:
+      self.__queued.extend(exports)
+      if self.__thread is None:
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+      self.__lock.notify()
+
+  def __headers(self, url: str, **headers) -> dict:
+    cookies = cookies_for(self.cookies, urlparse(url).hostname)
+    if cookies: headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in cookies.items())
+    return headers
+
+  def __post(self, url: str, body: dict) -> dict:
+    response = self.pool.request('POST', url, body=json.dumps(body).encode('utf-8'),
+                                 headers=self.__headers(url, **{'Content-Type': 'application/json'}))
+    if response.status != 200:
+      raise HttpError(response.status, url)
+    return json.loads(response.body)
+
+  def __run(self) -> None:
+    """裏のスレッド：頼む・まとめて状態を聞く・取得と解凍を任せる、を仕事がなくなるまで繰り返す"""
+    # タスクID -> _HttpExport
+    running = {}
+    # 取得と解凍のFuture -> _HttpExport
+    fetching = {}
+    try:
+      self.__loop(running, fetching)
+    except Exception as e:
+      # 待っている人が待ちぼうけにならないよう、受け持っていたものはすべてあきらめる
+      with self.__lock:
+        exports, self.__queued, self.__thread = self.__queued + list(running.values()) + list(fetching.values()), [], None
+      for export in exports:
+        export.attempt = self.max_attempts
+        self.__retry(export, f'{type(e).__name__}: {e}')
+      raise
+
+  def __loop(self, running: dict, fetching: dict) -> None:
+    last_poll = 0.
+    while True:
+      now = time.monotonic()
+      with self.__lock:
+        if not (self.__queued or running or fetching):
+          self.__thread = None
+          return
+        ready = [export for export in self.__queued if export.ready_at <= now]
+        self.__queued = [export for export in self.__queued if export.ready_at > now]
+
+      # 頼めるものは一度に頼む
+      for export, error in zip(ready, self.__executor.map(self.__enqueue, ready)):
+        if error is None:
+          running[export.task_id] = export
+        else:
+          self.__retry(export, error)
+
+      # 終わっていないタスクの状態をまとめて聞く
+      now = time.monotonic()
+      if running and now - last_poll >= self.poll_interval_second:
+        last_poll = now
+        for export, status in self.__poll(list(running.values())):
+          if status.get('state') == 'success':
+            del running[export.task_id]
+            export_url = urljoin(export.origin, status.get('status', {}).get('exportURL', ''))
+            fetching[self.__executor.submit(self.__fetch, export, export_url)] = export
+          elif status.get('state') == 'failure':
+            del running[export.task_id]
+            self.__retry(export, f'export: {status.get("error") or "task failed"}')
+          elif now - export.enqueued_at > self.timeout_second:
+            del running[export.task_id]
+            self.__retry(export, f'export: not finished in {self.timeout_second} seconds')
+
+      # 取得と解凍が済んだもの
+      for future in [future for future in fetching if future.done()]:
+        export = fetching.pop(future)
+        try:
+          future.result()
+        except Exception as e:
+          self.__retry(export, f'fetch: {e}')
+        else:
+          self.__finish(export, True)
+
+      # 次にすることがあるまで待つ（取得と解凍が済めばすぐ起きる）
+      now = time.monotonic()
+      deadlines = [last_poll + self.poll_interval_second] if running else []
+      with self.__lock:
+        deadlines += [export.ready_at for export in self.__queued]
+        if not deadlines and not fetching: continue
+        # 新しく頼まれたものも、長くてもpoll_interval_secondのうちには拾う
+        timeout = min([self.poll_interval_second] + [max(0., deadline - now) for deadline in deadlines])
+        if not fetching:
+          self.__lock.wait(timeout)
+          continue
+      wait(fetching, timeout=timeout, return_when=FIRST_COMPLETED)
+
+  def __enqueue(self, export: _HttpExport) -> str:
+    """エクスポートのタスクを頼む。失敗すればその説明を返す"""
+    export.attempt += 1
+    if export.attempt > 1:
+      runlog.record('download', 'retry', page=export.title, attempt=export.attempt, at='enqueue')
+    block_id = page_id(export.url)
+    if block_id is None:
+      # 何度頼んでも同じなので、頼み直さない
+      export.attempt = self.max_attempts
+      return f'enqueue: no page ID in {export.url}'
+    body = {'task': {'eventName': 'exportBlock', 'request': {
+      'block': {'id': block_id}, 'recursive': False, 'exportOptions': EXPORT_OPTIONS}}}
+    try:
+      with runlog.timed('download', 'enqueue', page=export.title):
+        export.task_id = self.__post(f'{export.origin}{ENQUEUE_API_PATH}', body)['taskId']
+    except (OSError, ValueError, KeyError, http.client.HTTPException, HttpError) as e:
+      return f'enqueue: {e}'
+    export.enqueued_at = time.monotonic()
+    return None
+
+  def __poll(self, exports: list) -> list:
+    """タスクの状態を、サイトごとにPOLL_BATCH件ずつまとめて聞き、(_HttpExport, 状態) のリストを返す
+
+    聞けなかったものは空の状態（まだ終わっていない扱い）になる。
+    """
+    by_origin = {}
+    for export in exports:
+      by_origin.setdefault(export.origin, []).append(export)
+    statuses = []
+    for site, site_exports in by_origin.items():
+      for n in range(0, len(site_exports), POLL_BATCH):
+        batch = site_exports[n:n+POLL_BATCH]
+        self.polls += 1
+        try:
+          with runlog.timed('download', 'poll', tasks=len(batch)):
+            results = self.__post(f'{site}{TASKS_API_PATH}', {'taskIds': [export.task_id for export in batch]})['results']
+        except (OSError, ValueError, KeyError, http.client.HTTPException, HttpError):
+          # logging.warning(f'Could not poll export tasks on {site}')
+          results = []
+        by_id = {result.get('id'): result for result in results}
+        statuses += [(export, by_id.get(export.task_id, {})) for export in batch]
+    return statuses
+
+  def __fetch(self, export: _HttpExport, url: str) -> None:
+    """できたZIPを取ってきて、HTMLを保存先へ取り出す（スレッドプールで動く）"""
+    zip_path = self.__tempdir / f'{export.task_id}.zip'
+    try:
+      with runlog.timed('download', 'fetch', page=export.title):
+        # リダイレクトの先がほかのサイトなら、そのサイトのクッキーだけを送る
+        for _ in range(5):
+          response = self.pool.request('GET', url, headers=self.__headers(url), dest=zip_path)
+          if response.status not in (301, 302, 303, 307, 308): break
+          url = urljoin(url, response.headers['Location'])
+        if response.status != 200:
+          raise HttpError(response.status, url)
+      with runlog.timed('download', 'unpack', page=export.title):
+        if not extract_html(zip_path, self.dest_dir / f'{export.title}.html'):
+          raise ValueError(f'{url} has no HTML')
+    finally:
+      zip_path.unlink(missing_ok=True)
+
+  def __retry(self, export: _HttpExport, error: str) -> None:
+    export.error = error
+    if export.attempt >= self.max_attempts:
+      self.failures[export.title] = {'url': export.url, 'attempts': export.attempt, 'error': error}
+      runlog.record('download', 'failed', page=export.title, attempts=export.attempt, error=error)
+      # logging.error(f'Failed to download {export.title}.html: {error}')
+      self.__finish(export, False)
+      return
+    export.ready_at = time.monotonic() + self.backoff.delay(export.attempt)
+    with self.__lock:
+      self.__queued.append(export)
+
+  def __finish(self, export: _HttpExport, ok: bool) -> None:
+    export.ok = ok
+    export.done.set()
@@ -0,0 +1,413 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""Notionの代役となるローカルのHTTPサーバー
+
+notion2htmlをNotionにつながずに試すためのもの。
+ページを開くと、notion2html.SELECTORSのセレクタがそのまま当たるエクスポートメニューが出てきて、
+順々に押していくとNotionと同じ形のZIP（中に「タイトル ページID.html」）がダウンロードされる。
+ページの最終更新時刻を返すAPI（syncRecordValues）と、エクスポートのタスクのAPI（enqueueTask, getTasks）の代役も兼ねる。
+
+やり直しを試せるよう、わざと失敗させることもできる（dropped_clicks、export_failure_rate、break_page）。
+
+  with NotionStandin() as standin:
+    url = standin.add_page('問題集')
+    # 使い回すブラウザー（browser.py）のタブで。代役にはログインが要らないので use_profile=False
+    loader = NotionHtmlDownloader(dest, use_profile=False)
+    loader.download_many([('問題集', url)])
+"""
+
+import re
+import io
+import json
+import time
+import uuid
+import random
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote
+
+# セレクタの名前と、それが表示されるまとまり
+_GROUPS = {
+  'button1': None,
+  'button2': 'menu',
+  'select1': 'dialog',
+  'option1': 'popup',
+  'select2': 'dialog',
+  'option2': 'popup',
+  'toggle1': 'dialog',
+  'toggle2': 'dialog',
+  'submit': 'dialog',
+}
+
+# notion2html.RECORD_API_PATH と同じ
+RECORD_API_PATH = '/api/v3/syncRecordValues'
+# notion_http.ENQUEUE_API_PATH, TASKS_API_PATH と同じ
+ENQUEUE_API_PATH = '/api/v3/enqueueTask'
+TASKS_API_PATH = '/api/v3/getTasks'
+
+_SCRIPT = '''
+const show = (group, on) => document.querySelectorAll(`[data-group="${group}"]`)
+  .forEach(el => { el.style.display = on ? '' : 'none'; });
+const dropped = new Set(DROPPED_CLICKS);
+document.addEventListener('click', ev => {
+  const el = ev.target.closest('[data-roles]');
+  if (!el) return;
+  const roles = el.dataset.roles.split(' ');
+  // 開いてから最初のクリックを取りこぼす（Notionの画面がまだ反応しないときのつもり）
+  const drop = roles.find(role => dropped.has(role));
+  if (drop) { dropped.delete(drop); return; }
+  if (roles.includes('button1')) show('menu', true);
+  if (roles.includes('button2')) { show('menu', false); show('dialog', true); }
+  if (roles.includes('select1') || roles.includes('select2')) show('popup', true);
+  if (roles.includes('option1') || roles.includes('option2')) show('popup', false);
+  if (roles.includes('submit')) { show('dialog', false); location.href = EXPORT_URL; }
+});
+'''
+
+class _Node():
+  """代役ページのDOMの要素"""
+
+  def __init__(self, tag: str = 'div'):
+    self.tag = tag
+    self.id = None
+    self.classes = []
+    self.attrs = {}
+    self.children = []
+    self.roles = []
+
+  def matches(self, tag: str, id: str, classes: list) -> bool:
+    return self.tag == tag and (id is None or self.id == id) and all(c in self.classes for c in classes)
+
+  def merge(self, tag: str, id: str, classes: list, attrs: dict) -> None:
+    self.tag = tag
+    self.id = id or self.id
+    self.classes += [c for c in classes if c not in self.classes]
+    self.attrs.update(attrs)
+
+  def render(self, texts: dict, toggle1_enabled: bool) -> str:
+    attrs = dict(self.attrs)
+    if self.id: attrs['id'] = self.id
+    if self.classes: attrs['class'] = ' '.join(self.classes)
+    if self.roles:
+      attrs['data-roles'] = ' '.join(self.roles)
+      group = _GROUPS.get(self.roles[0])
+      if group:
+        attrs['data-group'] = group
+        attrs['style'] = 'display:none'
+      if 'toggle1' in self.roles and not toggle1_enabled:
+        attrs['disabled'] = 'disabled'
+    attr_str = ''.join(f' {k}="{v}"' for k, v in attrs.items())
+    if self.tag == 'input':
+      return f'<input{attr_str}>'
+    inner = ''.join(child.render(texts, toggle1_enabled) for child in self.children)
+    if self.roles:
+      inner += ' / '.join(texts[role] for role in self.roles)
+    return f'<{self.tag}{attr_str}>{inner}</{self.tag}>'
+
+def _parse_step(step: str):
+  """「div.a.b:nth-child(2)」のようなセレクタの1段を分解する"""
+  tag = re.match(r'[a-z]*', step).group(0) or 'div'
+  id = re.search(r'#([\w-]+)', step)
+  classes = re.findall(r'\.([\w-]+)', step)
+  nth = re.search(r':nth-child\((\d+)\)', step)
+  attrs = dict(re.findall(r'\[(\w+)=(\w+)\]', step))
+  return tag, (id.group(1) if id else None), classes, (int(nth.group(1)) if nth else None), attrs
+
+def build_dom(selectors: list) -> _Node:
+  """すべてのセレクタがその名前の要素に（文書順で最初に）当たるようなDOMをつくる"""
+  root = None
+  for selector in selectors:
+    steps = selector.content.split(' > ')
+    tag, id, classes, nth, attrs = _parse_step(steps[0])
+    if root is None:
+      root = _Node(tag)
+      root.merge(tag, id, classes, attrs)
+    node = root
+    for step in steps[1:]:
+      tag, id, classes, nth, attrs = _parse_step(step)
+      if nth is not None:
+        # nth-child に合わせて、手前を空のdivで埋める
+        while len(node.children) < nth:
+          node.children.append(_Node())
+        child = node.children[nth-1]
+      else:
+        child = next((c for c in node.children if c.matches(tag, id, classes)), None)
+        if child is None:
+          child = _Node(tag)
+          node.children.append(child)
+      child.merge(tag, id, classes, attrs)
+      node = child
+    node.roles.append(selector.name)
+  return root
+
+def quiz_html(title: str, n_toggles: int = 5) -> str:
+  """Notionが書き出すのと同じ形の、一問一答ページのHTMLを返す"""
+  rows = ''.join(
+    f'<details open=""><summary>問題{n}　　答え{n}</summary><p>解説{n}</p></details>'
+    for n in range(1, n_toggles+1)
+  )
+  return (
+    f'<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"/><title>{title}</title>'
+    f'<style>body {{ margin: 0; }}</style></head><body><article class="page sans"><header><h1 class="page-title">{title}</h1></header>'
+    f'<div class="page-body"><div class="indented">{rows}</div></div></article></body></html>'
+  )
+
+class NotionStandin():
+  """Notionの代役サーバー
+
+  add_pageでページを登録し、返ってきたURLをNotionのURLのかわりに使う。
+  export_delay_secondはエクスポートボタンを押してからZIPが返ってくるまでの秒数（Notion側の処理時間のつもり）。
+  toggle1_enabled=True にすると「サブページのフォルダーを作成」が有効になり、トグル2も押される。
+
+  わざと失敗させるには:
+    dropped_clicks       ページを開くたびに、これらのセレクタの名前の要素への最初のクリックを無視する
+    export_failure_rate  エクスポートがこの確率で500を返す（seedで再現できる）
+    break_page(url)      そのページのエクスポートはいつも500を返す
+  （エクスポートのタスクのAPIでは、500のかわりにタスクが失敗する）
+
+  tokenを指定すると、APIとタスクのZIPはクッキー token_v2 がそれと同じときだけ応じる（401）。
+  connections は受けた接続の数、api_requests はAPIのパスごとの呼ばれた回数。
+  """
+
+  def __init__(self, selectors: list = None, export_delay_second: float = 1., toggle1_enabled: bool = False,
+               dropped_clicks: list = (), export_failure_rate: float = 0., seed: int = None, token: str = None):
+    if selectors is None:
+      from notion2html import SELECTORS as selectors
+    self.selectors = selectors
+    self.export_delay_second = export_delay_second
+    self.toggle1_enabled = toggle1_enabled
+    self.dropped_clicks = list(dropped_clicks)
+    self.export_failure_rate = export_failure_rate
+    self.__random = random.Random(seed)
+    self.token = token
+    self.connections = 0
+    self.api_requests = {}
+    # タスクID -> (ページID, 終わる時刻, 失敗させるか)
+    self.tasks = {}
+    self.__lock = threading.Lock()
+    # ページID -> (タイトル, HTML)
+    self.pages = {}
+    # ページID -> 最終更新時刻（エポックからのミリ秒）
+    self.last_edited = {}
+    # ページIDごとのエクスポートされた回数
+    self.export_counts = {}
+    # ページIDごとのエクスポートに失敗させた回数
+    self.export_failures = {}
+    # いつもエクスポートに失敗させるページID
+    self.broken = set()
+    self.__dom = build_dom(selectors)
+    self.__texts = {selector.name: selector.description for selector in selectors}
+    self.__server = None
+    self.__thread = None
+
+  @property
+  def base_url(self) -> str:
+    host, port = self.__server.server_address[:2]
+    return f'http://{host}:{port}'
+
+  def add_page(self, title: str, html: str = None) -> str:
+    """ページを登録してそのURLを返す"""
+    page_id = uuid.uuid4().hex
+    self.pages[page_id] = (title, html if html is not None else quiz_html(title))
+    self.last_edited[page_id] = int(time.time() * 1000)
+    return f'{self.base_url}/{quote(title.replace(" ", "-"))}-{page_id}'
+
+  def edit_page(self, url: str, html: str = None) -> None:
+    """ページを更新したことにする（最終更新時刻を進め、htmlを指定すれば中身も変える）"""
+    page_id = url[-32:]
+    if html is not None:
+      self.pages[page_id] = (self.pages[page_id][0], html)
+    self.last_edited[page_id] = max(int(time.time() * 1000), self.last_edited[page_id] + 1)
+
+  def break_page(self, url: str, broken: bool = True) -> None:
+    """ページのエクスポートをいつも失敗させる（broken=Falseで元に戻す）"""
+    (self.broken.add if broken else self.broken.discard)(url[-32:])
+
+  def export_fails(self, page_id: str) -> bool:
+    """このエクスポートを失敗させるかどうか"""
+    fails = page_id in self.broken or self.__random.random() < self.export_failure_rate
+    if fails:
+      self.export_failures[page_id] = self.export_failures.get(page_id, 0) + 1
+    return fails
+
+  def count_connection(self) -> None:
+    with self.__lock:
+      self.connections += 1
+
+  def count_api_request(self, path: str) -> None:
+    with self.__lock:
+      self.api_requests[path] = self.api_requests.get(path, 0) + 1
+
+  def enqueue_task(self, request: dict) -> dict:
+    """NotionのenqueueTaskと同じ形で、エクスポートのタスクを受け付ける（export_delay_second後に終わる）"""
+    page_id = request['task']['request']['block']['id'].replace('-', '')
+    if page_id not in self.pages:
+      return None
+    task_id = str(uuid.uuid4())
+    with self.__lock:
+      self.tasks[task_id] = (page_id, time.monotonic() + self.export_delay_second, self.export_fails(page_id))
+    return {'taskId': task_id}
+
+  def task_results(self, request: dict) -> dict:
+    """NotionのgetTasksと同じ形で、タスクの状態を返す"""
+    results = []
+    for task_id in request.get('taskIds', []):
+      if task_id not in self.tasks: continue
+      page_id, ready_at, fails = self.tasks[task_id]
+      result = {'id': task_id, 'eventName': 'exportBlock'}
+      if time.monotonic() < ready_at:
+        result.update(state='in_progress', status={'type': 'progress', 'pagesExported': 0})
+      elif fails:
+        result.update(state='failure', error='Export failed.')
+      else:
+        result.update(state='success', status={'type': 'complete', 'pagesExported': 1,
+                                               'exportURL': f'{self.base_url}/exports/{task_id}.zip'})
+      results.append(result)
+    return {'results': results}
+
+  def record_values(self, request: dict) -> dict:
+    """NotionのsyncRecordValuesと同じ形で、ページの最終更新時刻を返す"""
+    blocks = {}
+    for req in request.get('requests', []):
+      dashed = req['pointer']['id']
+      page_id = dashed.replace('-', '')
+      if page_id in self.pages:
+        blocks[dashed] = {'value': {'value': {'id': dashed, 'type': 'page', 'last_edited_time': self.last_edited[page_id]}}}
+    return {'recordMap': {'block': blocks}}
+
+  def page_html(self, page_id: str) -> str:
+    """エクスポートメニューのあるページ"""
+    title = self.pages[page_id][0]
+    body = self.__dom.render(self.__texts, self.toggle1_enabled)
+    return (
+      f'<html><head><meta charset="utf-8"><title>{title}</title></head><body>{body}'
+      f'<script>const EXPORT_URL = {json.dumps(f"/export/{page_id}.zip")};'
+      f'const DROPPED_CLICKS = {json.dumps(self.dropped_clicks)};{_SCRIPT}</script></body></html>'
+    )
+
+  def export_zip(self, page_id: str) -> bytes:
+    """Notionのエクスポートと同じ形のZIP"""
+    title, html = self.pages[page_id]
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+      zf.writestr(f'{title} {page_id}.html', html)
+    return buf.getvalue()
+
+  def start(self) -> 'NotionStandin':
+    standin = self
+
+    class Handler(BaseHTTPRequestHandler):
+      # keep-aliveで接続を使い回せるように
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, *args):
+        pass
+
+      def setup(self):
+        super().setup()
+        standin.count_connection()
+
+      def signed_in(self) -> bool:
+        if standin.token is None: return True
+        cookies = dict(pair.split('=', 1) for pair in (self.headers.get('Cookie') or '').split('; ') if '=' in pair)
+        return cookies.get('token_v2') == standin.token
+
+      def do_GET(self):
+        m = re.fullmatch(r'/exports/([0-9a-f-]{36})\.zip', self.path)
+        if m and m.group(1) in standin.tasks:
+          if not self.signed_in(): return self.send_error(401)
+          page_id = standin.tasks[m.group(1)][0]
+          standin.export_counts[page_id] = standin.export_counts.get(page_id, 0) + 1
+          return self.reply(standin.export_zip(page_id), 'application/zip')
+        m = re.fullmatch(r'/export/([0-9a-f]{32})\.zip', self.path)
+        if m and m.group(1) in standin.pages:
+          time.sleep(standin.export_delay_second)
+          if standin.export_fails(m.group(1)):
+            return self.send_error(500)
+          standin.export_counts[m.group(1)] = standin.export_counts.get(m.group(1), 0) + 1
+          return self.reply(standin.export_zip(m.group(1)), 'application/zip',
+                            {'Content-Disposition': f'attachment; filename="Export-{uuid.uuid4()}.zip"'})
+        m = re.fullmatch(r'/.*-([0-9a-f]{32})', self.path)
+        if m and m.group(1) in standin.pages:
+          return self.reply(standin.page_html(m.group(1)).encode('utf-8'), 'text/html; charset=utf-8')
+        if self.path == '/':
+          return self.reply(b'<html><body>Notion stand-in</body></html>', 'text/html; charset=utf-8')
+        self.send_error(404)
+
+      def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        standin.count_api_request(self.path)
+        apis = {RECORD_API_PATH: standin.record_values, ENQUEUE_API_PATH: standin.enqueue_task,
+                TASKS_API_PATH: standin.task_results}
+        if self.path not in apis:
+          return self.send_error(404)
+        if self.path != RECORD_API_PATH and not self.signed_in():
+          return self.send_error(401)
+        response = apis[self.path](request)
+        if response is None:
+          return self.send_error(400)
+        self.reply(json.dumps(response).encode('utf-8'), 'application/json')
+
+      def reply(self, body: bytes, content_type: str, headers: dict = {}):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+          self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+    self.__thread.start()
+    return self
+
+  def stop(self) -> None:
+    self.__server.shutdown()
+    self.__server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+if __name__ == '__main__':
+  # 代役サーバーを立てて、そこから同時にダウンロードし、できたHTMLを印刷してみる
+  # ダウンロードも印刷も、使い回すブラウザー（browser.py）の別々のタブで行う。--own-browserなら自分で起動する
+  # --flakyなら、クリックの取りこぼしとエクスポートの失敗を混ぜ、1ページはいつも失敗させる
+  import sys
+  from mylib.path import TempDirPath
+  from notion2html import NotionHtmlDownloader
+  from html2pdf import DevToolsPrinter
+  from retry import DeadLetters
+  shared = '--own-browser' not in sys.argv
+  flaky = '--flaky' in sys.argv
+  dest = TempDirPath()
+  faults = {'dropped_clicks': ['button2', 'select1'], 'export_failure_rate': 0.3, 'seed': 0} if flaky else {}
+  with NotionStandin(**faults) as standin:
+    pages = [(f'Page {n}', standin.add_page(f'Page {n}')) for n in range(6)]
+    if flaky: standin.break_page(pages[-1][1])
+    started = time.perf_counter()
+    # 代役にはログインが要らないので、新しいプロファイルでもログインを求めない（画面のないLinuxでも動く）
+    loader = NotionHtmlDownloader(dest, use_profile=False, shared=shared)
+    print(f'Browser ready in {time.perf_counter()-started:.1f} s')
+    started = time.perf_counter()
+    failed = loader.download_many(pages, tabs=3)
+    print(f'{len(pages)-len(failed)}/{len(pages)} pages in {time.perf_counter()-started:.1f} s: {sorted(p.name for p in dest.iterdir())}')
+    if flaky:
+      dead = DeadLetters(dest / 'dead_letters.json')
+      for title, record in loader.failures.items():
+        dead.add(title, **record)
+      dead.save()
+      print(f'Full-page reloads: {loader.reloads}, export failures: {sum(standin.export_failures.values())}, '
+            f'dead letters: {dead.keys()}')
+    del loader
+    if shared:
+      printer = DevToolsPrinter(dest)
+      html = next(dest.glob('*.html'))
+      printer.print(html)
+      print(f'Printed {html.stem}.pdf ({(dest / f"{html.stem}.pdf").stat().st_size} B)')
+      del printer
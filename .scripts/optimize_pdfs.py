@@ -0,0 +1,157 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""見開きのPDFを小さくする（Step 4 のあと）
+
+Chromeの印刷やpdf2to1のつなぎ直しでできたPDFには、同じフォントや画像がいくつも入っていたり、
+圧縮されていないストリームや、どこからも使われていないオブジェクトが残っていたりする。
+ここではページから辿れるものだけをStreamingPdfWriterで写し直すことで、
+  * 中身がまったく同じオブジェクト（フォント・画像・XObjectなど）を1つにまとめ、
+  * ストリームを COMPRESS_LEVEL で圧縮し直し、
+  * どこからも使われていないオブジェクトを捨てる。
+linearize=True なら、さらに1ページ目からすぐ表示できるように並べ直す（pikepdfが要る）。
+
+  python optimize_pdfs.py [--linearize] [--processes N]
+"""
+
+# from mylib import logging
+import mymodule
+import runlog
+import artifacts
+# !conda install -c conda-forge pypdf2
+import PyPDF2
+import pdfstream
+from pdfstream import StreamingPdfWriter
+from tqdm import tqdm
+from pathlib import Path
+from collections import namedtuple
+from multiprocessing import Pool
+import argparse
+import traceback
+import importlib.util
+import os
+
+# ストリームを圧縮し直すときのレベル（zlib）
+COMPRESS_LEVEL = 9
+
+# 1ファイルぶんの結果（before・afterはバイト数。errorは失敗したときの説明）
+Optimized = namedtuple('Optimized', 'path before after error')
+
+def rewrite(src: Path, dest: Path, linearize: bool = False) -> None:
+  """srcのページから辿れるものだけを写し直して、destに書き出す"""
+  reader = PyPDF2.PdfReader(src.as_posix(), strict=False)
+  with open(dest.as_posix(), mode='wb') as f:
+    writer = StreamingPdfWriter(f, compress_level=COMPRESS_LEVEL)
+    writer.add_pdf(reader)
+    writer.close()
+  if linearize: linearize_pdf(dest)
+
+def can_linearize() -> bool:
+  """並べ直しに使うpikepdfが入っているか"""
+  return importlib.util.find_spec('pikepdf') is not None
+
+def linearize_pdf(path: Path) -> None:
+  """1ページ目からすぐ表示できるように並べ直す（その場で置き換える）"""
+  # 並べ直すときにだけ読み込む
+  # !conda install -c conda-forge pikepdf
+  import pikepdf
+  temp = path.with_name(f'{path.name}.linearized')
+  with pikepdf.open(path) as pdf:
+    pdf.save(temp, linearize=True)
+  os.replace(temp, path)
+
+def optimize_key(cache: artifacts.ArtifactCache, path: Path, linearize: bool) -> str:
+  """小さくしたPDFを置き場から引くキー（もとのPDFの中身と、小さくするやり方から決まる）"""
+  settings = {'compress_level': COMPRESS_LEVEL, 'linearize': linearize}
+  return cache.key('optimize', [path], settings, scripts=[__file__, pdfstream.__file__])
+
+def optimize(job: tuple) -> Optimized:
+  """PDFを1つ小さくして置き換える（プロセスプールの各プロセスで実行される）
+
+  jobは (PDFのパス, linearize, cache)。cacheがNoneでなければ、前に同じPDFを小さくしたものを置き場から取り出し、
+  なければ小さくして置き場にしまう。小さくならなければ（linearize=Trueでなければ）もとのままにする。
+  失敗しても例外は投げず、もとのPDFは残したまま、エラーの説明を入れて返す。
+  """
+  path, linearize, cache = job
+  before = path.stat().st_size
+  temp = path.with_name(f'{path.name}.optimized')
+  try:
+    key = None
+    if cache is not None:
+      key = optimize_key(cache, path, linearize)
+      if cache.fetch(key, path) is not None:
+        return Optimized(path, before, path.stat().st_size, None)
+    with runlog.timed('optimize', 'linearize' if linearize else 'rewrite', page=path.stem):
+      rewrite(path, temp, linearize=linearize)
+    if linearize or temp.stat().st_size < before:
+      # 置き場の見開きとハードリンクでつながっているかもしれないので、上書きせずに置き換える
+      os.replace(temp, path)
+    else:
+      temp.unlink()
+    after = path.stat().st_size
+    runlog.record('optimize', 'saved', page=path.stem, bytes=before - after)
+    if cache is not None:
+      cache.store(key, path)
+  except Exception:
+    temp.unlink(missing_ok=True)
+    return Optimized(path, before, before, traceback.format_exc())
+  return Optimized(path, before, after, None)
+
+def describe(result: Optimized) -> str:
+  """1ファイルぶんの結果の説明"""
+  if result.error is not None:
+    return f'Failed to optimize "{result.path.name}":\n{result.error}'
+  saved = result.before - result.after
+  return (f'{result.path.name}: {result.before:,} -> {result.after:,} B '
+          f'(saved {saved:,} B, {saved / result.before if result.before else 0:.1%})')
+
+def optimize_all(paths: list, linearize: bool = False, cache: artifacts.ArtifactCache = None, imap=map) -> list:
+  """PDFをまとめて小さくし、ファイルごとに減ったバイト数を知らせて、結果（Optimized）のリストを返す
+
+  imapにはプロセスプールのimap_unorderedなどを渡す（省略するとこのプロセスだけで処理）。
+  """
+  if linearize and not can_linearize():
+    raise ValueError('Linearizing needs pikepdf (conda install -c conda-forge pikepdf).')
+  jobs = [(path, linearize, cache) for path in paths]
+  bar = tqdm(total=len(jobs))
+  bar.set_description('Optimizing PDF')
+  results = []
+  for result in imap(optimize, jobs):
+    results.append(result)
+    bar.write(describe(result))
+    # if result.error is not None: logging.error(describe(result))
+    bar.update(1)
+  bar.close()
+  before = sum(result.before for result in results)
+  after = sum(result.after for result in results)
+  if results:
+    print(f'Optimized {len(results)} PDFs: {before:,} -> {after:,} B (saved {before - after:,} B)')
+  return results
+
+def main(processes: int = None, linearize: bool = False, cache: bool = True) -> list:
+  """対象のページの見開きのPDFを小さくする
+
+  processesはプロセスプールの大きさ（Noneならコア数、1ならこのプロセスだけで処理）。
+  小さくできなかったページのタイトルのリストを返す。
+  """
+  paths = [page.combined for page in mymodule.stage_status('optimize').ready]
+  store = artifacts.ArtifactCache() if cache else None
+  if processes is None and paths:
+    processes = mymodule.pool_size(len(paths), 0)
+  if processes == 1 or len(paths) <= 1:
+    results = optimize_all(paths, linearize=linearize, cache=store)
+  else:
+    with Pool(processes=processes) as pool:
+      results = optimize_all(paths, linearize=linearize, cache=store, imap=pool.imap_unordered)
+  return [result.path.stem for result in results if result.error is not None]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='見開きのPDFを小さくする')
+  parser.add_argument('--linearize', action='store_true', help='1ページ目からすぐ表示できるように並べ直す（pikepdfが要る）')
+  parser.add_argument('--processes', type=int, default=None,
+                      help='プロセスプールの大きさ（省略するとコア数。1ならプールを使わない）')
+  parser.add_argument('--no-cache', action='store_true', help='前と同じPDFでも置き場から取り出さずに小さくし直す')
+  args = parser.parse_args()
+  runlog.start('optimize_pdfs')
+  main(processes=args.processes, linearize=args.linearize, cache=not args.no_cache)
+  runlog.report()
@@ -0,0 +1,263 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""PDFを少しずつファイルに書き出していくライター
+
+PyPDF2のPdfWriterは全ページを溜め込んでから最後に書き出すので、ページが増えるほどメモリを食う。
+こちらはオブジェクトをつくったそばからファイルに書き、覚えておくのはオブジェクトの位置と対応表だけにする。
+読み込んだPDFのオブジェクトはストリームの中身を展開せずにそのまま写し、
+中身がまったく同じオブジェクト（別のPDFにある同じフォントなど）は1つにまとめる。
+add_pdfで読み込んだPDFのページを丸ごと加えていけば、何百ものPDFを1冊にまとめても、メモリには1つぶんしか載らない。
+"""
+
+# !conda install -c conda-forge pypdf2
+from PyPDF2 import generic
+import hashlib
+import io
+import zlib
+
+def _number(x: float) -> bytes:
+  """PDFに書く数値"""
+  return (f'{x:.6f}'.rstrip('0').rstrip('.') if isinstance(x, float) else str(x)).encode()
+
+def _text(s: str) -> bytes:
+  """PDFに書く文字列（しおりの題名など。日本語も書けるようにUTF-16BEで）"""
+  return b'<' + ('\ufeff' + s).encode('utf-16-be').hex().upper().encode() + b'>'
+
+# ページが自分で持っていなければ、ページツリーの親から引き継ぐ属性
+_INHERITABLE = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+class StreamingPdfWriter():
+  """オブジェクトをつくったそばからファイルに書き出すPDFライター
+
+    with open(path, 'wb') as f:
+      writer = StreamingPdfWriter(f)
+      writer.add_page(...)
+      writer.close()
+  """
+
+  def __init__(self, f, compress_level: int = None):
+    """fにはバイナリモードで開いたファイルを指定
+
+    compress_levelを指定すると、読み込んだPDFから写すストリームのうち、圧縮されていないものと
+    FlateDecodeだけで圧縮されたものを、そのレベル（zlibの0〜9）で圧縮し直す（小さくなるときだけ）。
+    """
+    self.__f = f
+    self.__compress_level = compress_level
+    self.__offsets = {}
+    self.__next_num = 1
+    # 読み込んだPDFのオブジェクト (PDFのid, 番号, 世代) -> 書き出したオブジェクトの番号
+    self.__copied = {}
+    # 写している途中のオブジェクト（循環参照のため）-> 先に決めた番号
+    self.__in_progress = {}
+    # 書き出したオブジェクトの中身のハッシュ -> 番号
+    self.__by_digest = {}
+    self.__pages_num = self.reserve()
+    self.__page_nums = []
+    # しおり [(題名, ページの番号)]
+    self.__outline = []
+    f.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+  def reserve(self) -> int:
+    """オブジェクトの番号を1つ確保する"""
+    num = self.__next_num
+    self.__next_num += 1
+    return num
+
+  def write_object(self, num: int, data: bytes) -> int:
+    """確保した番号でオブジェクトを書き出す"""
+    self.__offsets[num] = self.__f.tell()
+    self.__f.write(b'%d 0 obj\n' % num + data + b'\nendobj\n')
+    return num
+
+  def add_object(self, data: bytes, share: bool = True) -> int:
+    """オブジェクトを書き出して番号を返す。share=Trueなら中身が同じものは1つにまとめる"""
+    if share:
+      digest = hashlib.sha1(data).digest()
+      if digest in self.__by_digest:
+        return self.__by_digest[digest]
+    num = self.write_object(self.reserve(), data)
+    if share:
+      self.__by_digest[digest] = num
+    return num
+
+  @staticmethod
+  def stream(dictionary: bytes, data: bytes) -> bytes:
+    """ストリームオブジェクトの中身。dictionaryは /Length を除いた辞書の中身"""
+    return b'<<' + dictionary + b' /Length %d>>\nstream\n' % len(data) + data + b'\nendstream'
+
+  def copy(self, obj) -> bytes:
+    """読み込んだPDFのオブジェクトを、このPDFで使える形（参照先も写したもの）にして返す"""
+    if isinstance(obj, generic.IndirectObject):
+      return b'%d 0 R' % self.__copy_indirect(obj)
+    if isinstance(obj, generic.StreamObject):
+      # ストリームは必ず間接オブジェクトにする
+      return b'%d 0 R' % self.add_object(self.__stream_data(obj))
+    if isinstance(obj, generic.DictionaryObject):
+      return b'<<' + b''.join(self.copy(k) + b' ' + self.copy(v) for k, v in obj.items()) + b'>>'
+    if isinstance(obj, generic.ArrayObject):
+      return b'[' + b' '.join(self.copy(v) for v in obj) + b']'
+    buf = io.BytesIO()
+    obj.write_to_stream(buf, None)
+    return buf.getvalue()
+
+  def __stream_data(self, obj) -> bytes:
+    """ストリームを、中身を展開せずにそのまま写す（compress_levelを指定していれば圧縮し直す）"""
+    data = obj._data
+    skip = ('/Length',)
+    if self.__compress_level is not None:
+      recompressed = self.__recompress(obj)
+      if recompressed is not None and len(recompressed) < len(data):
+        data = recompressed
+        skip = ('/Length', '/Filter')
+    dictionary = b''.join(self.copy(k) + b' ' + self.copy(v) for k, v in obj.items() if k not in skip)
+    if skip != ('/Length',):
+      dictionary += b' /Filter /FlateDecode'
+    return self.stream(dictionary, data)
+
+  def __recompress(self, obj) -> bytes:
+    """圧縮されていないか、FlateDecodeだけで（予測子なしに）圧縮されたストリームを圧縮し直したもの。できなければNone"""
+    if '/DecodeParms' in obj: return None
+    filters = obj.get('/Filter')
+    if isinstance(filters, generic.ArrayObject) and len(filters) == 1:
+      filters = filters[0]
+    if filters is None:
+      raw = obj._data
+    elif filters == '/FlateDecode':
+      try:
+        raw = zlib.decompress(obj._data)
+      except zlib.error:
+        return None
+    else:
+      return None
+    return zlib.compress(raw, self.__compress_level)
+
+  def __copy_indirect(self, ref) -> int:
+    key = (id(ref.pdf), ref.idnum, ref.generation)
+    if key in self.__copied:
+      return self.__copied[key]
+    if key in self.__in_progress:
+      # 循環参照。番号だけ先に決めておく
+      if self.__in_progress[key] is None:
+        self.__in_progress[key] = self.reserve()
+      return self.__in_progress[key]
+    self.__in_progress[key] = None
+    obj = ref.get_object()
+    if isinstance(obj, generic.StreamObject):
+      data = self.__stream_data(obj)
+    else:
+      data = self.copy(obj)
+    num = self.__in_progress.pop(key)
+    if num is None:
+      num = self.add_object(data)
+    else:
+      self.write_object(num, data)
+    self.__copied[key] = num
+    return num
+
+  def form_xobject(self, page) -> int:
+    """読み込んだPDFのページを、そのまま貼り付けられるフォームXObjectにして番号を返す
+
+    ページの内容ストリームは展開せずに写し、リソース（フォントなど）は参照を写すだけにする。
+    """
+    box = page.mediabox
+    resources = page.get('/Resources')
+    dictionary = b'/Type /XObject /Subtype /Form /BBox [%s]' % b' '.join(
+      _number(float(v)) for v in (box.left, box.bottom, box.right, box.top))
+    if resources is not None:
+      dictionary += b' /Resources ' + self.copy(resources)
+    contents = page.get('/Contents')
+    contents = contents.get_object() if contents is not None else None
+    if isinstance(contents, generic.StreamObject):
+      # ストリームが1つならそのまま（圧縮されたまま）使う
+      for key in ('/Filter', '/DecodeParms'):
+        if key in contents:
+          dictionary += b' ' + self.copy(generic.NameObject(key)) + b' ' + self.copy(contents[key])
+      data = contents._data
+    else:
+      # 複数のストリームに分かれていればつなげる
+      data = b'\n'.join(s.get_object().get_data() for s in (contents or []))
+      dictionary += b' /Filter /FlateDecode'
+      data = zlib.compress(data)
+    return self.add_object(self.stream(dictionary, data))
+
+  def add_page(self, width: float, height: float, content: bytes, xobjects: dict) -> int:
+    """ページを1枚加える
+
+    contentは圧縮前の内容ストリーム、xobjectsは {名前: XObjectの番号}。
+    """
+    content_num = self.add_object(self.stream(b'/Filter /FlateDecode', zlib.compress(content)), share=False)
+    resources = b'<</XObject <<' + b''.join(b'/%s %d 0 R' % (name.encode(), num) for name, num in xobjects.items()) + b'>>>>'
+    num = self.add_object(
+      b'<</Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] /Resources %s /Contents %d 0 R>>'
+      % (self.__pages_num, _number(width), _number(height), resources, content_num), share=False)
+    self.__page_nums.append(num)
+    return num
+
+  def add_pdf(self, reader) -> int:
+    """読み込んだPDFの全ページをそのまま加え、最初のページの（このPDFでの）オブジェクトの番号を返す
+
+    ページの番号を先に決めておくので、注釈などからほかのページへの参照があっても、ページツリーごと写すことはない。
+    加え終わったら、そのPDFのオブジェクトの対応表は捨てる（中身のハッシュは残すので、次のPDFとも共通のものは1つにまとめる）。
+    """
+    pages = list(reader.pages)
+    nums = [self.reserve() for _ in pages]
+    source = id(reader)
+    for page, num in zip(pages, nums):
+      ref = page.indirect_ref
+      self.__copied[(id(ref.pdf), ref.idnum, ref.generation)] = num
+    for page, num in zip(pages, nums):
+      self.__write_page(page, num)
+    self.__page_nums.extend(nums)
+    # 読み終わったPDFのidは使い回されるかもしれないので、対応表に残しておかない
+    self.__copied = {key: num for key, num in self.__copied.items() if key[0] != source}
+    return nums[0] if nums else None
+
+  def __write_page(self, page, num: int) -> None:
+    """読み込んだPDFのページを、このPDFのページツリーにつないで書き出す"""
+    entries = {key: value for key, value in page.items() if key not in ('/Parent', '/Type')}
+    parent = page.get('/Parent')
+    while parent is not None and not all(key in entries for key in _INHERITABLE):
+      parent = parent.get_object()
+      for key in _INHERITABLE:
+        if key not in entries and key in parent:
+          entries[key] = parent[key]
+      parent = parent.get('/Parent')
+    body = b''.join(b' ' + self.copy(generic.NameObject(key)) + b' ' + self.copy(value) for key, value in entries.items())
+    self.write_object(num, b'<</Type /Page /Parent %d 0 R%s>>' % (self.__pages_num, body))
+
+  def add_outline(self, title: str, page_num: int) -> None:
+    """しおりを1つ加える（page_numはadd_pageやadd_pdfが返したページの番号）"""
+    self.__outline.append((title, page_num))
+
+  @property
+  def page_count(self) -> int:
+    return len(self.__page_nums)
+
+  def close(self) -> None:
+    """ページツリー・カタログ・相互参照表を書いて、PDFを仕上げる"""
+    kids = b' '.join(b'%d 0 R' % num for num in self.__page_nums)
+    self.write_object(self.__pages_num, b'<</Type /Pages /Kids [%s] /Count %d>>' % (kids, len(self.__page_nums)))
+    catalog = b'/Type /Catalog /Pages %d 0 R' % self.__pages_num
+    if self.__outline:
+      catalog += b' /Outlines %d 0 R /PageMode /UseOutlines' % self.__write_outline()
+    root_num = self.add_object(b'<<' + catalog + b'>>', share=False)
+    xref_offset = self.__f.tell()
+    size = self.__next_num
+    lines = [b'xref\n0 %d\n' % size, b'0000000000 65535 f \n']
+    for num in range(1, size):
+      lines.append(b'%010d 00000 n \n' % self.__offsets[num])
+    self.__f.write(b''.join(lines))
+    self.__f.write(b'trailer\n<</Size %d /Root %d 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (size, root_num, xref_offset))
+
+  def __write_outline(self) -> int:
+    """しおり（1段だけ）を書き出して、その根の番号を返す"""
+    root = self.reserve()
+    items = [self.reserve() for _ in self.__outline]
+    for i, ((title, page_num), num) in enumerate(zip(self.__outline, items)):
+      links = b''
+      if i > 0: links += b' /Prev %d 0 R' % items[i-1]
+      if i < len(items) - 1: links += b' /Next %d 0 R' % items[i+1]
+      self.write_object(num, b'<</Title %s /Parent %d 0 R%s /Dest [%d 0 R /Fit]>>' % (_text(title), root, links, page_num))
+    return self.write_object(root, b'<</Type /Outlines /First %d 0 R /Last %d 0 R /Count %d>>'
+                             % (items[0], items[-1], len(items)))
@@ -0,0 +1,121 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""ページを段から段へ流していく流れ作業
+
+各段はそれぞれの数のスレッドで動き、段と段のあいだは大きさに上限のあるキューでつなぐ。
+前の段が終わったページから次の段に進むので、全ページのダウンロードを待たずに編集や印刷が始まる。
+キューに上限があるので、速い段が先走って作りかけのものを溜め込みすぎることもない。
+
+  stages = [Stage('reform', lambda: reform), Stage('print', make_printer, workers=2)]
+  result = run(titles, stages)
+"""
+
+import time
+import queue
+import threading
+import traceback
+import runlog
+
+# キューの終わりの印
+_END = object()
+
+class Stage():
+  """流れ作業の1段
+
+  make_workerは各スレッドで最初に1回だけ呼ばれ、1件を処理する関数を返す（ブラウザーなどスレッドごとに持つもの用）。
+  処理する関数は受け取ったものを次の段に渡すものとして返す。例外を投げたものはそこで脱落する。
+  workersはこの段のスレッドの数、maxsizeはこの段の手前のキューの上限（Noneならworkersの2倍）。
+  """
+
+  def __init__(self, name: str, make_worker, workers: int = 1, maxsize: int = None):
+    self.name = name
+    self.make_worker = make_worker
+    self.workers = max(1, workers)
+    self.maxsize = maxsize if maxsize is not None else self.workers * 2
+
+class PipelineResult():
+  """流れ作業の結果"""
+
+  def __init__(self):
+    # 最後の段まで終わったもの
+    self.done = []
+    # (段の名前, もの, エラーの説明)
+    self.failed = []
+    # 始めてから、最初の1件が最後の段まで終わるまでの秒数
+    self.first_done_second = None
+    self.elapsed_second = None
+
+def run(items: list, stages: list, on_done=None, on_failed=None) -> PipelineResult:
+  """itemsを順にstagesへ流し、すべて終わるまで待つ
+
+  on_done(もの)は最後の段まで終わるたびに、on_failed(段の名前, もの, エラーの説明)は脱落するたびに呼ばれる。
+  """
+  result = PipelineResult()
+  lock = threading.Lock()
+  started = time.perf_counter()
+  queues = [queue.Queue(maxsize=stage.maxsize) for stage in stages] + [None]
+  # 段ごとの、まだ動いているスレッドの数
+  running = [stage.workers for stage in stages]
+
+  def finish(item) -> None:
+    with lock:
+      if result.first_done_second is None:
+        result.first_done_second = time.perf_counter() - started
+      result.done.append(item)
+    if on_done is not None: on_done(item)
+
+  def fail(stage: Stage, item, error: str) -> None:
+    with lock:
+      result.failed.append((stage.name, item, error))
+    if on_failed is not None: on_failed(stage.name, item, error)
+
+  def work(n: int) -> None:
+    stage = stages[n]
+    inbox, outbox = queues[n], queues[n+1]
+    try:
+      worker = stage.make_worker()
+    except Exception:
+      worker = None
+      error = traceback.format_exc()
+    try:
+      while True:
+        item = inbox.get()
+        if item is _END: break
+        if worker is None:
+          # 準備に失敗した段には流れてきたものをすべて脱落させる
+          fail(stage, item, error)
+          continue
+        try:
+          with runlog.timed(stage.name, 'stage', page=str(item)):
+            item = worker(item)
+        except Exception:
+          fail(stage, item, traceback.format_exc())
+          continue
+        if outbox is None:
+          finish(item)
+        else:
+          outbox.put(item)
+    finally:
+      # ブラウザーなどはこのスレッドで片付ける
+      del worker
+      with lock:
+        running[n] -= 1
+        last = running[n] == 0
+      # この段の最後のスレッドが、次の段のスレッドの数だけ終わりの印を送る
+      if last and outbox is not None:
+        for _ in range(stages[n+1].workers):
+          outbox.put(_END)
+
+  threads = [threading.Thread(target=work, args=(n,), daemon=True)
+             for n, stage in enumerate(stages) for _ in range(stage.workers)]
+  for thread in threads:
+    thread.start()
+  for item in items:
+    queues[0].put(item)
+  for _ in range(stages[0].workers):
+    queues[0].put(_END)
+  for thread in threads:
+    thread.join()
+  result.elapsed_second = time.perf_counter() - started
+  return result
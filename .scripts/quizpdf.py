@@ -0,0 +1,231 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""すべてのステップをまとめたコマンド
+
+  python quizpdf.py download [--downloader D] [--tabs N] [--force]  Step 1
+  python quizpdf.py reform [--engine E] [--processes N] [--spread]  Step 2
+  python quizpdf.py print [--backend B] [--workers N] [--spread]    Step 3
+  python quizpdf.py combine [--mode M] [--processes N] [--book]     Step 4
+  python quizpdf.py optimize [--linearize] [--processes N]          Step 4 のあと、見開きを小さくする
+  python quizpdf.py all [...]                                       Step 1 から 4 まで
+  python quizpdf.py log [ログファイル]                               実行時間の記録のまとめ
+  python quizpdf.py browser start|status|stop                       使い回すブラウザー
+
+各ステップのモジュール（とSeleniumやBeautifulSoup、PyPDF2など）は、そのステップを実行するときに初めて読み込む。
+たとえば combine だけならブラウザーまわりは読み込まない。
+"""
+
+import argparse
+from datetime import datetime
+
+OWN_BROWSER_HELP = '使い回すブラウザーではなく、起動中のChromeを閉じてふだんのプロファイルで起動する'
+SPREAD_HELP = '問いと答えを左右に並べたHTMLを1回印刷して、見開きのPDFを直接つくる（Step 4 は要らない。devtoolsのみ）'
+NO_CACHE_HELP = '読むファイルが前と同じでも、置き場（.cache/artifacts/）から取り出さずにつくり直す'
+BOOK_HELP = '最後に全ページの見開きを setting.csv の順に1冊（pdf/book.pdf）にまとめる（しおりつき）'
+OPTIMIZE_HELP = 'できた見開きを小さくする（同じフォントや画像をまとめ、圧縮し直し、使われていないものを捨てる）'
+LINEARIZE_HELP = '小さくするときに、1ページ目からすぐ表示できるように並べ直す（pikepdfが要る。--optimize も兼ねる）'
+DOWNLOADER_HELP = '使うダウンローダー（browser, http）。httpならNotionのAPIにまとめてエクスポートを頼む'
+SINCE_HELP = 'この日時（例: 2023-04-01T09:00）以降に更新されたページは必ずダウンロードし直す'
+
+# サブコマンドごとに読み込むモジュール（起動時間の計測用）
+COMMAND_MODULES = {
+  'download': ('notion2html',),
+  'reform': ('reform_html',),
+  'print': ('html2pdf',),
+  'combine': ('combine_pdfs',),
+  'optimize': ('optimize_pdfs',),
+  'all': ('do_all_at_once',),
+  'log': ('runlog',),
+  'browser': ('browser',),
+}
+
+def _check_choice(parser: argparse.ArgumentParser, name: str, value: str, choices) -> None:
+  """選択肢の検証（選択肢を持つモジュールを読み込んだあとで行う）"""
+  if value not in choices:
+    parser.error(f"argument --{name}: invalid choice: '{value}' (choose from {', '.join(map(repr, choices))})")
+
+def _check_linearize(parser: argparse.ArgumentParser, args) -> None:
+  """--linearize を指定したのに、並べ直しに使うpikepdfが入っていなければ知らせる"""
+  import optimize_pdfs
+  if args.linearize and not optimize_pdfs.can_linearize():
+    parser.error('argument --linearize: pikepdf is not installed (conda install -c conda-forge pikepdf)')
+
+def _confirm(message: str, yes: bool) -> bool:
+  if yes: return True
+  from mylib.io import yes_no_input
+  return yes_no_input(message)
+
+def download(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  import notion2html
+  print("I'll download notion documents.")
+  if args.own_browser and not _confirm('May I close Google Chrome windows?', args.yes): return
+  runlog.start('notion2html')
+  _check_choice(parser, 'downloader', args.downloader, notion2html.DOWNLOADERS.keys())
+  notion2html.main(tabs=args.tabs, force=args.force, since=args.since, shared=not args.own_browser,
+                   dead_letters=args.dead_letters, downloader=args.downloader)
+  if args.own_browser: notion2html.NotionHtmlDownloader.recover_chrome()
+  runlog.report()
+
+def reform(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  import reform_html
+  _check_choice(parser, 'engine', args.engine, reform_html.EDITERS.keys())
+  runlog.start('reform_html')
+  reform_html.main(processes=args.processes, force=args.force, engine=args.engine, spread=args.spread)
+  runlog.report()
+
+def print_pdf(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  import html2pdf
+  _check_choice(parser, 'backend', args.backend, html2pdf.PRINTERS.keys())
+  if args.spread and not html2pdf.can_print_spread(args.backend):
+    parser.error(f'argument --spread: the {args.backend} printer cannot print spreads')
+  if not _confirm("I'll convert HTML into PDF. Ready?", args.yes): return
+  runlog.start('html2pdf')
+  html2pdf.main(backend=args.backend, workers=args.workers, spread=args.spread, cache=not args.no_cache)
+  runlog.report()
+
+def combine(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  import combine_pdfs
+  _check_choice(parser, 'mode', args.mode, combine_pdfs.COMPOSERS.keys())
+  _check_linearize(parser, args)
+  runlog.start('combine_pdfs')
+  combine_pdfs.main(mode=args.mode, processes=args.processes, cache=not args.no_cache, book=args.book,
+                    optimize=args.optimize or args.linearize, linearize=args.linearize)
+  runlog.report()
+
+def optimize(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  import optimize_pdfs
+  _check_linearize(parser, args)
+  runlog.start('optimize_pdfs')
+  optimize_pdfs.main(processes=args.processes, linearize=args.linearize, cache=not args.no_cache)
+  runlog.report()
+
+def all_at_once(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  import notion2html
+  import html2pdf
+  import combine_pdfs
+  import do_all_at_once
+  _check_choice(parser, 'downloader', args.downloader, notion2html.DOWNLOADERS.keys())
+  _check_choice(parser, 'backend', args.backend, html2pdf.PRINTERS.keys())
+  _check_choice(parser, 'mode', args.mode, combine_pdfs.COMPOSERS.keys())
+  if args.spread and not html2pdf.can_print_spread(args.backend):
+    parser.error(f'argument --spread: the {args.backend} printer cannot print spreads')
+  _check_linearize(parser, args)
+  if not _confirm("I'll execute Step 1 to 4 all at once. Ready?", args.yes): return
+  runlog.start('do_all_at_once')
+  do_all_at_once.main(serial=args.serial, reform_workers=args.reform_workers, print_workers=args.print_workers,
+                      combine_workers=args.combine_workers, backend=args.backend, mode=args.mode, force=args.force,
+                      since=args.since, shared=not args.own_browser, downloader=args.downloader, spread=args.spread,
+                      cache=not args.no_cache, book=args.book, optimize=args.optimize or args.linearize,
+                      linearize=args.linearize)
+  runlog.report()
+
+def log(parser: argparse.ArgumentParser, args) -> None:
+  import runlog
+  if args.path is not None:
+    runlog.report(args.path)
+  else:
+    logs = sorted(runlog.LOGDIR.glob('run-*.jsonl'))
+    if logs: runlog.report(logs[-1])
+
+def browser(parser: argparse.ArgumentParser, args) -> None:
+  import browser
+  if args.action == 'start':
+    state = browser.start(headless=args.headless or None)
+    print(f'{state["browser"]} on port {state["port"]} (pid {state["pid"]})')
+  elif args.action == 'login':
+    print('logged in' if browser.login() else 'not logged in')
+  elif args.action == 'status':
+    state = browser.status()
+    print('not running' if state is None else f'{state["browser"]} on port {state["port"]} (pid {state["pid"]})')
+  else:
+    print('stopped' if browser.stop() else 'not running')
+
+def make_parser() -> argparse.ArgumentParser:
+  """引数の解析器をつくる（ここではステップのモジュールを読み込まない）"""
+  parser = argparse.ArgumentParser(description='Notionの記事から問題集のPDFをつくる')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  def add_command(name: str, handler, help: str, confirm: bool = False) -> argparse.ArgumentParser:
+    command = commands.add_parser(name, help=help, description=help)
+    command.set_defaults(handler=handler, parser=command)
+    if confirm:
+      command.add_argument('-y', '--yes', action='store_true', help='実行の確認をしない')
+    return command
+
+  command = add_command('download', download, 'Step 1: NotionページのHTMLをダウンロードする', confirm=True)
+  command.add_argument('--tabs', type=int, default=1, help='同時にエクスポートするタブの数')
+  command.add_argument('--force', action='store_true', help='更新されていないページもダウンロードし直す')
+  command.add_argument('--since', type=datetime.fromisoformat, help=SINCE_HELP)
+  command.add_argument('--own-browser', action='store_true', help=OWN_BROWSER_HELP)
+  command.add_argument('--dead-letters', action='store_true', help='前回あきらめたページだけをやり直す')
+  command.add_argument('--downloader', default='browser', help=DOWNLOADER_HELP)
+
+  command = add_command('reform', reform, 'Step 2: HTMLを問い用・答え用に編集する')
+  command.add_argument('--engine', default='soup', help='使う編集屋（soup, stream）')
+  command.add_argument('--processes', type=int, default=None, help='プロセスプールの大きさ（1ならこのプロセスだけで処理）')
+  command.add_argument('--force', action='store_true', help='変わっていないページも編集し直す')
+  command.add_argument('--spread', action='store_true', help=SPREAD_HELP)
+
+  command = add_command('print', print_pdf, 'Step 3: HTMLをPDFにする', confirm=True)
+  command.add_argument('--backend', default='devtools',
+                       help='使うプリンター（devtools, chrome, weasyprint）。devtoolsなら使い回すブラウザーで印刷する')
+  command.add_argument('--workers', type=int, default=1, help='同時に動かすプリンターの数')
+  command.add_argument('--spread', action='store_true', help=SPREAD_HELP)
+  command.add_argument('--no-cache', action='store_true', help=NO_CACHE_HELP)
+
+  command = add_command('combine', combine, 'Step 4: 問いと答えのPDFを見開きにする')
+  command.add_argument('--mode', default='xobject', help='見開きのつくり方（merge, xobject）')
+  command.add_argument('--processes', type=int, default=None,
+                       help='プロセスプールの大きさ（省略するとコア数と空きメモリから決める）')
+  command.add_argument('--no-cache', action='store_true', help=NO_CACHE_HELP)
+  command.add_argument('--book', action='store_true', help=BOOK_HELP)
+  command.add_argument('--optimize', action='store_true', help=OPTIMIZE_HELP)
+  command.add_argument('--linearize', action='store_true', help=LINEARIZE_HELP)
+
+  command = add_command('optimize', optimize, 'Step 4 のあと: 見開きのPDFを小さくする')
+  command.add_argument('--linearize', action='store_true', help=LINEARIZE_HELP)
+  command.add_argument('--processes', type=int, default=None, help='プロセスプールの大きさ（省略するとコア数）')
+  command.add_argument('--no-cache', action='store_true', help=NO_CACHE_HELP)
+
+  command = add_command('all', all_at_once, 'Step 1 から 4 までを通して実行する', confirm=True)
+  command.add_argument('--serial', action='store_true', help='流れ作業にせず、Step 1 から 4 を順に全ページずつ実行する')
+  command.add_argument('--reform-workers', type=int, default=2, help='同時に編集するページの数')
+  command.add_argument('--print-workers', type=int, default=1, help='同時に動かすプリンターの数')
+  command.add_argument('--combine-workers', type=int, default=2, help='同時に見開きにするページの数')
+  command.add_argument('--downloader', default='browser', help=DOWNLOADER_HELP)
+  command.add_argument('--backend', default='devtools', help='使うプリンター')
+  command.add_argument('--mode', default='xobject', help='見開きのつくり方')
+  command.add_argument('--force', action='store_true', help='更新されていないページもダウンロード・編集し直す')
+  command.add_argument('--since', type=datetime.fromisoformat, help=SINCE_HELP)
+  command.add_argument('--own-browser', action='store_true', help=OWN_BROWSER_HELP)
+  command.add_argument('--spread', action='store_true', help=SPREAD_HELP)
+  command.add_argument('--no-cache', action='store_true', help=NO_CACHE_HELP)
+  command.add_argument('--book', action='store_true', help=BOOK_HELP)
+  command.add_argument('--optimize', action='store_true', help=OPTIMIZE_HELP)
+  command.add_argument('--linearize', action='store_true', help=LINEARIZE_HELP)
+
+  command = add_command('browser', browser, '使い回すブラウザーを起動する・状態を見る・閉じる・Notionにログインする')
+  command.add_argument('action', choices=['start', 'status', 'stop', 'login'])
+  command.add_argument('--headless', action='store_true', help='ヘッドレスで起動する（画面のないLinuxでは指定しなくてもヘッドレス）')
+
+  command = add_command('log', log, '実行時間の記録をまとめて表示する')
+  command.add_argument('path', nargs='?', default=None, help='ログファイル（省略するといちばん新しいもの）')
+  return parser
+
+def main(argv: list = None) -> None:
+  args = make_parser().parse_args(argv)
+  # 選択肢の誤りはサブコマンドの解析器で知らせる
+  args.handler(args.parser, args)
+
+if __name__ == '__main__':
+  # マルチプロセスのバグ回避
+  from multiprocessing import freeze_support
+  freeze_support()
+  main()
@@ -3,56 +3,219 @@
 
 # from mylib import logging
 from bs4 import BeautifulSoup
+from bs4.dammit import EntitySubstitution
+from html.parser import HTMLParser
+import html
 import mymodule
+import runlog
 from pathlib import Path
 import re
 from fractions import Fraction
 import unicodedata
 from tqdm import tqdm
-from queue import LifoQueue
 from dataclasses import dataclass
+from functools import lru_cache, partial
+from multiprocessing import Pool
+import hashlib
+import json
+import argparse
 
-def lenz(s: str):
+# 文字幅の表。全角を1としたときの幅を分数の文字列で表す。
+LENZ_PATTERNS = {
+  ",:;": "2/9",
+  "'‘`": "3/13",
+  "I!": "2/7",
+  "ijl.|": "1/4",
+  "_/\\": "2/5",
+  "frtJ \"()[]{}": "1/3",
+  "*-": "3/7",
+  "?": "4/9",
+  "EFLSTY$": "1/2",
+  "#": "3/5",
+  "~<=>^": "2/3",
+  "DGHNOQ+": "3/4",
+  "%&": "7/8",
+  "mw": "5/6",
+  "MW@": "1",
+}
+# 全角1文字ぶんの整数幅。上の分母（9, 13, 7, 4, 5, 3, 8, 6）の最小公倍数なので、どの幅も割り切れる。
+LENZ_UNIT = 32760
+
+def _char_units(c: str) -> int:
+  """1文字の幅を、全角をLENZ_UNITとした整数で返す"""
+  for pat, length_str in LENZ_PATTERNS.items():
+    if c in pat:
+      return int(Fraction(length_str) * LENZ_UNIT)
+  if re.match('[0-9a-zｱ-ﾝ]', c):
+    return LENZ_UNIT // 2
+  elif re.match('[A-Z]', c):
+    return LENZ_UNIT * 3 // 5
+  # 厳重なチェックのためにやはりunicodedataは取り入れる。
+  elif unicodedata.east_asian_width(c) in 'FW':
+    return LENZ_UNIT
+  elif unicodedata.east_asian_width(c) in 'HNa':
+    return LENZ_UNIT // 2
+  else:   # ほかは間をとって3/4。
+    return LENZ_UNIT * 3 // 4
+
+class _WidthTable(dict):
+  """文字から幅への表
+  
+  ASCIIと半角カナはあらかじめ埋めておき、それ以外の文字は初めて引かれたときに求めて覚える。
+  """
+
+  def __init__(self, convert):
+    super().__init__()
+    self.__convert = convert
+    for c in map(chr, [*range(0x20, 0x7f), *range(0xff61, 0xffa0)]):
+      self[c]
+
+  def __missing__(self, c: str):
+    width = self[c] = self.__convert(_char_units(c))
+    return width
+
+_WIDTH_UNITS = _WidthTable(int)
+# 整数幅を割っただけのfloatは、Fraction(...)をfloatにしたものと等しい（どちらも正しく丸められるので）。
+_WIDTH_FLOATS = _WidthTable(lambda units: units / LENZ_UNIT)
+
+def lenz_units(s: str) -> int:
+  """lenzの整数版。全角をLENZ_UNITとした文字列の長さを返す"""
+  return sum(map(_WIDTH_UNITS.__getitem__, s))
+
+@lru_cache(maxsize=65536)
+def lenz(s: str) -> float:
   """全角を1として、だいたいの文字列の長さを返す
   
   zは全角のz。
+  1文字ずつfloatで足し合わせていく順序は、Fractionを使っていた頃と同じにしてある。
+  （正確な和をとると、int()したときに結果が変わる文字列がまれにあるため）
   """
-  PATTERNS = {
-    ",:;": "2/9",
-    "'‘`": "3/13",
-    "I!": "2/7",
-    "ijl.|": "1/4",
-    "_/\\": "2/5",
-    "frtJ \"()[]{}": "1/3",
-    "*-": "3/7",
-    "?": "4/9",
-    "EFLSTY$": "1/2",
-    "#": "3/5",
-    "~<=>^": "2/3",
-    "DGHNOQ+": "3/4",
-    "%&": "7/8",
-    "mw": "5/6",
-    "MW@": "1",
-  }
   length = 0.
+  table = _WIDTH_FLOATS
   for c in s:
-    for pat, length_str in PATTERNS.items():
-      if c in pat:
-        length += Fraction(length_str)
-        break
+    length += table[c]
+  return length
+
+WIDTHZ = 40   # 全角を1としたときのページ幅
+STYLESHEET_HREF = 'css/styles.css'
+
+_SUMMARY = re.compile(r"<summary>.*?</summary>", re.DOTALL)
+_SUMMARY_EXCLUDED = re.compile(r'(<[^<>]*?>)*[☆※].*', re.DOTALL)
+_SUMMARY_DELETED = re.compile(r'<summary><del>.*?</del></summary>', re.DOTALL)
+_QUES_AND_BLANK = re.compile(r"(<summary>|\n)(([^\n]*?)(　+|[　 ]{2,}))[^　 \n]")
+_TAG = re.compile(r"<[^<>]*?>")
+_LINE_END = re.compile(r'</summary>|\n')
+
+def _scan_answer_start(body: str, startroot: int, limit: int, ques_and_blank_lenz: float):
+  """改行から始まる行について、答えの始まる位置を探す
+  
+  body[startroot:start]からタグを削除した文字列が、
+  既定の「問題+空白」分の長さ（ques_and_blank_lenz）を超えるか、
+  「空白+答えの1文字目」で終わるようになったところの手前を返す。
+  1文字ずつ切り出してタグ削除とlenzをやり直す代わりに、
+  タグの削除と長さの計算を1文字ごとに積み上げていく。
+  limit以降を読む必要が出たらNoneを返す。
+  """
+  table = _WIDTH_FLOATS
+  # タグの外側として確定した文字の長さ・末尾3文字・改行の有無
+  length, tail, has_newline = 0., '', False
+  # 閉じられていない「<」の位置と、そこまで含めた長さ・改行の有無
+  # （左側の山ガッコのみの場合もあるので、閉じるまではタグの外側とみなす）
+  tag_at, tag_length, tag_newline = -1, 0., False
+  for j in range(startroot, len(body)):
+    if j >= limit:
+      return None
+    c = body[j]
+    if c == '<':
+      if tag_at >= 0:   # 閉じられなかった「<」はもうタグにならない
+        length, has_newline = tag_length, has_newline or tag_newline
+        tail = (tail + body[max(tag_at, j-3):j])[-3:]
+      tag_at, tag_length, tag_newline = j, length + table[c], False
+    elif tag_at >= 0:
+      if c == '>':
+        tag_at = -1
+      else:
+        tag_length += table[c]
+        tag_newline = tag_newline or c == '\n'
+    else:
+      length += table[c]
+      tail = (tail + c)[-3:]
+      has_newline = has_newline or c == '\n'
+    if tag_at >= 0:
+      temp_length, temp_tail, temp_newline = tag_length, (tail + body[max(tag_at, j-2):j+1])[-3:], has_newline or tag_newline
     else:
-      if re.match('[0-9a-zｱ-ﾝ]', c):
-        length += Fraction('1/2')
-      elif re.match('[A-Z]', c):
-        length += Fraction('3/5')
-      # 厳重なチェックのためにやはりunicodedataは取り入れる。
-      elif unicodedata.east_asian_width(c) in 'FW':
-        length += 1.
-      elif unicodedata.east_asian_width(c) in 'HNa':
-        length += Fraction('1/2')
-      else:   # ほかは間をとって3/4。
-        length += Fraction('3/4')
-  return float(length)
+      temp_length, temp_tail, temp_newline = length, tail, has_newline
+    # r'.*(　+|[　 ]{2,})[^　 \n]' にfullmatchするかどうか
+    ends_with_answer = not temp_newline and len(temp_tail) >= 2 and temp_tail[-1] not in '　 \n' \
+      and (temp_tail[-2] == '　' or (temp_tail[-2] == ' ' and len(temp_tail) == 3 and temp_tail[-3] in '　 '))
+    if temp_length > ques_and_blank_lenz or ends_with_answer:
+      return j
+  raise ValueError('答えの始まる位置が見つかりませんでした。')
+
+def _summaries(body: str, starts: list):
+  """starts（<summary>の位置）から始まるsummaryのre.Matchを順に返す（重なるものは飛ばす）"""
+  end = 0
+  for start in starts:
+    if start < end: continue
+    summ = _SUMMARY.match(body, start)
+    if summ is None: continue
+    end = summ.end()
+    yield summ
+
+def mask_answers(body: str, starts: list = None):
+  """bodyの一問一答ブロックの答え部分を虫食いにする
+  
+  虫食いにしたbodyと、不適切なトグル（re.Match）のリストを返す。
+  startsに<summary>の位置のリストを渡すと、bodyからsummaryを探し直さずにそれを使う。
+  置換は後ろから順に決まっていくので、置換し終えた後半部分を逆順にためておき、最後に1回だけ連結する。
+  """
+  # body[:cursor] は未置換のまま。piecesは置換済みの後半部分（逆順）
+  cursor = len(body)
+  pieces = []
+  def flush():
+    """それまでの置換をすべて反映させる
+    
+    行の途中で答えが見つからず置換済みの部分まで読み進めてしまう、まれな場合のためのもの。
+    """
+    nonlocal body, cursor, pieces
+    body = body[:cursor] + ''.join(reversed(pieces))
+    cursor = len(body)
+    pieces = []
+
+  invalid_summs = []
+  summaries = _SUMMARY.finditer(body) if starts is None else _summaries(body, starts)
+  for summ in reversed(list(summaries)):
+    if _SUMMARY_EXCLUDED.fullmatch(summ.group(0)): continue
+    if _SUMMARY_DELETED.fullmatch(summ.group(0)): continue
+    match_list = list(_QUES_AND_BLANK.finditer(summ.group(0)))
+    if len(match_list)==0:
+      invalid_summs.append(summ)
+      continue
+    ques_and_blank = _TAG.sub("", match_list[0].group(2))
+    ques_and_blank_lenz = lenz(ques_and_blank)
+    ans_lenz = WIDTHZ - int(ques_and_blank_lenz)
+    repl = f'<mark class="highlight-yellow_background">{"　"*(ans_lenz-3)}\t\t\t\t\t\t</mark>'   # さすがに答え部分は全角文字3つ以上あるだろうという前提
+    for idx, m in enumerate(reversed(match_list)):
+      start = summ.start() + m.end() - 1
+      # summary中に改行がある場合に、虫食い部分が共通の長さにならない現象を解消する
+      # idxが最後じゃないなら（すなわち、改行から始まるなら）
+      if idx < len(match_list)-1:
+        startroot = summ.start() + m.start() + 2
+        start = _scan_answer_start(body, startroot, cursor, ques_and_blank_lenz)
+        if start is None:
+          flush()
+          start = _scan_answer_start(body, startroot, cursor, ques_and_blank_lenz)
+      line_end = _LINE_END.search(body, start)
+      if line_end is None or line_end.end() > cursor:
+        flush()
+        line_end = _LINE_END.search(body, start)
+      stop = line_end.start()
+      pieces.append(body[stop:cursor])
+      pieces.append(repl)
+      cursor = start
+
+  pieces.append(body[:cursor])
+  return ''.join(reversed(pieces)), list(reversed(invalid_summs))
 
 @dataclass
 class NotionHtmlFile():
@@ -60,6 +223,7 @@ class NotionHtmlFile():
   src: Path
   exp_q: Path
   exp_a: Path
+  exp_s: Path = None
 
 class NotionHtmlEditer():
   """HTMLファイルの編集屋"""
@@ -70,7 +234,8 @@ class NotionHtmlEditer():
 
     # BeautifulSoupへ読み込み
     with open(self.nhfile.src, encoding="utf-8") as f:
-      soup = BeautifulSoup(f, 'html.parser')
+      with runlog.timed('reform', 'parse'):
+        soup = BeautifulSoup(f, 'html.parser')
     
     # ハイパーリンクタグ削除（タグの中身は残す）
     tags = soup.select("a")
@@ -88,7 +253,7 @@ class NotionHtmlEditer():
     # スタイルの差し替え
     linktag = soup.new_tag('link')
     linktag.attrs['rel'] = 'stylesheet'
-    linktag.attrs['href'] = 'css/styles.css'
+    linktag.attrs['href'] = STYLESHEET_HREF
     soup.select('head style')[0].replace_with(linktag)
 
     # ヘッダとボディをわけて管理
@@ -125,42 +290,10 @@ class NotionHtmlEditer():
     head = re.sub(r'<title>[^<>]*?</title>', f'<title>{title}</title>', head)
 
     # 解答欄をつくる
-    summary_list = list(re.finditer(r"<summary>(.|\n)*?</summary>", body))
-    WIDTHZ = 40   # 全角を1としたときのページ幅
-    invalid_summs = LifoQueue()
-    for summ in reversed(summary_list):
-      if re.compile(r'(<[^<>]*?>)*[☆※](.|\n)*').fullmatch(summ.group(0)): continue
-      if re.compile(r'<summary><del>(.|\n)*?</del></summary>').fullmatch(summ.group(0)): continue
-      match_list = list(re.finditer(r"(<summary>|\n)(([^\n]*?)(　+|[　 ]{2,}))[^　 \n]", summ.group(0)))
-      if len(match_list)==0: 
-        invalid_summs.put(summ)
-        continue
-      ques_and_blank = re.sub(r"<[^<>]*?>", "", match_list[0].group(2))
-      ques_and_blank_lenz = lenz(ques_and_blank)
-      ans_lenz = WIDTHZ - int(ques_and_blank_lenz)
-      for idx, m in enumerate(list(reversed(match_list))):
-        repl = f'<mark class="highlight-yellow_background">{"　"*(ans_lenz-3)}\t\t\t\t\t\t</mark>'   # さすがに答え部分は全角文字3つ以上あるだろうという前提
-        start = summ.start() + m.end() - 1
-        # summary中に改行がある場合に、虫食い部分が共通の長さにならない現象を解消する
-        # idxが最後じゃないなら（すなわち、改行から始まるなら）
-        if idx < len(match_list)-1:
-          # 既定の「問題+空白」分の長さ（ques_and_blank_lenz）になるか
-          # 答えの文字が登場するまで、startを1ずつ先へ動かす。
-          startroot = summ.start() + m.start() + 2
-          start = startroot + 1
-          while True:
-            # タグを削除。左側の山ガッコのみの場合もあるので、注意している。
-            temp_ques_and_blank = re.sub(r"<[^<>]*>", "", body[startroot:start])
-            if lenz(temp_ques_and_blank) > ques_and_blank_lenz \
-              or re.compile(r'.*(　+|[　 ]{2,})[^　 \n]').fullmatch(temp_ques_and_blank):
-              start -= 1
-              break
-            start += 1
-        stop = start + re.search(r'</summary>|\n', body[start:]).start()
-        body = f'{body[:start]}{repl}{body[stop:] if stop<len(body) else ""}'
-    
-    for n in range(invalid_summs.qsize()):
-      summ = invalid_summs.get()
+    with runlog.timed('reform', 'mask'):
+      body, invalid_summs = mask_answers(body)
+    for summ in invalid_summs:
+      pass
       # logging.warning(f'{self.nhfile.title} にて不適切なトグル: {summ.group(0)}')
 
     return f'<html>{head}{body}</html>'
@@ -171,34 +304,396 @@ class NotionHtmlEditer():
     # text = text.replace(' ', '&nbsp;')
     return text
 
-def main():
-  # 対象のHTMLファイルのパスのリスト
-  SRCDIR = mymodule.APPDIR / 'html/src/'
-  EXPDIR = mymodule.APPDIR / 'html/reformed/'
-  nhfiles = []
-  for title in mymodule.target_pages():
-    src = SRCDIR / f'{title}.html'
-    # もととなるHTMLファイルが実際に存在していなければ、ログに書いたうえでスキップ
-    if not src.exists():
-      # logging.info(f'Missed the file "{src.name}"')
-      continue
-    exp_q = EXPDIR / f'{title}{mymodule.POSTFIXES.q}.html'
-    exp_a = EXPDIR / f'{title}{mymodule.POSTFIXES.a}.html'
-    nhfiles.append(NotionHtmlFile(title, src, exp_q, exp_a))
-  bar = tqdm(total=len(nhfiles)*2)
-  bar.set_description('Exporting HTML')
-  for nhfile in nhfiles:
-    editer = NotionHtmlEditer(nhfile)
+# BeautifulSoup（html.parser）と同じ書き出し方をするための表
+_EMPTY_ELEMENTS = frozenset([
+  'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+  'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr',
+])
+_LIST_ATTRIBUTES = {
+  'a': {'rel', 'rev'}, 'link': {'rel', 'rev'}, 'td': {'headers'}, 'th': {'headers'}, 'form': {'accept-charset'},
+  'object': {'archive'}, 'area': {'rel'}, 'icon': {'sizes'}, 'iframe': {'sandbox'}, 'output': {'for'},
+}
+_LIST_ATTRIBUTES_ANY = {'class', 'accesskey', 'dropzone'}
+_PRESERVE_WHITESPACE = ('pre', 'textarea')
+_CDATA_CONTAINING = ('script', 'style')
+_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+_NEWLINE = re.compile(r'\r\n?')
+
+def _escape(text: str) -> str:
+  return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def _quoted_attribute(value: str) -> str:
+  value = _escape(value)
+  if '"' in value:
+    if "'" in value:
+      return '"' + value.replace('"', '&quot;') + '"'
+    return "'" + value + "'"
+  return '"' + value + '"'
+
+class _OpenElement():
+  """読み進めている途中の、開いている要素"""
+  __slots__ = ('name', 'hidden', 'pruning', 'page_body', 'indented', 'capture')
+
+  def __init__(self, name: str, parent):
+    self.name = name
+    # 中身ごと書き出さないか
+    self.hidden = parent is not None and parent.hidden
+    # summary以外の子を取り除くdetailsか
+    self.pruning = False
+    # div.page-body の中か、div.page-body div.indented の中か
+    self.page_body = parent is not None and parent.page_body
+    self.indented = parent is not None and parent.indented
+    # 最初のhead・body要素なら 'head'・'body'
+    self.capture = None
+
+class _SinglePassReformer(HTMLParser):
+  """HTMLを1回読むだけで、NotionHtmlEditerと同じheadとbodyを書き出す
+
+  BeautifulSoupで木をつくって編集し文字列に戻す代わりに、読み進めながら
+  aタグの除去・detailsの中身の除去・スタイルの差し替え・codeタグの連結を済ませて書き出す。
+  書き出し方（属性の並びやエスケープ、空白だけの文字列のまとめ方など）はBeautifulSoupに合わせてある。
+  """
+
+  def __init__(self):
+    super().__init__(convert_charrefs=False)
+    self.head = []
+    self.body = []
+    # bodyに書いた<summary>の位置
+    self.summary_starts = []
+    self.__body_len = 0
+    self.__stack = []
+    self.__data = []
+    self.__captures = set()
+    self.__captured = set()
+    self.__preserve = 0
+    self.__style_replaced = False
+
+  def __emit(self, chunk: str) -> None:
+    if '\r' in chunk:
+      chunk = _NEWLINE.sub('\n', chunk)
+    if 'head' in self.__captures:
+      self.head.append(chunk)
+    if 'body' in self.__captures:
+      body = self.body
+      # 文中コードの不格好を解消（</code><code> などをつなげる）
+      if chunk == '<code>' and body:
+        if body[-1] == '</code>':
+          body.pop()
+          self.__body_len -= 7
+          return
+        if len(body) >= 2 and body[-2] == '</code>' and body[-1] in ('<strong>', '<em>'):
+          tag = body.pop()
+          body[-1] = tag
+          self.__body_len -= 7
+          return
+      if chunk == '<summary>':
+        self.summary_starts.append(self.__body_len)
+      body.append(chunk)
+      self.__body_len += len(chunk)
+
+  def __parent(self):
+    """aを取り除いたあとの親要素"""
+    for element in reversed(self.__stack):
+      if element.name != 'a':
+        return element
+    return None
+
+  def __flush(self, prefix: str = '', suffix: str = '') -> None:
+    """たまった文字列を書き出す（空白だけならBeautifulSoupと同じく1文字にまとめる）"""
+    if not self.__data: return
+    data = ''.join(self.__data)
+    self.__data = []
+    if not self.__preserve and not data.strip(_ASCII_SPACES):
+      data = '\n' if '\n' in data else ' '
+    if not self.__captures: return
+    if self.__stack:
+      if self.__stack[-1].hidden: return
+      parent = self.__parent()
+      if parent is not None and parent.pruning: return
+    if prefix:
+      self.__emit(prefix + data + suffix)
+    elif self.__stack and self.__stack[-1].name in _CDATA_CONTAINING:
+      self.__emit(data)
+    else:
+      self.__emit(_escape(data))
+
+  def handle_starttag(self, tag: str, attrs: list) -> None:
+    self.__start(tag, attrs)
+    if tag in _EMPTY_ELEMENTS: self.__pop(tag)
+
+  def handle_startendtag(self, tag: str, attrs: list) -> None:
+    self.__start(tag, attrs)
+    self.__pop(tag)
+
+  def __start(self, tag: str, attrs: list) -> None:
+    self.__flush()
+    attr_dict = {}
+    for key, value in attrs:
+      attr_dict[key] = '' if value is None else value
+    top = self.__stack[-1] if self.__stack else None
+    element = _OpenElement(tag, top)
+    if tag == 'div' and 'class' in attr_dict:
+      classes = attr_dict['class'].split()
+      if 'page-body' in classes: element.page_body = True
+      if 'indented' in classes and top is not None and top.page_body: element.indented = True
+    parent = self.__parent()
+    if parent is not None and parent.pruning and tag not in ('summary', 'a'):
+      element.hidden = True
+    if tag == 'details' and top is not None and top.indented:
+      element.pruning = True
+      attr_dict.pop('open', None)
+    if tag in ('head', 'body') and tag not in self.__captured:
+      element.capture = tag
+      self.__captured.add(tag)
+      self.__captures.add(tag)
+    if tag in _PRESERVE_WHITESPACE: self.__preserve += 1
+    self.__stack.append(element)
+
+    # headの最初のstyleはスタイルシートへのリンクに差し替える
+    if tag == 'style' and not element.hidden and not self.__style_replaced \
+        and any(e.name == 'head' for e in self.__stack):
+      self.__style_replaced = True
+      element.hidden = True
+      self.__emit(f'<link href={_quoted_attribute(STYLESHEET_HREF)} rel="stylesheet"/>')
+    if element.hidden or tag == 'a' or not self.__captures: return
+    list_attributes = _LIST_ATTRIBUTES.get(tag, ())
+    parts = [tag]
+    for key, value in sorted(attr_dict.items()):
+      if key in _LIST_ATTRIBUTES_ANY or key in list_attributes:
+        value = ' '.join(value.split())
+      parts.append(f'{key}={_quoted_attribute(value)}')
+    self.__emit(f'<{" ".join(parts)}{"/" if tag in _EMPTY_ELEMENTS else ""}>')
+
+  def handle_endtag(self, tag: str) -> None:
+    if tag in _EMPTY_ELEMENTS: return
+    self.__flush()
+    # ふつうはいちばん内側の要素が閉じられる
+    if (self.__stack and self.__stack[-1].name == tag) or any(element.name == tag for element in self.__stack):
+      self.__pop(tag)
+
+  def __pop(self, tag: str) -> None:
+    """tagまでの要素を閉じる"""
+    while self.__stack:
+      element = self.__stack.pop()
+      if not element.hidden and element.name != 'a' and element.name not in _EMPTY_ELEMENTS:
+        self.__emit(f'</{element.name}>')
+      if element.name in _PRESERVE_WHITESPACE: self.__preserve -= 1
+      if element.capture: self.__captures.discard(element.capture)
+      if element.name == tag: break
+
+  def handle_data(self, data: str) -> None:
+    self.__data.append(data)
+
+  def handle_entityref(self, name: str) -> None:
+    self.__data.append(EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name, f'&{name}'))
+
+  def handle_charref(self, name: str) -> None:
+    self.__data.append(html.unescape(f'&#{name};'))
+
+  def handle_comment(self, data: str) -> None:
+    self.__flush()
+    self.__data.append(data)
+    self.__flush('<!--', '-->')
+
+  def handle_decl(self, decl: str) -> None:
+    self.__flush()
+    self.__data.append(decl[len('DOCTYPE '):])
+    self.__flush('<!DOCTYPE ', '>\n')
+
+  def handle_pi(self, data: str) -> None:
+    self.__flush()
+    self.__data.append(data)
+    self.__flush('<?', '>')
+
+  def unknown_decl(self, data: str) -> None:
+    self.__flush()
+    if data.upper().startswith('CDATA['):
+      self.__data.append(data[len('CDATA['):])
+      self.__flush('<![CDATA[', ']]>')
+    else:
+      self.__data.append(data)
+      self.__flush('<?', '?>')
+
+  def close(self) -> None:
+    super().close()
+    self.__flush()
+    if self.__stack:
+      self.__pop(None)
+
+class NotionHtmlStreamEditer():
+  """NotionHtmlEditerと同じHTMLを、1回読むだけでつくる編集屋
+
+  BeautifulSoupの木をつくらずに、_SinglePassReformerで読み進めながら答え用のHTMLを書き出し、
+  そのときに覚えておいた<summary>の位置を使って問い用のHTMLをつくる。
+  """
+
+  def __init__(self, nhfile: NotionHtmlFile):
+    """ベースとなる体裁の整えられたHTMLをつくる"""
+    self.nhfile = nhfile
+    with open(self.nhfile.src, encoding="utf-8") as f:
+      source = f.read()
+    parser = _SinglePassReformer()
+    with runlog.timed('reform', 'parse'):
+      parser.feed(source)
+      parser.close()
+    self.__basichead = ''.join(parser.head)
+    self.__basicbody = ''.join(parser.body)
+    self.__summary_starts = parser.summary_starts
+    self.basic_html = f'<html>{self.__retitle(self.__basichead, self.nhfile.exp_a.stem)}{self.__basicbody}</html>'
+
+  @property
+  def problem_html(self):
+    """虫食いになったHTML"""
+    head = self.__retitle(self.__basichead, self.nhfile.exp_q.stem)
+    with runlog.timed('reform', 'mask'):
+      body, invalid_summs = mask_answers(self.__basicbody, self.__summary_starts)
+    for summ in invalid_summs:
+      pass
+      # logging.warning(f'{self.nhfile.title} にて不適切なトグル: {summ.group(0)}')
+    return f'<html>{head}{body}</html>'
+
+  def __retitle(self, head: str, title: str) -> str:
+    # 「&」だけ置き換える理由はNotionHtmlEditerと同じ
+    title = title.replace('&', '&amp;')
+    return re.sub(r'<title>[^<>]*?</title>', f'<title>{title}</title>', head)
+
+# HTMLの編集屋
+EDITERS = {'soup': NotionHtmlEditer, 'stream': NotionHtmlStreamEditer}
+
+_HEAD_END = re.compile(r'</head>')
+_BODY_INNER = re.compile(r'<body[^<>]*>(.*)</body>', re.DOTALL)
+_TITLE = re.compile(r'<title>[^<>]*?</title>')
+
+@lru_cache(maxsize=None)
+def spread_style() -> str:
+  """見開き用のHTMLに足すスタイル
+
+  bodyを2列のグリッドにして、左の列に問い、右の列に答えを置く。
+  印刷すると2つの列はそれぞれ別々にページをまたぐので、各ページの左右には同じページ番号の問いと答えが並ぶ。
+  列のあいだの幅は、combine_pdfsの見開きと同じになるようにhtml2pdf.spread_geometryから決める。
+  """
+  # 見開き用のHTMLをつくるときだけ読み込む
+  from html2pdf import spread_geometry
+  return (
+    '<style>body.spread { display: grid; grid-template-columns: minmax(0, 1fr) minmax(0, 1fr); '
+    f'column-gap: {spread_geometry().gap_mm:.3f}mm; align-items: start; max-width: none; }}</style>'
+  )
+
+def spread_html(problem_html: str, basic_html: str, title: str) -> str:
+  """問い用と答え用のHTMLから、問いと答えを左右に並べた見開き用のHTMLをつくる（titleは<title>にする）"""
+  head = basic_html[len('<html>'):basic_html.index('<body')]
+  head = _TITLE.sub(f'<title>{title.replace("&", "&amp;")}</title>', head, count=1)
+  head = _HEAD_END.sub(f'{spread_style()}</head>', head, count=1)
+  problem = _BODY_INNER.search(problem_html).group(1)
+  basic = _BODY_INNER.search(basic_html).group(1)
+  return (f'<html>{head}<body class="spread">'
+          f'<div class="spread-column">{problem}</div><div class="spread-column">{basic}</div></body></html>')
+
+def reform(nhfile: NotionHtmlFile, engine: str = 'soup', spread: bool = False) -> NotionHtmlFile:
+  """問いと答えのHTMLをつくって保存する（プロセスプールの各プロセスで実行される）
+
+  engineには使う編集屋（EDITERSのキー）を指定。
+  spread=True なら、問いと答えを左右に並べた見開き用のHTML（nhfile.exp_s）を1つだけつくる。
+  """
+  with runlog.timed('reform', 'page', page=nhfile.title):
+    editer = EDITERS[engine](nhfile)
+    if spread:
+      with open(nhfile.exp_s, 'w', encoding='utf-8') as f:
+        f.write(spread_html(editer.problem_html, editer.basic_html, nhfile.exp_s.stem))
+      return nhfile
     # 問いとなるHTMLを作成
     with open(nhfile.exp_q, 'w', encoding='utf-8') as f:
       f.write(editer.problem_html)
-    # logging.info(f'Exported {nhfile.exp_q.stem}')
-    bar.update(1)
     # 答えとなるHTMLを作成
     with open(nhfile.exp_a, 'w', encoding='utf-8') as f:
       f.write(editer.basic_html)
-    # logging.info(f'Exported {nhfile.exp_a.stem}')
-    bar.update(1)
+  return nhfile
+
+def html_file(title: str) -> NotionHtmlFile:
+  """タイトルから、もとのHTMLと問い用・答え用のHTMLのパスをまとめて返す"""
+  page = mymodule.make_page(title)
+  return NotionHtmlFile(title, page.src, page.html_q, page.html_a, page.html_s)
+
+def settings_digest() -> str:
+  """編集の設定のハッシュを返す
+  
+  このスクリプト自体も含めているので、編集のしかたが変われば全ページつくり直される。
+  """
+  h = hashlib.sha256()
+  h.update(json.dumps({'WIDTHZ': WIDTHZ, 'STYLESHEET_HREF': STYLESHEET_HREF}).encode())
+  h.update(Path(__file__).read_bytes())
+  return h.hexdigest()
+
+def manifest_entry(nhfile: NotionHtmlFile, settings: str, spread: bool = False) -> dict:
+  """manifest.jsonに書く、編集したページの記録（もとのHTMLと編集の設定、見開き用かどうか）
+
+  見開き用のHTMLは列のあいだの幅にhtml2pdf.spread_geometryを使うので、その体裁も記録する
+  （印刷の倍率や余白を変えたら、このスクリプトが同じでもつくり直す）。
+  """
+  entry = {'src': mymodule.file_digest(nhfile.src), 'settings': settings}
+  if spread:
+    from html2pdf import spread_geometry
+    entry['layout'] = 'spread'
+    entry['geometry'] = spread_geometry()._asdict()
+  return entry
+
+def main(processes: int = None, force: bool = False, engine: str = 'soup', spread: bool = False):
+  """HTMLを問い用・答え用に編集する
+  
+  processesはプロセスプールの大きさ（Noneならコア数、1ならこのプロセスだけで処理）。
+  engineは使う編集屋（EDITERSのキー）。streamはsoupと同じHTMLをつくるはずだが、
+  environment.ymlで固定したBeautifulSoupでも同じになることを bench_reform_engines.py で確かめてから使うこと。
+  spread=True なら、問い用・答え用のかわりに見開き用のHTMLを1つずつつくる（html2pdfもspread=Trueで印刷する）。
+  もとのHTMLと編集の設定が前回から変わっていないページは飛ばす。force=Trueならすべてつくり直す。
+  """
+  # 対象のHTMLファイルのパスのリスト（もととなるHTMLファイルが存在しないページは飛ばす）
+  status = mymodule.stage_status('reform_spread' if spread else 'reform')
+  nhfiles = [html_file(page.title) for page in status.ready]
+  # 問い用・答え用（見開き用）のHTMLがまだそろっていないページ
+  unfinished = {page.title for page in status.pending}
+  per_page = 1 if spread else 2
+  bar = tqdm(total=len(nhfiles)*per_page)
+  bar.set_description('Exporting HTML')
+
+  # 前回から変わっていないページは飛ばす
+  manifest_path = mymodule.DIRS.html_reformed / 'manifest.json'
+  manifest = {} if force else mymodule.load_manifest(manifest_path)
+  settings = settings_digest()
+  entries = {}
+  todo = []
+  for nhfile in nhfiles:
+    entries[nhfile.title] = manifest_entry(nhfile, settings, spread)
+    if manifest.get(nhfile.title) == entries[nhfile.title] and nhfile.title not in unfinished:
+      # logging.info(f'Skipped {nhfile.title} (unchanged)')
+      bar.update(per_page)
+      continue
+    todo.append(nhfile)
+
+  def done(nhfile: NotionHtmlFile):
+    manifest[nhfile.title] = entries[nhfile.title]
+    # logging.info(f'Exported {nhfile.exp_q.stem} and {nhfile.exp_a.stem}')
+    bar.update(per_page)
+
+  # 途中で止まっても、できたぶんは次回飛ばせるように記録を残す
+  try:
+    if processes == 1 or len(todo) <= 1:
+      for nhfile in todo:
+        done(reform(nhfile, engine=engine, spread=spread))
+    else:
+      with Pool(processes=processes) as pool:
+        for nhfile in pool.imap_unordered(partial(reform, engine=engine, spread=spread), todo):
+          done(nhfile)
+  finally:
+    mymodule.save_manifest(manifest_path, manifest)
 
 if __name__ == '__main__':
-  main()
+  parser = argparse.ArgumentParser(description='HTMLを問い用・答え用に編集する')
+  parser.add_argument('--engine', choices=EDITERS.keys(), default='soup', help='使う編集屋')
+  parser.add_argument('--processes', type=int, default=None, help='プロセスプールの大きさ（1ならこのプロセスだけで処理）')
+  parser.add_argument('--force', action='store_true', help='変わっていないページも編集し直す')
+  parser.add_argument('--spread', action='store_true', help='問い用・答え用のかわりに、左右に並べた見開き用のHTMLをつくる')
+  args = parser.parse_args()
+
+  runlog.start('reform_html')
+  main(processes=args.processes, force=args.force, engine=args.engine, spread=args.spread)
+  runlog.report()
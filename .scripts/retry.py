@@ -0,0 +1,73 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""やり直しの間隔と、あきらめたものの記録
+
+  backoff = Backoff()
+  for attempt in range(1, 6):
+    if attempt > 1: time.sleep(backoff.delay(attempt-1))
+    ...
+
+  dead = DeadLetters(path)   # 前回あきらめたもの
+  dead.add(title, url=url, error=error)
+  dead.save()
+"""
+
+import time
+import random
+import mymodule
+from pathlib import Path
+from datetime import datetime
+
+class Backoff():
+  """指数関数的に伸ばし、ゆらぎ（ジッター）を加えたやり直しの間隔
+
+  n回目の失敗のあとは base_second * factor**(n-1) 秒（max_secondが上限）の、半分から全部までのどこかだけ待つ。
+  いっせいに失敗したものが同じ間隔でやり直してまたぶつかることがないよう、ゆらぎを加える。
+  """
+
+  def __init__(self, base_second: float = 0.25, factor: float = 2., max_second: float = 8., seed: int = None):
+    self.base_second = base_second
+    self.factor = factor
+    self.max_second = max_second
+    self.__random = random.Random(seed)
+
+  def delay(self, failures: int) -> float:
+    """failures回失敗したあとに待つ秒数"""
+    cap = min(self.max_second, self.base_second * self.factor ** max(0, failures-1))
+    return cap / 2 + self.__random.uniform(0, cap / 2)
+
+  def sleep(self, failures: int) -> float:
+    """failures回失敗したあとの間隔だけ待ち、その秒数を返す"""
+    seconds = self.delay(failures)
+    time.sleep(seconds)
+    return seconds
+
+class DeadLetters():
+  """やり直してもだめだったもの（{キー: 記録}）をJSONに残しておき、次の実行でやり直せるようにする"""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.entries = mymodule.load_manifest(path)
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.entries
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def keys(self) -> list:
+    return list(self.entries)
+
+  def add(self, key: str, **record) -> None:
+    """あきらめたものを記録する（何回目のあきらめかも数える）"""
+    record['failed_at'] = datetime.now().isoformat(timespec='seconds')
+    record['runs'] = self.entries.get(key, {}).get('runs', 0) + 1
+    self.entries[key] = record
+
+  def remove(self, key: str) -> None:
+    """うまくいったものを記録から外す"""
+    self.entries.pop(key, None)
+
+  def save(self) -> None:
+    mymodule.save_manifest(self.path, self.entries)
@@ -0,0 +1,156 @@
+# Copyright (c) 2023 Kanta Yasuda (GitHub: @kyasuda516)
+# This software is released under the MIT License, see LICENSE.
+
+"""各段・各ページ・各手順にかかった時間の記録
+
+1回の実行ごとに log/run-日時.jsonl をつくり、1手順1行のJSONで書き足していく。
+プロセスプールの子プロセスも同じファイルに書く（ファイルの場所は環境変数で引き継ぐ）。
+記録が始まっていなければ何も書かない。
+
+  runlog.start('combine_pdfs')
+  with runlog.timed('combine', 'compose', page=title):
+    ...
+  with runlog.timed('download', 'unpack', page=title) as timing:
+    if not unpack(): timing.fail()   # 例外で抜けない失敗は自分で知らせる
+  runlog.report()
+
+記録をまとめて見るには python runlog.py [ログファイル]
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import mymodule
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime
+
+LOGDIR = mymodule.APPDIR / 'log'
+# 記録中のログファイルのパスを子プロセスへ引き継ぐための環境変数
+ENV_NAME = 'NOTION_QUIZ_RUNLOG'
+
+# このプロセスで開いているログファイル (パス, ファイル記述子)
+_opened = (None, None)
+_lock = threading.Lock()
+# スレッドごとの、いま処理しているページ（入れ子になったtimedが引き継ぐ）
+_local = threading.local()
+
+def start(name: str) -> Path:
+  """記録を始めてログファイルのパスを返す。すでに始まっていればそれを引き継ぐ"""
+  if os.environ.get(ENV_NAME):
+    return Path(os.environ[ENV_NAME])
+  LOGDIR.mkdir(parents=True, exist_ok=True)
+  path = LOGDIR / f'run-{datetime.now():%Y%m%d-%H%M%S}-{name}.jsonl'
+  os.environ[ENV_NAME] = str(path)
+  return path
+
+def current() -> Path:
+  """記録中のログファイルのパス。記録していなければNone"""
+  path = os.environ.get(ENV_NAME)
+  return Path(path) if path else None
+
+def _write(line: bytes) -> None:
+  global _opened
+  path = os.environ.get(ENV_NAME)
+  if not path: return
+  with _lock:
+    if _opened[0] != path:
+      if _opened[1] is not None: os.close(_opened[1])
+      _opened = (path, os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644))
+    # 追記モードで1行を1回で書けば、ほかのプロセスの行と混ざらない
+    os.write(_opened[1], line)
+
+def record(stage: str, step: str, seconds: float = None, page: str = None, **fields) -> None:
+  """1手順ぶんを記録する。secondsを省略すると回数だけの記録（リトライなど）になる"""
+  if not os.environ.get(ENV_NAME): return
+  if page is None: page = getattr(_local, 'page', None)
+  entry = {'ts': round(time.time(), 3), 'pid': os.getpid(), 'stage': stage, 'step': step, 'page': page}
+  if seconds is not None: entry['seconds'] = round(seconds, 6)
+  entry.update(fields)
+  _write((json.dumps(entry, ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+
+class Timing():
+  """timedがwithに渡すもの。失敗を戻り値で知らせる処理は、fail()を呼んで ok: false にする"""
+
+  def __init__(self):
+    self.ok = True
+    self.fields = {}
+
+  def fail(self, **fields) -> None:
+    """例外で抜けなくても失敗として記録させる。fieldsは記録に書き足す"""
+    self.ok = False
+    self.fields.update(fields)
+
+@contextmanager
+def timed(stage: str, step: str, page: str = None, **fields):
+  """withの中にかかった時間を記録する
+
+  pageを指定すると、中で呼ばれるtimedやrecordもそのページのものとして記録される。
+  例外で抜けたとき、またはwithに渡したTimingのfail()を呼んだときは ok: false として記録する。
+  """
+  outer = getattr(_local, 'page', None)
+  if page is not None: _local.page = page
+  started = time.perf_counter()
+  timing = Timing()
+  ok = False
+  try:
+    yield timing
+    ok = timing.ok
+  finally:
+    record(stage, step, time.perf_counter() - started, page, ok=ok, **{**fields, **timing.fields})
+    _local.page = outer
+
+def load(path: Path) -> list:
+  """ログファイルを読み込む（書きかけの行は飛ばす）"""
+  entries = []
+  with open(path, encoding='utf-8') as f:
+    for line in f:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        pass
+  return entries
+
+def _percentile(sorted_values: list, ratio: float) -> float:
+  return sorted_values[min(len(sorted_values)-1, int(len(sorted_values)*ratio))]
+
+def summarize(entries: list) -> list:
+  """段・手順ごとに、回数・合計・p50・p95・最大と、最大だったページを返す（合計の大きい順）"""
+  groups = {}
+  for entry in entries:
+    groups.setdefault((entry['stage'], entry['step']), []).append(entry)
+  rows = []
+  for (stage, step), group in groups.items():
+    timed_entries = sorted((e for e in group if 'seconds' in e), key=lambda e: e['seconds'])
+    seconds = [e['seconds'] for e in timed_entries]
+    row = {'stage': stage, 'step': step, 'count': len(group), 'failed': sum(1 for e in group if e.get('ok') is False)}
+    if seconds:
+      row.update(total=sum(seconds), p50=_percentile(seconds, 0.5), p95=_percentile(seconds, 0.95),
+                 max=seconds[-1], max_page=timed_entries[-1].get('page'))
+    rows.append(row)
+  rows.sort(key=lambda row: row.get('total', 0.), reverse=True)
+  return rows
+
+def report(path: Path = None, file=None) -> None:
+  """ログファイル（省略すると記録中のもの）のまとめを表で出す"""
+  path = path or current()
+  if path is None or not Path(path).exists(): return
+  file = file or sys.stdout
+  print(f'Run log: {path}', file=file)
+  print(f'{"stage":<10} {"step":<20} {"count":>6} {"fail":>5} {"total s":>9} {"p50 s":>8} {"p95 s":>8} {"max s":>8}  slowest page', file=file)
+  for row in summarize(load(path)):
+    if 'total' in row:
+      print(f'{row["stage"]:<10} {row["step"]:<20} {row["count"]:>6} {row["failed"]:>5} {row["total"]:>9.2f} '
+            f'{row["p50"]:>8.3f} {row["p95"]:>8.3f} {row["max"]:>8.3f}  {row["max_page"] or ""}', file=file)
+    else:
+      print(f'{row["stage"]:<10} {row["step"]:<20} {row["count"]:>6} {row["failed"]:>5}', file=file)
+
+if __name__ == '__main__':
+  # 指定がなければいちばん新しいログをまとめる
+  if len(sys.argv) > 1:
+    report(Path(sys.argv[1]))
+  else:
+    logs = sorted(LOGDIR.glob('run-*.jsonl'))
+    if logs: report(logs[-1])